@@ -1,15 +1,21 @@
 import os
-from tenacity import retry
-from openai import AzureOpenAI
+import concurrent.futures
 import json
-from json_repair import repair_json
-from datasets import load_dataset
 
 from prompts import *
+from backends import AzureBackend
+from feedback_store import OK,FeedbackStore,StoredReferences
+from parsing import ParseStats
+from retry_policy import RetryPolicy
+from teacher_client import TeacherClient
+from token_budget import TokenBudget
+from tracing import Tracer
+from usage import FEEDBACK,UsageTracker
+from seed_source import SeedSource
 
 
 class ReferenceLevelFeedbackCollector():
-    def __init__(self, teacher_name="gpt-4o-mini", seed_dataset_name="GAIR/lima", output_dir="./output_dir"):
+    def __init__(self, teacher_name="gpt-4o-mini", seed_dataset_name="GAIR/lima", output_dir="./output_dir", cache=None, backend=None, retry_policy=None, seed_source=None, token_budget=None, tracer=None, prompt_layout="original", feedback_store=None):
         """
         Initialize the feedback collector with model and dataset configurations.
 
@@ -17,20 +23,35 @@ class ReferenceLevelFeedbackCollector():
             teacher_name (str): name of the teacher model used to collect feedback
             seed_dataset_name (str): name of the seed dataset used for reference samples
             output_dir (str): directory to save the feedback files
+            cache (Optional[CompletionCache]): persistent cache of teacher model completions
+            backend (Optional[OpenAIBackend]): backend serving the teacher model, defaults to Azure OpenAI configured from the environment
+            retry_policy (Optional[RetryPolicy]): retry policy for teacher model requests, can be shared with the synthesizer
+            seed_source (Optional[SeedSource]): seed samples to read instead of seed_dataset_name with LIMA's schema
+            token_budget (Optional[TokenBudget]): per-stage max_tokens, can be shared with the synthesizer
+            tracer (Optional[Tracer]): records spans of requests and seed samples, can be shared with the synthesizer
+            prompt_layout (str): "cache" to put the static parts of prompts first and the seed sample last, so requests share prefixes the provider can cache, or "original"
+            feedback_store (Optional[FeedbackStore]): store of feedback keyed by seed sample, teacher model and prompt version, shared between runs, so only new and previously failed seed samples are collected
         """
         self.teacher_name = teacher_name
+        self.cache = cache
+        self.prompt_layout = prompt_layout
+        self.feedback_store = feedback_store
 
         self.output_dir = output_dir
         os.makedirs(output_dir, exist_ok=True)
 
-        self.client = AzureOpenAI(
-            azure_endpoint=os.getenv("AZURE_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_KEY"),
-            api_version=os.getenv("AZURE_VERSION")
-        )
+        self.backend = backend or AzureBackend()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.token_budget = token_budget or TokenBudget()
+        self.tracer = tracer or Tracer()
+
+        self.usage = UsageTracker(teacher_name)
+        self.parse_stats = ParseStats()
+        self.client = TeacherClient(teacher_name, self.backend, self.retry_policy, self.token_budget, self.tracer, self.usage, self.parse_stats, cache)
+        self.num_collected = 0
 
         self.seed_dataset_name = seed_dataset_name
-        self.seed_dataset = self.process_seed_dataset(seed_dataset_name)
+        self.seed_dataset = seed_source if seed_source is not None else self.process_seed_dataset(seed_dataset_name)
 
     def process_seed_dataset(self, seed_dataset_name):
         """
@@ -40,131 +61,247 @@ class ReferenceLevelFeedbackCollector():
             seed_dataset_name (str): name of dataset to load
 
         Returns:
-            list: list of objects with instruction and response values
-        """
-        ds = load_dataset(seed_dataset_name)
-
-        processed_data = []
-        for elem in ds["train"]:
-            conversations = elem["conversations"]
-            if len(conversations)==2:
-                instruction,response = conversations[0],conversations[1]
-
-                processed_data.append({
-                    "instruction": instruction,
-                    "response": response
-                })
-        return processed_data
-
-    @retry
-    def azure_openai_completion(
-        self,
-        prompt,
-        model_name,
-        temperature,
-        max_tokens,
-        top_p,
-        stop=None
-    ):
-        """
-        Make an API call to Azure OpenAI for chat completion.
+            Iterable[dict]: objects with instruction and response values, read lazily
+        """
+        return SeedSource(seed_dataset_name)
 
-        Args:
-            prompt (str): prompt for the model
-            model_name (str): name of the model to use
-            temperature (float): sampling temperature
-            max_tokens (int): maximum number of tokens to generate
-            top_p (float): nucleus sampling parameter
-            stop (Optional[str]): stop sequence for text generation
+    def azure_openai_completion(self, prompt, model_name, temperature, max_tokens, top_p, stop=None, sample_index=None):
+        """
+        Make an API call to the teacher model backend for chat completion, see TeacherClient.complete.
+        """
+        return self.client.complete(prompt, model_name, temperature, max_tokens, top_p, stop, sample_index, FEEDBACK)
 
-        Returns:
-            dict: Response containing generated text
-        """
-        messages = [{"role": "user", "content": prompt }]
-
-        try:
-            response = self.client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=top_p,
-                stop=stop,
-                logit_bias={"50256": -100},
-            )
-            response = response.choices[0].message.content
-            return {"text": response.strip()}
-        except Exception as e:
-            if "The response was filtered due to the prompt triggering Azure OpenAI's content management policy. Please modify your prompt and retry." in str(e):
-                return {"text": ""}
-            else:
-                raise
-
-    @retry
-    def ask_gpt(self, prompt):
+    def ask_gpt(self, prompt, schema=None):
         """
         Submits a request to the teacher model
 
         Args:
             prompt (str): input prompt for the model
+            schema (Optional[dict]): output schema from prompts.py, the request is re-sent a bounded number of times if the output does not match it
 
         Returns:
-            str: Generated response
+            Union[str, dict]: Generated response, or its validated fields if schema is given
         """
-        response = self.azure_openai_completion(
-            prompt=prompt,
-            model_name=self.teacher_name,
-            temperature =1.0,
-            max_tokens=4096,
-            top_p=1.0
-        )
-        return response["text"]
-
+        return self.client.ask(prompt, FEEDBACK, schema=schema)
 
-    def collect_feedback(self):
+    def collect_sample_feedback(self, elem):
         """
-        Collects reference-level feedback on instructions and responses from the seed dataset.
+        Collects reference-level feedback on a single seed sample.
+
+        Args:
+            elem (dict): seed sample with instruction and response values
 
         Returns:
-            list: Collection of processed samples with their corresponding feedback
+            dict: the sample along with its instruction and response feedback
         """
-        print(f"Beginning reference-level feedback collection for reference samples from {self.seed_dataset_name}\n\n")
+        instruction,response = elem["instruction"],elem["response"]
 
-        filepath = os.path.join(self.output_dir, "feedback.json")
-        if os.path.exists(filepath):
-            print(f"Loading pre-generated reference-level feedback from: {filepath}")
-            with open(filepath, "r") as file: return json.load(file)
+        instruction_feedback_prompt = get_instruction_feedback_prompt(instruction, response, self.prompt_layout)
+        response_feedback_prompt = get_response_feedback_prompt(instruction, response, self.prompt_layout)
+
+        with self.tracer.span("stage", stage=FEEDBACK):
+            instruction_feedback = self.ask_gpt(instruction_feedback_prompt, INSTRUCTION_FEEDBACK_SCHEMA)
+            response_feedback = self.ask_gpt(response_feedback_prompt, RESPONSE_FEEDBACK_SCHEMA)
+
+        return {
+            "instruction": instruction,
+            "reference_response": response,
+
+            "instruction_feedback_subject": instruction_feedback["subject_areas"],
+            "instruction_feedback_skill": instruction_feedback["relevant_skills"],
+            "response_feedback": response_feedback["response_feedback"]
+        }
+
+    def stats(self):
+        """
+        Returns:
+            dict: progress, token usage and cost, and retries, for the metrics snapshot
+        """
+        return {"records": self.num_collected, "usage": self.usage.stats(), "retries": self.retry_policy.stats()}
 
-        samples_with_feedback = []
-        for i,elem in enumerate(self.seed_dataset):
-            instruction,response = elem["instruction"],elem["response"]
+    def sample_key(self, instruction, response):
+        """
+        Returns:
+            str: hash identifying the feedback of a seed sample, independent of its position in the seed dataset
+        """
+        return FeedbackStore.key(instruction, response, self.teacher_name, FEEDBACK_PROMPT_VERSION)
 
-            instruction_feedback_prompt = get_instruction_feedback_prompt(instruction, response)
-            response_feedback_prompt = get_response_feedback_prompt(instruction, response)
+    def load_feedback_checkpoint(self, checkpoint_path):
+        """
+        Loads the samples whose feedback was already collected by a previous, interrupted run.
 
-            print(f"Collecting feedback for reference sample {i}")
+        Args:
+            checkpoint_path (str): path to the feedback checkpoint file
 
-            try:
-                instruction_feedback = self.ask_gpt(instruction_feedback_prompt)
-                instruction_feedback = repair_json(instruction_feedback, return_objects=True)
+        Returns:
+            dict: seed sample key mapped to the sample with its feedback
+        """
+        completed = {}
+        if not os.path.exists(checkpoint_path): return completed
+
+        with open(checkpoint_path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be partially written if the previous run crashed mid-write
+                    continue
+                sample = record["sample"]
+                completed[self.sample_key(sample["instruction"], sample["reference_response"])] = sample
+        return completed
+
+    def collect_pending(self, pending, num_workers, on_collected, on_failed=None):
+        """
+        Collects feedback on seed samples with up to num_workers of them processed concurrently.
 
-                response_feedback = self.ask_gpt(response_feedback_prompt)
-                response_feedback = repair_json(response_feedback, return_objects=True)["response_feedback"]
+        Args:
+            pending (Iterator[tuple]): seed sample indices and samples, read lazily with a bounded number submitted ahead of the workers
+            num_workers (int): maximum number of seed samples with requests in flight at once
+            on_collected (Callable[[int, dict], None]): called with the index and the sample with its feedback, from the calling thread
+            on_failed (Optional[Callable[[int, Exception], None]]): called with the index and the error of samples whose collection failed
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = {}
+            while True:
+                while len(futures) < 2 * num_workers:
+                    i,elem = next(pending, (None, None))
+                    if elem is None: break
+                    futures[executor.submit(self.collect_sample_feedback, elem)] = i
+                if not futures: break
+
+                done,_ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    i = futures.pop(future)
+                    try:
+                        sample = future.result()
+                    except Exception as e:
+                        print(f"Feedback collection failed for reference sample {i}: {e}")
+                        if on_failed is not None: on_failed(i, e)
+                        continue
+                    on_collected(i, sample)
+                    print(f"Collected feedback for reference sample {i}")
+
+    def print_summary(self):
+        if isinstance(self.seed_dataset, SeedSource) and self.seed_dataset.num_skipped: print(f"Skipped {self.seed_dataset.num_skipped} seed samples longer than {self.seed_dataset.max_tokens} tokens")
+        print(f"\n\n{self.usage.summary('Total cost for feedback collection')}")
+        print(self.retry_policy.summary())
+        print(self.parse_stats.summary())
+        print(self.token_budget.summary())
+        if self.cache is not None: print(self.cache.summary())
+
+    def collect_feedback(self, num_workers=16, collect_missing=True):
+        """
+        Collects reference-level feedback on instructions and responses from the seed dataset.
+        Up to num_workers seed samples are processed concurrently, and each finished sample is
+        appended to a checkpoint file, or committed to the feedback store, so an interrupted run
+        resumes where it stopped.
 
+        Args:
+            num_workers (int): maximum number of seed samples with requests in flight at once
+            collect_missing (bool): with a feedback store, False to only look up the feedback already stored for the seed samples
 
-                samples_with_feedback.append({
-                    "instruction": instruction,
-                    "reference_response": response,
+        Returns:
+            Sequence: Collection of processed samples with their corresponding feedback, read from the feedback store on access if there is one
+        """
+        print(f"Beginning reference-level feedback collection for reference samples from {self.seed_dataset_name}\n\n")
+        if self.feedback_store is not None: return self.collect_feedback_into_store(num_workers, collect_missing)
 
-                    "instruction_feedback_subject": instruction_feedback["subject_areas"],
-                    "instruction_feedback_skill": instruction_feedback["relevant_skills"],
-                    "response_feedback": response_feedback
-                })
-            except Exception as e:
-                print(f"Feedback collection failed: {e}")
+        filepath = os.path.join(self.output_dir, "feedback.json")
+        if os.path.exists(filepath):
+            print(f"Loading pre-generated reference-level feedback from: {filepath}")
+            with open(filepath, "r") as file: return json.load(file)
 
+        checkpoint_path = os.path.join(self.output_dir, "feedback_checkpoint.jsonl")
+        # Keyed by content rather than position, which shifts when the seed dataset, split or length filter changes
+        checkpointed = self.load_feedback_checkpoint(checkpoint_path)
+        if checkpointed: print(f"Resuming from {checkpoint_path} with feedback for {len(checkpointed)} reference samples")
+        completed,keys = {},{}
+
+        def pending():
+            for i,elem in enumerate(self.seed_dataset):
+                key = self.sample_key(elem["instruction"], elem["response"])
+                if key in checkpointed:
+                    completed[i] = checkpointed[key]
+                    self.num_collected = len(completed)
+                else:
+                    keys[i] = key
+                    yield i,elem
+
+        with open(checkpoint_path, "a") as checkpoint_file:
+            def on_collected(i, sample):
+                completed[i] = sample
+                with self.tracer.span("checkpoint"):
+                    checkpoint_file.write(json.dumps({"key": keys.pop(i), "sample": sample}) + "\n")
+                    checkpoint_file.flush()
+                self.num_collected = len(completed)
+
+            self.collect_pending(pending(), num_workers, on_collected)
+
+        samples_with_feedback = [completed[i] for i in sorted(completed)]
+
+        self.print_summary()
         print(f"\n\nReference-level feedback collection completed, saving to: {filepath}")
-        with open(filepath, "w") as file:
+        with open(filepath + ".tmp", "w") as file:
             json.dump(samples_with_feedback, file)
+        os.replace(filepath + ".tmp", filepath)
+        # feedback.json supersedes the checkpoint
+        os.remove(checkpoint_path)
+
+        return samples_with_feedback
+
+    def collect_feedback_into_store(self, num_workers, collect_missing=True):
+        """
+        Collects feedback only for the seed samples whose key is not in the feedback store, or
+        whose collection failed in an earlier run. Each finished sample is committed to the
+        store, which doubles as the checkpoint. feedback.json is still written as a snapshot of
+        the run's reference samples, for batch mode and sharded runs.
+
+        Args:
+            num_workers (int): maximum number of seed samples with requests in flight at once
+            collect_missing (bool): False to only look up the feedback already stored
 
-        return samples_with_feedback
\ No newline at end of file
+        Returns:
+            StoredReferences: the seed samples with feedback, in seed dataset order
+        """
+        store,version = self.feedback_store,FEEDBACK_PROMPT_VERSION
+        filepath = os.path.join(self.output_dir, "feedback.json")
+        if not store.counts(self.teacher_name, version).get(OK):
+            # Feedback collected before the store was used is imported rather than paid for again
+            checkpoint = self.load_feedback_checkpoint(os.path.join(self.output_dir, "feedback_checkpoint.jsonl"))
+            if os.path.exists(filepath):
+                with open(filepath, "r") as file: checkpoint.update((self.sample_key(sample["instruction"], sample["reference_response"]), sample) for sample in json.load(file))
+            if checkpoint: print(f"Imported feedback for {store.import_samples(checkpoint.values(), self.teacher_name, version)} reference samples from {self.output_dir} into {store.path}")
+
+        row_ids,keys = {},{}
+
+        def pending():
+            for i,elem in enumerate(self.seed_dataset):
+                key = store.key(elem["instruction"], elem["response"], self.teacher_name, version)
+                row = store.lookup(key)
+                if row is not None and row[1] == OK:
+                    row_ids[i] = row[0]
+                    self.num_collected = len(row_ids)
+                elif collect_missing:
+                    keys[i] = key
+                    yield i,elem
+
+        def on_collected(i, sample):
+            with self.tracer.span("checkpoint"): row_ids[i] = store.put(keys.pop(i), self.teacher_name, version, sample)
+            self.num_collected = len(row_ids)
+
+        def on_failed(i, e):
+            store.put_failure(keys.pop(i), self.teacher_name, version, f"{type(e).__name__}: {e}")
+
+        self.collect_pending(pending(), num_workers, on_collected, on_failed)
+        references = StoredReferences(store, [row_ids[i] for i in sorted(row_ids)])
+
+        self.print_summary()
+        print(store.summary(self.teacher_name, version))
+        print(f"\n\nReference-level feedback collection completed for {len(references)} reference samples, saving a snapshot to: {filepath}")
+        with open(filepath + ".tmp", "w") as file:
+            # Streamed from the store, in the format json.dump writes
+            for j,sample in enumerate(references): file.write(("[" if j == 0 else ", ") + json.dumps(sample))
+            file.write("]" if len(references) else "[]")
+        os.replace(filepath + ".tmp", filepath)
+
+        return references
@@ -1,124 +1,135 @@
+import collections
 import json
 import os
-import random
-import concurrent.futures
-
-from openai import AzureOpenAI,OpenAI
-
-import tqdm
-from tenacity import retry
-
-from openai import AzureOpenAI
-import tiktoken
-from json_repair import repair_json
+import threading
 
 from prompts import *
+from data_writer import JsonDataWriter,JsonlDataWriter
+from sampler import ReferenceSampler,ReferenceYield,YieldAwareSampler
+from scheduler import PipelineStage,StagedPipeline
+from backends import AzureBackend
+from completion_cache import CacheMiss
+from parsing import ParseStats,parse_batched_items
+from retry_policy import RetryPolicy
+from teacher_client import TeacherClient
+from token_budget import TokenBudget
+from tracing import Tracer
+from usage import INSTRUCTION_GENERATION,RESPONSE_GENERATION,IMPROVEMENT,UsageTracker
+
+def default_stage_workers(num_workers):
+    """
+    Splits concurrent requests between the synthesis stages. Each instruction generation request
+    yields about ten instructions, each needing a response and an improvement, so most workers go
+    to the later stages.
+
+    Args:
+        num_workers (int): total number of concurrent requests
+
+    Returns:
+        dict: stage mapped to its number of workers
+    """
+    instruction_workers = max(1, num_workers // 10)
+    response_workers = max(1, (num_workers - instruction_workers) // 2)
+    return {INSTRUCTION_GENERATION: instruction_workers, RESPONSE_GENERATION: response_workers, IMPROVEMENT: max(1, num_workers - instruction_workers - response_workers)}
+
 
 class ReferenceLevelFeedbackSynthesizer():
-    def __init__(self, reference_samples_with_feedback, teacher_model="gpt-4o-mini", output_dir="./output_dir"):
+    def __init__(self, reference_samples_with_feedback, teacher_model="gpt-4o-mini", output_dir="./output_dir", output_format="json", shard_size=None, num_workers=40, seed=None, cache=None, backend=None, retry_policy=None, stage_workers=None, deduplicator=None, token_budget=None, instructions_per_prompt=1, reference_sampling="uniform", coverage_floor=0.3, tracer=None, prompt_layout="original", max_draws_without_output=1000):
         """
         Initialize the synthesizer with reference samples, feedback and teacher model.
 
         Args:
-            reference_samples_with_feedback (list): reference samples and their feedback
+            reference_samples_with_feedback (Sequence): reference samples and their feedback, a list or StoredReferences read from a FeedbackStore as they are drawn
             teacher_model (str): name of teacher model to use for data synthesis
             output_dir (str): directory to save the synthesized data
+            output_format (str): "json" to checkpoint the full dataset as pretty-printed JSON, or "jsonl" to stream records to append-only JSONL shards
+            shard_size (Optional[int]): records per JSONL shard, or None for a single JSONL file
+            num_workers (int): number of concurrent requests, split between the stages unless stage_workers is given
+            seed (Optional[int]): seed for reference sampling, so runs can be replayed
+            cache (Optional[CompletionCache]): persistent cache of teacher model completions
+            backend (Optional[OpenAIBackend]): backend serving the teacher model, defaults to Azure OpenAI configured from the environment
+            retry_policy (Optional[RetryPolicy]): retry policy for teacher model requests, can be shared with the collector
+            stage_workers (Optional[dict]): concurrent requests per stage (instruction_generation, response_generation, improvement), overriding the split of num_workers
+            deduplicator (Optional[MinHashDeduplicator]): drops synthesized instructions that are near-duplicates of earlier ones before their responses are generated
+            token_budget (Optional[TokenBudget]): per-stage max_tokens, can be shared with the collector
+            instructions_per_prompt (int): synthesized instructions of one reference sample answered, and improved, in a single batched prompt
+            reference_sampling (str): "uniform" to draw reference samples from shuffled decks, or "yield" to favour those producing more valid pairs per token
+            coverage_floor (float): with "yield" sampling, fraction of draws still taken uniformly so every reference keeps being drawn
+            tracer (Optional[Tracer]): records spans of requests, stages and checkpoints, can be shared with the collector
+            prompt_layout (str): "cache" to put the static parts of prompts first and per-instruction content last, so requests share prefixes the provider can cache, or "original"
+            max_draws_without_output (int): reference draws in a row without a single synthesized pair after which synthesis stops with an error, e.g. on bad credentials
         """
         self.reference_samples_with_feedback = reference_samples_with_feedback
         self.teacher_model = teacher_model
         self.output_dir = output_dir
-
-        self.client = AzureOpenAI(
-            azure_endpoint=os.getenv("AZURE_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_KEY"),
-            api_version=os.getenv("AZURE_VERSION")
-        )
+        self.output_format = output_format
+        self.shard_size = shard_size
+        self.num_workers = num_workers
+        self.stage_workers = dict(default_stage_workers(num_workers), **(stage_workers or {}))
+        self.seed = seed
+        self.cache = cache
+        self.deduplicator = deduplicator
+        self.instructions_per_prompt = instructions_per_prompt
+        self.reference_sampling = reference_sampling
+        self.coverage_floor = coverage_floor
+        self.prompt_layout = prompt_layout
+        self.max_draws_without_output = max_draws_without_output
+
+        self.backend = backend or AzureBackend()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.token_budget = token_budget or TokenBudget()
+        self.tracer = tracer or Tracer()
 
         self.temperature,self.top_p = 1.0,1.0
 
-        self.chatgpt_encoder = tiktoken.encoding_for_model(teacher_model)
-        self.total_input_tokens_submitted_to_chatgpt,self.total_output_tokens_received_from_chatgpt = 0,0
+        self.usage = UsageTracker(teacher_model)
+        self.parse_stats = ParseStats()
+        # Tokens spent on a draw count towards the yield of the reference it selected
+        self.client = TeacherClient(teacher_model, self.backend, self.retry_policy, self.token_budget, self.tracer, self.usage, self.parse_stats, cache, lambda sample_index, usage: self.record_yield(sample_index, tokens=usage["prompt_tokens"] + usage["completion_tokens"]))
+        self.pipeline,self.writer = None,None
+        self.sampler,self.reference_yield = None,None
 
-        self.seen = set()
-    
-    def update_costs(self, input, output):
+    def azure_openai_completion(self, prompt, model_name, temperature, max_tokens, top_p, stop=None, sample_index=None, stage=None):
         """
-        Update token counters for cost tracking.
-
-        Args:
-            input (str): input prompt sent to the model
-            output (str): response received from the model
+        Make an API call to the teacher model backend for chat completion, see TeacherClient.complete.
         """
-        num_input_tokens = len(self.chatgpt_encoder.encode(input))
-        self.total_input_tokens_submitted_to_chatgpt += num_input_tokens
-        num_output_tokens = len(self.chatgpt_encoder.encode(output))
-        self.total_output_tokens_received_from_chatgpt += num_output_tokens
+        return self.client.complete(prompt, model_name, temperature, max_tokens, top_p, stop, sample_index, stage)
 
-    @retry
-    def azure_openai_completion(self, prompt, model_name, temperature, max_tokens, top_p, stop=None):
+    def ask_gpt(self, prompt, stage, sample_index=None, schema=None, num_items=1):
         """
-        Make an API call to Azure OpenAI for chat completion.
+        Submits a request to the teacher model, see TeacherClient.ask.
 
         Args:
-            prompt (str): prompt for the model
-            model_name (str): name of the model to use
-            temperature (float): sampling temperature
-            max_tokens (int): maximum number of tokens to generate
-            top_p (float): nucleus sampling parameter
-            stop (Optional[str]): stop sequence for text generation
+            prompt (str): input prompt for the model
+            stage (str): pipeline stage sending the request, used for token accounting
+            sample_index (Optional[int]): index of the reference draw the request belongs to, used as part of the cache key
+            schema (Optional[dict]): output schema from prompts.py, only this request is re-sent, a bounded number of times, if the output does not match it
+            num_items (int): items a batched prompt answers at once, scaling its token budget
 
         Returns:
-            dict: Response containing generated text
+            Union[str, dict]: Generated response, or its validated fields if schema is given
         """
-        messages = [{"role": "user", "content": prompt}]
-
-        try:
-            response = self.client.chat.completions.create(
-                model=model_name,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=top_p,
-                stop=stop,
-                logit_bias={"50256": -100},
-            )
-            response = response.choices[0].message.content
-            self.update_costs(prompt, response)
-
-            return {"text": response}
-        except Exception as e:
-            if "The response was filtered due to the prompt triggering Azure OpenAI's content management policy. Please modify your prompt and retry." in str(e):
-                print(f"Error in API cll: {e}")
-                return {"text": ""}
-            else:
-                raise
+        return self.client.ask(prompt, stage, sample_index, schema, num_items)
 
-    def ask_gpt(self, prompt):
+    def record_yield(self, sample_index, **counters):
         """
-        Submits a request to the teacher model
+        Adds counters to the yield of the reference sample a draw selected.
 
         Args:
-            prompt (str): input prompt for the model
-
-        Returns:
-            str: Generated response
+            sample_index (Optional[int]): draw number, None outside synthesize_data
+            **counters: draws, pairs or tokens to add
         """
-        response = self.azure_openai_completion(
-            prompt=prompt,
-            model_name=self.teacher_model,
-            temperature =1.0,
-            max_tokens=4096,
-            top_p=1.0
-        )
-        return response["text"].strip()
+        if self.reference_yield is None or sample_index is None: return
+        self.reference_yield.record(self.sampler.reference_for(sample_index), **counters)
 
-    def synthesize_instructions(self, instruction, instruction_feedback):
+    def synthesize_instructions(self, instruction, instruction_feedback, sample_index=None):
         """
         Generate new instructions based on a reference instruction and its feedback.
 
         Args:
             instruction (str): original reference instruction
             instruction_feedback (str): instruction reference-level feedback
+            sample_index (Optional[int]): index of the reference draw, used as part of the cache key
 
         Returns:
             list: newly synthesized instructions
@@ -126,126 +137,309 @@ class ReferenceLevelFeedbackSynthesizer():
         synthesized_instrs = []
         if instruction_feedback == "": return synthesized_instrs
 
-        instr_generation_prompt = get_instruction_generation_prompt(instruction, instruction_feedback)
+        instr_generation_prompt = get_instruction_generation_prompt(instruction, instruction_feedback, self.prompt_layout)
  
-        generated_instructions = self.ask_gpt(instr_generation_prompt)
-        generated_instructions = repair_json(generated_instructions, return_objects=True)["instructions"]
+        generated_instructions = self.ask_gpt(instr_generation_prompt, INSTRUCTION_GENERATION, sample_index, INSTRUCTION_GENERATION_SCHEMA)["instructions"]
 
         return generated_instructions
 
-    def synthesize_responses(self, reference_instruction, reference_response, instructions, response_feedback):
+    def generate_response(self, reference_instruction, reference_response, instruction, sample_index=None):
         """
-        Generate and improve responses for synthesized instructions.
+        Generate a response for a synthesized instruction, guided by the reference sample.
 
         Args:
             reference_instruction (str): original instruction used as reference
             reference_response (str): original response used as reference
-            instructions (list): list of synthesized instructions
+            instruction (str): synthesized instruction
+            sample_index (Optional[int]): index of the reference draw, used as part of the cache key
+
+        Returns:
+            str: generated response
+        """
+        response_generation_prompt = get_response_generation_prompt(instruction, reference_instruction, reference_response, self.prompt_layout)
+        return self.ask_gpt(response_generation_prompt, RESPONSE_GENERATION, sample_index, RESPONSE_GENERATION_SCHEMA)["response"]
+
+    def improve_response(self, instruction, response, response_feedback, sample_index=None):
+        """
+        Improve a generated response using the reference-level response feedback.
+
+        Args:
+            instruction (str): synthesized instruction
+            response (str): generated response
             response_feedback (str): response reference-level feedback
+            sample_index (Optional[int]): index of the reference draw, used as part of the cache key
 
         Returns:
-            list: synthesized instruction-response pairs along with analysis and explanations
+            Optional[dict]: synthesized instruction-response pair along with analysis and explanations, None if the improvement is empty
         """
-        synthesized_instr_response_pairs = []
-        for instruction in instructions:
-            if instruction == "" or response_feedback == "": continue
+        improved_response_prompt = get_improved_response_prompt(instruction, response, response_feedback, self.prompt_layout)
+        improved_response = self.ask_gpt(improved_response_prompt, IMPROVEMENT, sample_index, IMPROVED_RESPONSE_SCHEMA)
+        if improved_response["improved_response"] == "": return None
+
+        return {
+            "instruction": instruction,
+            "response": response,
 
-            response_generation_prompt = get_response_generation_prompt(instruction, reference_instruction, reference_response)
-            response = self.ask_gpt(response_generation_prompt)
-            response = repair_json(response, return_objects=True)["response"]
-            if response == "": continue
+            "analysis": improved_response["analysis"],
+            "implementation_strategy": improved_response["implementation_strategy"],
+            "improved_response": improved_response["improved_response"],
+        }
+
+    def generate_responses(self, reference_instruction, reference_response, instructions, sample_index=None):
+        """
+        Generate responses for several synthesized instructions of one reference sample with a single
+        batched prompt, so the reference sample is sent once rather than once per instruction.
+        Instructions missing from the batched output fall back to generate_response.
 
+        Args:
+            reference_instruction (str): original instruction used as reference
+            reference_response (str): original response used as reference
+            instructions (list): synthesized instructions
+            sample_index (Optional[int]): index of the reference draw, used as part of the cache key
 
-            improved_response_prompt = get_improved_response_prompt(instruction, response, response_feedback)
-            improved_response = self.ask_gpt(improved_response_prompt)
-            improved_response = repair_json(improved_response, return_objects=True)
-            if improved_response == "": continue
+        Returns:
+            list: generated responses, in the order of instructions
+        """
+        if len(instructions) == 1: return [self.generate_response(reference_instruction, reference_response, instructions[0], sample_index)]
 
-            synthesized_instr_response_pairs.append({
-                "instruction": instruction,
-                "response": response,
+        prompt = get_batched_response_generation_prompt(instructions, reference_instruction, reference_response, self.prompt_layout)
+        try:
+            output = self.ask_gpt(prompt, RESPONSE_GENERATION, sample_index, BATCHED_RESPONSE_GENERATION_SCHEMA, len(instructions))
+            answered = parse_batched_items(output["responses"], len(instructions), RESPONSE_GENERATION_SCHEMA)
+        except (KeyError, IndexError, TypeError, ValueError):
+            answered = {}
+        self.parse_stats.record_batch(RESPONSE_GENERATION, len(instructions), len(answered))
 
-                "analysis": improved_response["analysis"],
-                "implementation_strategy": improved_response["implementation_strategy"],
-                "improved_response": improved_response["improved_response"],
-            })
-        
-        return synthesized_instr_response_pairs
+        return [answered[i]["response"] if i in answered else self.generate_response(reference_instruction, reference_response, instruction, sample_index) for i,instruction in enumerate(instructions)]
 
-    def synthesize_data(self, num_samples_to_generate):
+    def improve_responses(self, instruction_response_pairs, response_feedback, sample_index=None):
         """
-        Uses reference-level feedback to synthesize new instruction-response pairs.
-        Uses parallel processing to generate samples efficiently.
+        Improve several generated responses with the same response feedback in a single batched
+        prompt. Pairs missing from the batched output fall back to improve_response.
 
         Args:
-            num_samples_to_generate (int): target number of samples to synthesize
+            instruction_response_pairs (list): synthesized instructions and their generated responses
+            response_feedback (str): response reference-level feedback
+            sample_index (Optional[int]): index of the reference draw, used as part of the cache key
 
         Returns:
-            list: collection of synthesized instruction-response pairs
+            list: synthesized instruction-response pairs along with analysis and explanations, None where the improvement is empty
         """
-        synthesized_data = []
-        filepath = os.path.join(self.output_dir, "synthesized_data.json")
-        if os.path.exists(filepath):
-            with open(filepath, 'r') as file: synthesized_data = json.load(file)
+        if len(instruction_response_pairs) == 1: return [self.improve_response(*instruction_response_pairs[0], response_feedback, sample_index)]
 
-        print(f"Loaded {len(synthesized_data)} synthesized data")
-        progress_bar = tqdm.tqdm(total=num_samples_to_generate)
-        if synthesized_data: progress_bar.update(len(synthesized_data))
+        prompt = get_batched_improved_response_prompt(instruction_response_pairs, response_feedback, self.prompt_layout)
+        try:
+            output = self.ask_gpt(prompt, IMPROVEMENT, sample_index, BATCHED_IMPROVED_RESPONSE_SCHEMA, len(instruction_response_pairs))
+            answered = parse_batched_items(output["improved_responses"], len(instruction_response_pairs), IMPROVED_RESPONSE_SCHEMA)
+        except (KeyError, IndexError, TypeError, ValueError):
+            answered = {}
+        self.parse_stats.record_batch(IMPROVEMENT, len(instruction_response_pairs), len(answered))
+
+        pairs = []
+        for i,(instruction,response) in enumerate(instruction_response_pairs):
+            if i not in answered:
+                pairs.append(self.improve_response(instruction, response, response_feedback, sample_index))
+            elif answered[i]["improved_response"] == "":
+                pairs.append(None)
+            else:
+                pairs.append({"instruction": instruction, "response": response, **answered[i]})
+        return pairs
 
-        def process_single_request():
-            unseen_samples = [elem for elem in self.reference_samples_with_feedback if elem["instruction"] not in self.seen]
-            response_with_feedback = random.choice(unseen_samples)
-            instruction,reference_response = response_with_feedback["instruction"],response_with_feedback["reference_response"]
-            instruction_feedback_subject,instruction_feedback_skill,response_feedback = response_with_feedback["instruction_feedback_subject"],response_with_feedback["instruction_feedback_skill"],response_with_feedback["response_feedback"]
-            curr_synthesized_data = []
+    def synthesize_responses(self, reference_instruction, reference_response, instructions, response_feedback, sample_index=None):
+        """
+        Generate and improve responses for synthesized instructions, instructions_per_prompt instructions at a time.
 
-            if instruction in self.seen: return curr_synthesized_data
-            self.seen.add(instruction)
+        Args:
+            reference_instruction (str): original instruction used as reference
+            reference_response (str): original response used as reference
+            instructions (list): list of synthesized instructions
+            response_feedback (str): response reference-level feedback
+            sample_index (Optional[int]): index of the reference draw, used as part of the cache key
 
-            for feature in [instruction_feedback_subject, instruction_feedback_skill]:
-                # 1. Synthesize instructions for skill/subject feedback
-                synthesized_instructions = self.synthesize_instructions(instruction, feature)
+        Returns:
+            list: synthesized instruction-response pairs along with analysis and explanations
+        """
+        synthesized_instr_response_pairs = []
+        if response_feedback == "": return synthesized_instr_response_pairs
 
-                # 2. Synthesize responses for skill/subject feedback
-                curr_synthesized_data += self.synthesize_responses(instruction, reference_response, synthesized_instructions, response_feedback)
+        instructions = [instruction for instruction in instructions if instruction != ""]
+        for i in range(0, len(instructions), self.instructions_per_prompt):
+            batch = instructions[i:i+self.instructions_per_prompt]
+            responses = self.generate_responses(reference_instruction, reference_response, batch, sample_index)
+            instruction_response_pairs = [(instruction, response) for instruction,response in zip(batch, responses) if response != ""]
+            if not instruction_response_pairs: continue
 
-            return curr_synthesized_data
+            pairs = self.improve_responses(instruction_response_pairs, response_feedback, sample_index)
+            synthesized_instr_response_pairs.extend(pair for pair in pairs if pair is not None)
         
-        request_idx = 0
-        curr_goal = 5000
-        while len(synthesized_data) < num_samples_to_generate:
-            request_idx += 1
-            num_workers = 40
-            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-                if len(self.seen) == len(self.reference_samples_with_feedback): self.seen = set()
-
-                futures = [executor.submit(process_single_request) for _ in range(num_workers)]
-
-                for future in concurrent.futures.as_completed(futures):
-                    try:
-                        curr_synthesized_data = future.result()
-                        synthesized_data += curr_synthesized_data
-                        
-                        print(f"Generated {len(curr_synthesized_data)} instruction response pairs")
-                        progress_bar.update(len(curr_synthesized_data))
-
-                        if len(synthesized_data) >= curr_goal:
-                            curr_goal += 5000
-                            print(f"\n\n\nSaving generated data to {filepath}")
-                            with open(filepath, 'w') as f:
-                                json.dump(synthesized_data, f, indent=4)
-                            print(f"\n\n\nTotal cost for synthesis:\n    Total input tokens: {self.total_input_tokens_submitted_to_chatgpt}\n    Total output tokens: {self.total_output_tokens_received_from_chatgpt}\n    Total cost: {self.total_input_tokens_submitted_to_chatgpt*0.150/1000000 + self.total_input_tokens_submitted_to_chatgpt*0.600/1000000}")
-
-
-                    except Exception as e:
-                        print(f"Error processing request {request_idx}: {e}")
+        return synthesized_instr_response_pairs
 
-        
-        print(f"\n\n\nSaving generated data to {filepath}")
-        with open(filepath, 'w') as f:
-            json.dump(synthesized_data, f, indent=4)
+    def synthesize_data(self, num_samples_to_generate):
+        """
+        Uses reference-level feedback to synthesize new instruction-response pairs.
+        Uses parallel processing to generate samples efficiently.
 
-        
-        print(f"\n\n\nTotal cost for synthesis:\n    Total input tokens: {self.total_input_tokens_submitted_to_chatgpt}\n    Total output tokens: {self.total_output_tokens_received_from_chatgpt}\n    Total cost: {self.total_input_tokens_submitted_to_chatgpt*0.150/1000000 + self.total_input_tokens_submitted_to_chatgpt*0.600/1000000}")
+        Args:
+            num_samples_to_generate (int): target number of samples to synthesize
+
+        Returns:
+            list: collection of synthesized instruction-response pairs (an iterator over them in "jsonl" mode)
+        """
+        if self.output_format == "jsonl": writer = JsonlDataWriter(self.output_dir, self.shard_size)
+        else: writer = JsonDataWriter(self.output_dir)
+        self.writer,self.num_samples_to_generate = writer,num_samples_to_generate
+
+        print(f"Loaded {writer.num_records} synthesized data")
+        sampler_state = writer.sampler_state or {"seed": self.seed, "num_draws": 0}
+        # Yields of a previous run carry over when it is resumed
+        self.reference_yield = ReferenceYield(len(self.reference_samples_with_feedback))
+        if writer.num_records and os.path.exists(self.yield_path): self.reference_yield.load(self.yield_path)
+        if self.reference_sampling == "yield":
+            sampler = YieldAwareSampler(len(self.reference_samples_with_feedback), self.reference_yield, sampler_state["seed"], sampler_state["num_draws"], self.coverage_floor, sampler_state.get("num_coverage_draws", 0))
+        else:
+            sampler = ReferenceSampler(len(self.reference_samples_with_feedback), sampler_state["seed"], sampler_state["num_draws"])
+        self.sampler = sampler
+        print(f"Sampling reference samples with seed {sampler.seed}")
+        import tqdm
+        progress_bar = tqdm.tqdm(total=num_samples_to_generate)
+        if writer.num_records: progress_bar.update(writer.num_records)
+
+        # Instructions already in the output are indexed so a resumed run keeps deduplicating against them
+        if self.deduplicator is not None and 0 < writer.num_records < num_samples_to_generate:
+            for record in writer.iter_records(): self.deduplicator.add(record["instruction"], count=False)
+
+        # Items of each draw still queued or running; once none are left its yield is complete
+        # and the sampler can forget which reference the draw selected
+        open_items,open_items_lock = collections.Counter(),threading.Lock()
+
+        def settled(fn, final=False):
+            # Outputs of the final stage are finished pairs rather than items of the draw
+            def run(item):
+                outputs = []
+                try:
+                    outputs = fn(item)
+                    return outputs
+                finally:
+                    with open_items_lock:
+                        open_items[item[0]] += (0 if final else len(outputs)) - 1
+                        done = open_items[item[0]] == 0
+                        if done: del open_items[item[0]]
+                    if done: sampler.release(item[0])
+            return run
+
+        # Instruction generation feeds response generation, which feeds improvement, each stage
+        # with its own queue and workers so the instructions of a draw progress in parallel
+        # Items after instruction generation are batches of up to instructions_per_prompt instructions
+        def generate_instructions(item):
+            draw,reference,feature = item
+            with self.tracer.span("stage", stage=INSTRUCTION_GENERATION, sample_index=draw) as span:
+                synthesized_instructions = self.synthesize_instructions(reference["instruction"], feature, draw)
+                if reference["response_feedback"] == "": return []
+                # Near-duplicates are dropped here, before paying for their response and improvement
+                instructions = [instruction for instruction in synthesized_instructions if instruction != "" and (self.deduplicator is None or self.deduplicator.add(instruction))]
+                span["items"],span["outputs"] = len(synthesized_instructions),len(instructions)
+            return [(draw, reference, instructions[i:i+self.instructions_per_prompt]) for i in range(0, len(instructions), self.instructions_per_prompt)]
+
+        def generate_response(item):
+            draw,reference,instructions = item
+            with self.tracer.span("stage", stage=RESPONSE_GENERATION, sample_index=draw) as span:
+                responses = self.generate_responses(reference["instruction"], reference["reference_response"], instructions, draw)
+                instruction_response_pairs = [(instruction, response) for instruction,response in zip(instructions, responses) if response != ""]
+                span["items"],span["outputs"] = len(instructions),len(instruction_response_pairs)
+            return [(draw, reference, instruction_response_pairs)] if instruction_response_pairs else []
+
+        def improve_response(item):
+            draw,reference,instruction_response_pairs = item
+            with self.tracer.span("stage", stage=IMPROVEMENT, sample_index=draw) as span:
+                pairs = [pair for pair in self.improve_responses(instruction_response_pairs, reference["response_feedback"], draw) if pair is not None]
+                span["items"],span["outputs"] = len(instruction_response_pairs),len(pairs)
+            self.record_yield(draw, pairs=len(pairs))
+            return pairs
+
+        pipeline = StagedPipeline([
+            PipelineStage(INSTRUCTION_GENERATION, settled(generate_instructions), self.stage_workers[INSTRUCTION_GENERATION]),
+            PipelineStage(RESPONSE_GENERATION, settled(generate_response), self.stage_workers[RESPONSE_GENERATION]),
+            PipelineStage(IMPROVEMENT, settled(improve_response, final=True), self.stage_workers[IMPROVEMENT]),
+        ], self.retry_policy.circuit_breaker)
+        self.pipeline = pipeline
+
+        # Errors that are not retried, like bad credentials or every output being filtered, would otherwise keep drawing forever
+        draws_without_output = 0
+
+        def next_reference():
+            nonlocal draws_without_output
+            draws_without_output += 1
+            if draws_without_output > self.max_draws_without_output:
+                pipeline.stop()
+                return None
+            draw = sampler.next_draw()
+            reference = self.reference_samples_with_feedback[sampler.reference_for(draw)]
+            self.record_yield(draw, draws=1)
+            with open_items_lock: open_items[draw] = 2
+            # Instructions are synthesized separately for the subject and skill feedback
+            return [(draw, reference, reference["instruction_feedback_subject"]), (draw, reference, reference["instruction_feedback_skill"])]
+
+        def on_output(pair):
+            nonlocal draws_without_output
+            draws_without_output = 0
+            # Only keep as many pairs as are still needed to reach the target
+            if writer.num_records >= num_samples_to_generate: return
+
+            progress_bar.update(1)
+            progress_bar.set_postfix({name: f"{stats['queued']}q/{stats['in_flight']}f" for name,stats in pipeline.stats().items()}, refresh=False)
+
+            writer.sampler_state = sampler.state()
+            with self.tracer.span("checkpoint") as span:
+                span["checkpointed"] = writer.write([pair])
+                if span["checkpointed"]: self.reference_yield.save(self.yield_path)
+            if span["checkpointed"] and self.output_format == "json": self.print_costs()
+            if writer.num_records >= num_samples_to_generate: pipeline.stop()
+
+        def on_error(stage, e):
+            print(f"Error in {stage}: {e}")
+            # A replay run cannot produce anything the cache does not hold, so stop instead of drawing forever
+            if isinstance(e, CacheMiss): pipeline.stop()
+
+        if writer.num_records < num_samples_to_generate: pipeline.run(next_reference, on_output, on_error)
+        # Items dropped when the pipeline stopped never finish
+        for draw in open_items: sampler.release(draw)
+        writer.close()
+        self.reference_yield.save(self.yield_path)
+
+        self.print_costs()
+        print(pipeline.summary())
+        if draws_without_output > self.max_draws_without_output: raise RuntimeError(f"Stopped synthesis after {self.max_draws_without_output} reference draws in a row produced no synthesized data, see the errors above")
+
+        return writer.records if self.output_format == "json" else writer.iter_records()
+
+    def stats(self):
+        """
+        Returns:
+            dict: progress, per-stage queues and throughput, token usage and cost, and retries, for the metrics snapshot
+        """
+        stats = {"usage": self.usage.stats(), "retries": self.retry_policy.stats()}
+        if self.writer is not None: stats["records"],stats["target"] = self.writer.num_records,self.num_samples_to_generate
+        if self.pipeline is not None: stats["pipeline"] = self.pipeline.stats()
+        return stats
+
+    @property
+    def yield_path(self):
+        return os.path.join(self.output_dir, "reference_yield.json")
 
-        return synthesized_data
+    def print_costs(self):
+        """
+        Prints the token usage and cost of the synthesis so far.
+        """
+        print("\n\n\n" + self.usage.summary("Total cost for synthesis"))
+        print(self.retry_policy.summary())
+        print(self.parse_stats.summary())
+        print(self.token_budget.summary())
+        if self.reference_yield is not None: print(self.reference_yield.summary(self.usage.dollars_per_token()))
+        if self.cache is not None: print(self.cache.summary())
+        if self.deduplicator is not None:
+            # Each dropped instruction saves one response generation and one improvement call
+            saved_tokens = 0
+            for stage in [RESPONSE_GENERATION, IMPROVEMENT]:
+                counters = self.usage.stages[stage]
+                if counters["calls"]: saved_tokens += self.deduplicator.num_duplicates * (counters["input_tokens"] + counters["output_tokens"]) / counters["calls"]
+            print(f"{self.deduplicator.summary()}, about {saved_tokens:.0f} tokens")
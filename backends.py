@@ -0,0 +1,357 @@
+import collections
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+
+from rate_limiter import TokenBucket,estimate_prompt_tokens
+from usage import get_usage,usage_to_json
+
+# OpenAI and Azure cache prompt prefixes of at least 1024 tokens, in increments of 128 tokens
+PREFIX_CACHE_MIN_CHARS = 1024 * 4
+PREFIX_CACHE_BLOCK_CHARS = 128 * 4
+
+CONTENT_FILTER_MESSAGE = "The response was filtered due to the prompt triggering Azure OpenAI's content management policy. Please modify your prompt and retry."
+
+
+class OpenAIBackend():
+    def __init__(self, base_url=None, api_key=None, client=None, http_pool=None):
+        """
+        Backend for OpenAI-compatible chat completion endpoints. The client, and the openai
+        package itself, are only loaded when the first request is sent.
+
+        Args:
+            base_url (Optional[str]): base URL of the endpoint, e.g. http://localhost:8000/v1
+            api_key (Optional[str]): API key, defaults to the OPENAI_API_KEY environment variable
+            client (Optional[OpenAI]): pre-built client, overrides base_url and api_key
+            http_pool (Optional[HTTPPool]): connection pool settings of the client, defaults to the openai package's own
+        """
+        self.base_url,self.api_key = base_url,api_key
+        self.http_pool = http_pool
+        self._client = client
+        self.client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self.client_lock:
+                if self._client is None: self._client = self.make_client()
+        return self._client
+
+    def make_client(self):
+        from openai import OpenAI
+        # Retries are handled by RetryPolicy, so the client's own retries are turned off
+        return OpenAI(base_url=self.base_url, api_key=self.api_key or os.getenv("OPENAI_API_KEY", "EMPTY"), max_retries=0, **self.http_options())
+
+    def http_options(self):
+        if self.http_pool is None: return {}
+        return {"http_client": self.http_pool.make_client(), "timeout": self.http_pool.timeout()}
+
+    def complete(self, prompt, model_name, temperature, max_tokens, top_p, stop=None):
+        """
+        Sends a single-turn chat completion request.
+
+        Args:
+            prompt (str): prompt for the model
+            model_name (str): name of the model (or Azure deployment) to use
+            temperature (float): sampling temperature
+            max_tokens (int): maximum number of tokens to generate
+            top_p (float): nucleus sampling parameter
+            stop (Optional[str]): stop sequence for text generation
+
+        Returns:
+            dict: generated text, token usage reported by the API, and finish reason
+        """
+        response = self.client.chat.completions.create(
+            model=model_name,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            stop=stop,
+            logit_bias={"50256": -100},
+        )
+        choice = response.choices[0]
+        return {"text": choice.message.content, "usage": get_usage(response), "finish_reason": choice.finish_reason}
+
+
+class AzureBackend(OpenAIBackend):
+    def __init__(self, azure_endpoint=None, api_key=None, api_version=None, client=None, http_pool=None):
+        """
+        Backend for Azure OpenAI deployments. Unset arguments are read from the AZURE_ENDPOINT,
+        AZURE_OPENAI_KEY and AZURE_VERSION environment variables.
+
+        Args:
+            azure_endpoint (Optional[str]): Azure OpenAI endpoint
+            api_key (Optional[str]): Azure OpenAI key
+            api_version (Optional[str]): Azure OpenAI API version
+            client (Optional[AzureOpenAI]): pre-built client, overrides the other arguments
+            http_pool (Optional[HTTPPool]): connection pool settings of the client, defaults to the openai package's own
+        """
+        super().__init__(api_key=api_key, client=client, http_pool=http_pool)
+        self.azure_endpoint,self.api_version = azure_endpoint,api_version
+
+    def make_client(self):
+        from openai import AzureOpenAI
+        return AzureOpenAI(
+            azure_endpoint=self.azure_endpoint or os.getenv("AZURE_ENDPOINT"),
+            api_key=self.api_key or os.getenv("AZURE_OPENAI_KEY"),
+            api_version=self.api_version or os.getenv("AZURE_VERSION"),
+            max_retries=0,
+            **self.http_options()
+        )
+
+
+class MockAPIError(Exception):
+    def __init__(self, message, status_code, retry_after=None):
+        """
+        Error raised by MockBackend, mirroring the status code and Retry-After of an API error.
+
+        Args:
+            message (str): error message
+            status_code (int): HTTP status code the error stands in for
+            retry_after (Optional[float]): seconds the client is asked to wait before retrying
+        """
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def mock_completion_text(prompt, rng, response_words=200):
+    """
+    Builds a schema-valid JSON output for whichever prompt in prompts.py the prompt came from.
+
+    Args:
+        prompt (str): prompt sent to the model
+        rng (random.Random): random source for the generated content
+        response_words (int): approximate length of generated free-text fields
+
+    Returns:
+        str: JSON output in the format the prompt asks for
+    """
+    def text(num_words):
+        return " ".join(f"word{rng.randrange(1000)}" for _ in range(num_words))
+
+    if '"subject_areas"' in prompt:
+        output = {"subject_areas": text(30), "relevant_skills": text(30)}
+    elif '"response_feedback"' in prompt:
+        output = {"response_feedback": text(80)}
+    elif '"improved_responses"' in prompt:
+        num_items = len(re.findall(r"^## Pair \d+$", prompt, re.MULTILINE))
+        output = {"improved_responses": [dict(json.loads(mock_completion_text('"improved_response"', rng, response_words)), id=i) for i in range(1, num_items + 1)]}
+    elif '"responses"' in prompt:
+        num_items = len(re.findall(r"^## Instruction \d+$", prompt, re.MULTILINE))
+        output = {"responses": [{"id": i, "response": text(response_words)} for i in range(1, num_items + 1)]}
+    elif '"instructions"' in prompt:
+        output = {"instructions": [text(20) for _ in range(10)]}
+    elif '"improved_response"' in prompt:
+        output = {
+            "analysis": {"original_strengths": [text(10)], "improvement_opportunities": [text(10)], "relevant_feedback": [text(10)]},
+            "implementation_strategy": {"planned_changes": [text(10)], "rationale": text(20)},
+            "improved_response": text(response_words),
+        }
+    elif '"response"' in prompt:
+        output = {"response": text(response_words)}
+    else:
+        output = {"text": text(response_words)}
+    return json.dumps(output)
+
+
+class MockBackend():
+    def __init__(self, latency_median=0.5, latency_sigma=0.5, error_rate=0.0, rate_limit_rate=0.0, filter_rate=0.0, response_words=200, seed=None, requests_per_minute=None, tokens_per_minute=None, prefix_caching=True, cache_size=4096):
+        """
+        Local stand-in for the teacher model. Returns schema-valid JSON for each prompt type in
+        prompts.py after a log-normally distributed delay, and fails at configurable rates.
+        Prompt prefixes are cached like OpenAI and Azure do, so the reported cached tokens show
+        how well a prompt layout would hit the provider's cache.
+
+        Args:
+            latency_median (float): median latency of a request in seconds
+            latency_sigma (float): sigma of the log-normal latency distribution, 0 for a fixed latency
+            error_rate (float): fraction of requests failing with a server error
+            rate_limit_rate (float): fraction of requests failing with a 429 and a Retry-After
+            filter_rate (float): fraction of requests rejected by the content filter
+            response_words (int): approximate length of generated free-text fields
+            seed (Optional[int]): seed for latencies, failures and generated content
+            requests_per_minute (Optional[float]): RPM quota enforced with 429s like a real deployment
+            tokens_per_minute (Optional[float]): TPM quota enforced with 429s, charging prompt tokens plus max_tokens on admission
+            prefix_caching (bool): report cached tokens for prompt prefixes seen before
+            cache_size (int): prefix blocks kept in the cache, least recently used first out
+        """
+        self.latency_median,self.latency_sigma = latency_median,latency_sigma
+        self.error_rate,self.rate_limit_rate,self.filter_rate = error_rate,rate_limit_rate,filter_rate
+        self.response_words = response_words
+
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.num_requests,self.num_rate_limited = 0,0
+        # Azure evaluates quotas over short windows, so only ten seconds worth of quota can be burst
+        self.requests_quota = TokenBucket(requests_per_minute, burst_seconds=10) if requests_per_minute else None
+        self.tokens_quota = TokenBucket(tokens_per_minute, burst_seconds=10) if tokens_per_minute else None
+        self.prefix_caching = prefix_caching
+        self.cache_size = cache_size
+        self.prefix_cache = collections.OrderedDict()
+
+    def prefix_hashes(self, prompt):
+        """
+        Args:
+            prompt (str): prompt for the model
+
+        Returns:
+            list: hash of every prefix ending on a cache block boundary, from the shortest
+        """
+        hashes,digest = [],hashlib.sha1()
+        for end in range(PREFIX_CACHE_BLOCK_CHARS, len(prompt) + 1, PREFIX_CACHE_BLOCK_CHARS):
+            digest.update(prompt[end - PREFIX_CACHE_BLOCK_CHARS:end].encode("utf-8"))
+            hashes.append(digest.copy().hexdigest())
+        return hashes
+
+    def cached_tokens(self, hashes):
+        """
+        Returns:
+            int: tokens of the longest cached prefix, 0 if it is shorter than the provider's minimum
+        """
+        if not self.prefix_caching: return 0
+        with self.lock:
+            num_blocks = 0
+            for prefix_hash in hashes:
+                if prefix_hash not in self.prefix_cache: break
+                self.prefix_cache.move_to_end(prefix_hash)
+                num_blocks += 1
+        num_chars = num_blocks * PREFIX_CACHE_BLOCK_CHARS
+        return num_chars // 4 if num_chars >= PREFIX_CACHE_MIN_CHARS else 0
+
+    def cache_prefixes(self, hashes):
+        if not self.prefix_caching: return
+        with self.lock:
+            for prefix_hash in hashes:
+                self.prefix_cache[prefix_hash] = True
+                self.prefix_cache.move_to_end(prefix_hash)
+            while len(self.prefix_cache) > self.cache_size: self.prefix_cache.popitem(last=False)
+
+    def admit(self, prompt, max_tokens):
+        """
+        Charges a request against the quotas, like a deployment admitting it.
+
+        Returns:
+            Optional[float]: seconds to wait before retrying if the request is over quota, None if admitted
+        """
+        with self.lock:
+            now = time.monotonic()
+            charges = [(bucket, amount) for bucket,amount in [(self.requests_quota, 1), (self.tokens_quota, estimate_prompt_tokens(prompt) + max_tokens)] if bucket is not None]
+            for bucket,_ in charges: bucket.refill(now)
+            wait = max([bucket.wait_time(amount) for bucket,amount in charges], default=0)
+            if wait > 0:
+                self.num_rate_limited += 1
+                return wait
+            for bucket,amount in charges: bucket.level -= amount
+            return None
+
+    def sample(self):
+        with self.lock:
+            self.num_requests += 1
+            latency = self.latency_median * self.rng.lognormvariate(0, self.latency_sigma) if self.latency_sigma else self.latency_median
+            return latency,self.rng.random(),random.Random(self.rng.random())
+
+    def complete(self, prompt, model_name, temperature, max_tokens, top_p, stop=None):
+        """
+        Same interface as OpenAIBackend.complete.
+        """
+        retry_after = self.admit(prompt, max_tokens)
+        if retry_after is not None: raise MockAPIError("Rate limit exceeded", 429, retry_after=retry_after)
+
+        latency,outcome,rng = self.sample()
+        # Requests sent together all miss, the prefix is only cached once the first one is processed
+        hashes = self.prefix_hashes(prompt)
+        cached_tokens = self.cached_tokens(hashes)
+        time.sleep(latency)
+        self.cache_prefixes(hashes)
+
+        if outcome < self.rate_limit_rate:
+            raise MockAPIError("Rate limit exceeded", 429, retry_after=1)
+        outcome -= self.rate_limit_rate
+        if outcome < self.error_rate:
+            raise MockAPIError("Internal server error", 500)
+        outcome -= self.error_rate
+        if outcome < self.filter_rate:
+            raise MockAPIError(CONTENT_FILTER_MESSAGE, 400)
+
+        # Roughly four characters per token, truncated like the real API when max_tokens is hit
+        text,finish_reason = mock_completion_text(prompt, rng, self.response_words),"stop"
+        if len(text) > max_tokens * 4: text,finish_reason = text[:max_tokens * 4],"length"
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4, "cached_tokens": cached_tokens}
+        return {"text": text, "usage": usage, "finish_reason": finish_reason}
+
+
+class MockServer():
+    def __init__(self, backend=None, host="127.0.0.1", port=0):
+        """
+        Serves a MockBackend over an OpenAI-compatible /v1/chat/completions endpoint, so the
+        real HTTP client path can be exercised offline with OpenAIBackend(base_url=server.base_url).
+
+        Args:
+            backend (Optional[MockBackend]): backend generating the completions
+            host (str): interface to bind
+            port (int): port to bind, 0 to pick a free one
+        """
+        backend = backend or MockBackend()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status_code, body, headers=None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name,value in (headers or {}).items(): self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                try:
+                    completion = backend.complete(
+                        request["messages"][-1]["content"], request["model"], request.get("temperature"),
+                        request.get("max_tokens") or 4096, request.get("top_p"), request.get("stop")
+                    )
+                except MockAPIError as e:
+                    headers = {"Retry-After": str(e.retry_after)} if e.retry_after is not None else {}
+                    self.send_json(e.status_code, {"error": {"message": str(e), "code": str(e.status_code)}}, headers)
+                    return
+
+                usage = usage_to_json(completion["usage"])
+                self.send_json(200, {
+                    "id": f"chatcmpl-mock-{backend.num_requests}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": completion["text"]}, "finish_reason": completion["finish_reason"]}],
+                    "usage": usage,
+                })
+
+        self.backend = backend
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host,port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
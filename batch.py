@@ -0,0 +1,549 @@
+import concurrent.futures
+import json
+import math
+import os
+import shutil
+import time
+
+from prompts import *
+from backends import CONTENT_FILTER_MESSAGE
+from data_writer import JsonDataWriter,JsonlDataWriter
+from parsing import ParseStats,parse_output
+from retry_policy import RetryPolicy
+from sampler import ReferenceSampler
+from dedup import MinHashDeduplicator
+from usage import BATCH_PRICE_MULTIPLIER,FEEDBACK,INSTRUCTION_GENERATION,RESPONSE_GENERATION,IMPROVEMENT,UsageTracker,usage_from_json,usage_to_json
+
+# Feedback collection is split into two batch stages, since the two prompts are independent
+INSTRUCTION_FEEDBACK = "instruction_feedback"
+RESPONSE_FEEDBACK = "response_feedback"
+BATCH_STAGES = [INSTRUCTION_FEEDBACK, RESPONSE_FEEDBACK, INSTRUCTION_GENERATION, RESPONSE_GENERATION, IMPROVEMENT]
+
+# Output schema of each stage, from prompts.py
+STAGE_SCHEMAS = {
+    INSTRUCTION_FEEDBACK: INSTRUCTION_FEEDBACK_SCHEMA,
+    RESPONSE_FEEDBACK: RESPONSE_FEEDBACK_SCHEMA,
+    INSTRUCTION_GENERATION: INSTRUCTION_GENERATION_SCHEMA,
+    RESPONSE_GENERATION: RESPONSE_GENERATION_SCHEMA,
+    IMPROVEMENT: IMPROVED_RESPONSE_SCHEMA,
+}
+
+# Instructions are only known once instruction generation is done, so references are drawn for
+# this many pairs per draw; each draw asks for two sets of ten instructions, so this leaves slack
+PAIRS_PER_DRAW = 10
+
+# Batch statuses after which results can be downloaded; expired batches keep their finished requests
+DOWNLOADABLE_STATUSES = {"completed", "expired"}
+FAILED_STATUSES = {"failed", "cancelling", "cancelled"}
+
+
+def batch_request(custom_id, prompt, model_name, url="/v1/chat/completions", temperature=1.0, max_tokens=4096, top_p=1.0):
+    """
+    Builds one line of a Batch API input file, with the same parameters as the interactive requests.
+
+    Args:
+        custom_id (str): stable identifier of the request, used to match it with its result
+        prompt (str): prompt for the model
+        model_name (str): name of the model (or Azure deployment) to use
+        url (str): endpoint the request is sent to
+        temperature (float): sampling temperature
+        max_tokens (int): maximum number of tokens to generate
+        top_p (float): nucleus sampling parameter
+
+    Returns:
+        dict: Batch API request
+    """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": url,
+        "body": {
+            "model": model_name,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "top_p": top_p,
+            "logit_bias": {"50256": -100},
+        },
+    }
+
+
+def batch_result_response(result):
+    """
+    Extracts the completion from one line of a Batch API output or error file.
+
+    Args:
+        result (dict): Batch API result
+
+    Returns:
+        Optional[dict]: generated text, token usage and finish reason, or None if the request failed
+    """
+    response = result.get("response") or {}
+    if response.get("status_code") != 200: return None
+
+    body = response["body"]
+    choice = body["choices"][0]
+    return {"text": (choice["message"]["content"] or "").strip(), "usage": usage_from_json(body.get("usage")), "finish_reason": choice.get("finish_reason")}
+
+
+class LocalBatchSubmitter():
+    def __init__(self, backend, batch_dir, num_workers=40, retry_policy=None):
+        """
+        File-based stand-in for the Batch API. Each submitted input file is run through a backend
+        and its results are written in the Batch API output format, so the staged flow can be
+        tested offline (with MockBackend) or driven through the interactive API.
+
+        Args:
+            backend (OpenAIBackend): backend sending the requests
+            batch_dir (str): directory the result files are written to
+            num_workers (int): number of concurrent requests
+            retry_policy (Optional[RetryPolicy]): retry policy for the requests
+        """
+        self.backend = backend
+        self.batch_dir = batch_dir
+        self.num_workers = num_workers
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.endpoint = "/v1/chat/completions"
+        os.makedirs(batch_dir, exist_ok=True)
+
+    def results_path(self, batch_id):
+        return os.path.join(self.batch_dir, f"{batch_id}.output.jsonl")
+
+    def run_request(self, request):
+        body = request["body"]
+        try:
+            response = self.retry_policy.call(self.backend.complete, body["messages"][-1]["content"], body["model"], body["temperature"], body["max_tokens"], body["top_p"], body.get("stop"))
+        except Exception as e:
+            status_code = getattr(e, "status_code", None) or 500
+            code = "content_filter" if CONTENT_FILTER_MESSAGE in str(e) else None
+            return {"custom_id": request["custom_id"], "response": {"status_code": status_code, "body": {"error": {"message": str(e), "code": code}}}, "error": None}
+
+        usage = response["usage"] or {"prompt_tokens": 0, "completion_tokens": 0}
+        return {
+            "custom_id": request["custom_id"],
+            "response": {"status_code": 200, "body": {
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": response["text"]}, "finish_reason": response["finish_reason"]}],
+                "usage": usage_to_json(usage),
+            }},
+            "error": None,
+        }
+
+    def submit(self, requests_path):
+        """
+        Runs every request of an input file and writes the output file.
+
+        Args:
+            requests_path (str): Batch API input file
+
+        Returns:
+            str: batch id
+        """
+        batch_id = "local-" + os.path.basename(requests_path).removesuffix(".jsonl")
+        with open(requests_path, "r") as f: requests = [json.loads(line) for line in f]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            results = list(executor.map(self.run_request, requests))
+
+        tmp_path = self.results_path(batch_id) + ".tmp"
+        with open(tmp_path, "w") as f:
+            for i,result in enumerate(results): f.write(json.dumps(dict(result, id=f"batch_req_{i}")) + "\n")
+        os.replace(tmp_path, self.results_path(batch_id))
+        return batch_id
+
+    def status(self, batch_id):
+        return "completed" if os.path.exists(self.results_path(batch_id)) else "failed"
+
+    def download(self, batch_id, results_path):
+        shutil.copy(self.results_path(batch_id), results_path)
+
+
+class OpenAIBatchSubmitter():
+    def __init__(self, client, endpoint="/v1/chat/completions", completion_window="24h"):
+        """
+        Submits input files to the OpenAI or Azure OpenAI Batch API.
+
+        Args:
+            client (OpenAI): client of the account running the batches, e.g. OpenAIBackend().client
+            endpoint (str): chat completions endpoint, "/chat/completions" on Azure
+            completion_window (str): time frame the batch has to complete in
+        """
+        self.client = client
+        self.endpoint = endpoint
+        self.completion_window = completion_window
+
+    def submit(self, requests_path):
+        """
+        Uploads an input file and creates a batch for it.
+
+        Args:
+            requests_path (str): Batch API input file
+
+        Returns:
+            str: batch id
+        """
+        with open(requests_path, "rb") as f: input_file = self.client.files.create(file=f, purpose="batch")
+        return self.client.batches.create(input_file_id=input_file.id, endpoint=self.endpoint, completion_window=self.completion_window).id
+
+    def status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def download(self, batch_id, results_path):
+        """
+        Downloads the output file of a batch, followed by its error file.
+
+        Args:
+            batch_id (str): batch id
+            results_path (str): where to write the results
+        """
+        batch = self.client.batches.retrieve(batch_id)
+        with open(results_path + ".tmp", "w") as f:
+            for file_id in [batch.output_file_id, batch.error_file_id]:
+                if file_id is None: continue
+                text = self.client.files.content(file_id).text
+                f.write(text if text.endswith("\n") or not text else text + "\n")
+        os.replace(results_path + ".tmp", results_path)
+
+
+class BatchPipeline():
+    def __init__(self, teacher_model, output_dir, size, submitter=None, seed_dataset=None, output_format="json", shard_size=None, seed=None, max_attempts=3, poll_interval=60, dedup_threshold=None, prompt_layout="original", max_top_ups=3):
+        """
+        Runs feedback collection and synthesis as a sequence of Batch API jobs, one per stage.
+        Each stage writes its requests to a Batch-format input file with stable custom_ids, and
+        ingests the matching output file before the next stage's requests are written. State is
+        kept in the batch directory, so each invocation picks up where the previous one stopped.
+        Pairs lost to failed or filtered requests, empty outputs and near-duplicates are only
+        known after the last stage, so while the improved pairs fall short of size, more pairs
+        are sent through the stages again, drawing more references if needed.
+
+        Args:
+            teacher_model (str): name of the teacher model (or Azure deployment)
+            output_dir (str): directory to save the feedback, synthesized data and batch files
+            size (int): target number of samples to synthesize
+            submitter (Optional[OpenAIBatchSubmitter]): submits the input files and downloads the results, None to only write input files and ingest results placed next to them by hand
+            seed_dataset (Optional[Iterable[dict]]): seed samples with instruction and response values, e.g. a SeedSource, only read when feedback has not been collected yet
+            output_format (str): "json" or "jsonl", as for the synthesizer
+            shard_size (Optional[int]): records per JSONL shard, or None for a single JSONL file
+            seed (Optional[int]): seed for reference sampling
+            max_attempts (int): batches submitted per stage, requests that fail or do not parse are re-submitted in the next one
+            poll_interval (float): seconds between status checks when waiting for a batch
+            dedup_threshold (Optional[float]): similarity above which synthesized instructions are dropped as near-duplicates before response generation
+            prompt_layout (str): "cache" or "original", see prompts.build_prompt
+            max_top_ups (int): rounds of extra pairs sent when the improved pairs fall short of size
+        """
+        self.teacher_model = teacher_model
+        self.output_dir = output_dir
+        self.size = size
+        self.submitter = submitter
+        self.seed_dataset = seed_dataset
+        self.output_format = output_format
+        self.shard_size = shard_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.dedup_threshold = dedup_threshold
+        self.prompt_layout = prompt_layout
+        self.max_top_ups = max_top_ups
+
+        self.batch_dir = os.path.join(output_dir, "batch")
+        os.makedirs(self.batch_dir, exist_ok=True)
+        self.state_path = os.path.join(self.batch_dir, "state.json")
+        self.feedback_path = os.path.join(output_dir, "feedback.json")
+
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as f: self.state = json.load(f)
+        else:
+            # Feedback collected by an interactive run is reused
+            first_stage = INSTRUCTION_GENERATION if os.path.exists(self.feedback_path) else INSTRUCTION_FEEDBACK
+            self.state = {"stage": first_stage, "attempt": 0, "batch_id": None, "seed": ReferenceSampler(1, seed).seed, "num_draws": math.ceil(size / PAIRS_PER_DRAW), "num_pairs": size, "top_ups": 0}
+            self.save_state()
+
+        self.usage = UsageTracker(teacher_model, BATCH_PRICE_MULTIPLIER)
+        self.parse_stats = ParseStats()
+        self._references = None
+
+    def save_state(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f: json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+    @property
+    def references(self):
+        if self._references is None:
+            with open(self.feedback_path, "r") as f: self._references = json.load(f)
+        return self._references
+
+    def batch_name(self, stage, attempt):
+        # Top-up rounds send the stages again, so their files are named apart from the first round's
+        top_ups = self.state.get("top_ups", 0)
+        return f"{stage}-topup{top_ups}-{attempt}" if top_ups else f"{stage}-{attempt}"
+
+    def requests_path(self, stage, attempt):
+        return os.path.join(self.batch_dir, f"{self.batch_name(stage, attempt)}.jsonl")
+
+    def results_path(self, stage, attempt):
+        return os.path.join(self.batch_dir, f"{self.batch_name(stage, attempt)}.output.jsonl")
+
+    def outputs_path(self, stage):
+        return os.path.join(self.batch_dir, f"{stage}.outputs.jsonl")
+
+    def load_outputs(self, stage):
+        """
+        Args:
+            stage (str): batch stage
+
+        Returns:
+            dict: custom_id mapped to the parsed output of every ingested request of the stage
+        """
+        outputs = {}
+        if not os.path.exists(self.outputs_path(stage)): return outputs
+        with open(self.outputs_path(stage), "r") as f:
+            for line in f:
+                record = json.loads(line)
+                outputs[record["custom_id"]] = record["output"]
+        return outputs
+
+    def pairs(self, num_pairs=None):
+        """
+        Yields the instructions synthesized for each draw, in draw order, up to the number of
+        pairs sent through the stages.
+
+        Args:
+            num_pairs (Optional[float]): number of instructions to yield, defaults to the pairs in the state
+
+        Returns:
+            Iterator[tuple]: (custom_id suffix, reference sample, synthesized instruction)
+        """
+        instructions = self.load_outputs(INSTRUCTION_GENERATION)
+        sampler = ReferenceSampler(len(self.references), self.state["seed"])
+        # Rebuilt on every pass, so the same instructions are kept each time
+        deduplicator = MinHashDeduplicator(self.dedup_threshold) if self.dedup_threshold else None
+        # State files written before top-ups existed sent size pairs
+        if num_pairs is None: num_pairs = self.state.get("num_pairs", self.size)
+        num_yielded = 0
+        for draw in range(self.state["num_draws"]):
+            reference = self.references[sampler.reference_for(draw)]
+            if reference["response_feedback"] == "": continue
+            for feature in ["subject", "skill"]:
+                output = instructions.get(f"{INSTRUCTION_GENERATION}-{draw}-{feature}")
+                if output is None: continue
+                for j,instruction in enumerate(output["instructions"]):
+                    if instruction == "": continue
+                    if num_yielded == num_pairs: return
+                    if deduplicator is not None and not deduplicator.add(instruction): continue
+                    num_yielded += 1
+                    yield f"{draw}-{feature}-{j}",reference,instruction
+
+    def stage_prompts(self, stage):
+        """
+        Builds every request of a stage from the outputs of the previous stages.
+
+        Args:
+            stage (str): batch stage
+
+        Returns:
+            dict: custom_id mapped to prompt
+        """
+        prompts = {}
+        if stage == INSTRUCTION_FEEDBACK:
+            for i,elem in enumerate(self.seed_dataset): prompts[f"{stage}-{i}"] = get_instruction_feedback_prompt(elem["instruction"], elem["response"], self.prompt_layout)
+        elif stage == RESPONSE_FEEDBACK:
+            for i,elem in enumerate(self.seed_dataset): prompts[f"{stage}-{i}"] = get_response_feedback_prompt(elem["instruction"], elem["response"], self.prompt_layout)
+        elif stage == INSTRUCTION_GENERATION:
+            sampler = ReferenceSampler(len(self.references), self.state["seed"])
+            for draw in range(self.state["num_draws"]):
+                reference = self.references[sampler.reference_for(draw)]
+                for feature,feedback in [("subject", reference["instruction_feedback_subject"]), ("skill", reference["instruction_feedback_skill"])]:
+                    if feedback == "": continue
+                    prompts[f"{stage}-{draw}-{feature}"] = get_instruction_generation_prompt(reference["instruction"], feedback, self.prompt_layout)
+        elif stage == RESPONSE_GENERATION:
+            for suffix,reference,instruction in self.pairs():
+                prompts[f"{stage}-{suffix}"] = get_response_generation_prompt(instruction, reference["instruction"], reference["reference_response"], self.prompt_layout)
+        elif stage == IMPROVEMENT:
+            responses = self.load_outputs(RESPONSE_GENERATION)
+            for suffix,reference,instruction in self.pairs():
+                response = responses.get(f"{RESPONSE_GENERATION}-{suffix}")
+                if response is None or response["response"] == "": continue
+                prompts[f"{stage}-{suffix}"] = get_improved_response_prompt(instruction, response["response"], reference["response_feedback"], self.prompt_layout)
+        return prompts
+
+    def write_requests(self, stage, attempt):
+        """
+        Writes the input file for the requests of a stage that have no output yet.
+
+        Returns:
+            int: number of requests written
+        """
+        outputs = self.load_outputs(stage)
+        prompts = {custom_id: prompt for custom_id,prompt in self.stage_prompts(stage).items() if custom_id not in outputs}
+        if not prompts: return 0
+
+        url = self.submitter.endpoint if self.submitter is not None else "/v1/chat/completions"
+        with open(self.requests_path(stage, attempt), "w") as f:
+            for custom_id,prompt in prompts.items(): f.write(json.dumps(batch_request(custom_id, prompt, self.teacher_model, url)) + "\n")
+        return len(prompts)
+
+    def ingest(self, stage, results_path):
+        """
+        Parses a stage's output file and appends the outputs that parse to the stage outputs.
+
+        Returns:
+            tuple: number of requests ingested and number that failed or did not parse
+        """
+        num_ingested,num_failed = 0,0
+        prompts = self.stage_prompts(stage)
+        with open(results_path, "r") as f, open(self.outputs_path(stage), "a") as outputs_file:
+            for line in f:
+                result = json.loads(line)
+                response = batch_result_response(result)
+                if response is None:
+                    num_failed += 1
+                    continue
+                self.usage.record(FEEDBACK if stage in (INSTRUCTION_FEEDBACK, RESPONSE_FEEDBACK) else stage, prompts.get(result["custom_id"], ""), response["text"], response["usage"])
+                try:
+                    output = parse_output(response["text"], STAGE_SCHEMAS[stage], self.parse_stats, stage)
+                except (KeyError, IndexError, TypeError, ValueError):
+                    num_failed += 1
+                    continue
+                outputs_file.write(json.dumps({"custom_id": result["custom_id"], "output": output}) + "\n")
+                num_ingested += 1
+        return num_ingested,num_failed
+
+    def write_feedback(self):
+        """
+        Combines the feedback stages into feedback.json, in the format returned by collect_feedback.
+        """
+        instruction_feedback,response_feedback = self.load_outputs(INSTRUCTION_FEEDBACK),self.load_outputs(RESPONSE_FEEDBACK)
+        samples_with_feedback = []
+        for i,elem in enumerate(self.seed_dataset):
+            if f"{INSTRUCTION_FEEDBACK}-{i}" not in instruction_feedback or f"{RESPONSE_FEEDBACK}-{i}" not in response_feedback: continue
+            samples_with_feedback.append({
+                "instruction": elem["instruction"],
+                "reference_response": elem["response"],
+
+                "instruction_feedback_subject": instruction_feedback[f"{INSTRUCTION_FEEDBACK}-{i}"]["subject_areas"],
+                "instruction_feedback_skill": instruction_feedback[f"{INSTRUCTION_FEEDBACK}-{i}"]["relevant_skills"],
+                "response_feedback": response_feedback[f"{RESPONSE_FEEDBACK}-{i}"]["response_feedback"]
+            })
+
+        print(f"Reference-level feedback collection completed for {len(samples_with_feedback)} reference samples, saving to: {self.feedback_path}")
+        with open(self.feedback_path, "w") as file: json.dump(samples_with_feedback, file)
+
+    def synthesized_records(self):
+        """
+        Returns:
+            list: the improved pairs, in draw order, in the synthesizer's output format
+        """
+        responses,improvements = self.load_outputs(RESPONSE_GENERATION),self.load_outputs(IMPROVEMENT)
+        records = []
+        for suffix,_,instruction in self.pairs():
+            improved_response = improvements.get(f"{IMPROVEMENT}-{suffix}")
+            # Empty improvements are dropped, as in ReferenceLevelFeedbackSynthesizer.improve_response
+            if improved_response is None or improved_response["improved_response"] == "": continue
+            records.append({
+                "instruction": instruction,
+                "response": responses[f"{RESPONSE_GENERATION}-{suffix}"]["response"],
+
+                "analysis": improved_response["analysis"],
+                "implementation_strategy": improved_response["implementation_strategy"],
+                "improved_response": improved_response["improved_response"],
+            })
+        return records
+
+    def write_synthesized_data(self):
+        """
+        Writes the improved pairs into the synthesizer's output format.
+
+        Returns:
+            int: number of synthesized pairs written
+        """
+        records = self.synthesized_records()
+        writer = JsonlDataWriter(self.output_dir, self.shard_size) if self.output_format == "jsonl" else JsonDataWriter(self.output_dir)
+        writer.sampler_state = {"seed": self.state["seed"], "num_draws": self.state["num_draws"]}
+        # Records are rebuilt from the first draw on every run, so those already written by an earlier run are skipped
+        writer.write(records[writer.num_records:self.size])
+        writer.close()
+        return writer.num_records
+
+    def top_up(self):
+        """
+        Sends more pairs through the stages when the improved pairs fall short of size: the
+        shortfall's worth of further instructions from the draws made so far, and new draws if
+        those run out.
+
+        Returns:
+            bool: whether another round was scheduled
+        """
+        shortfall = self.size - len(self.synthesized_records())
+        if shortfall <= 0 or self.state.get("top_ups", 0) >= self.max_top_ups: return False
+
+        num_pairs = self.state.get("num_pairs", self.size) + shortfall
+        num_available = sum(1 for _ in self.pairs(math.inf))
+        num_draws = self.state["num_draws"] + math.ceil(max(num_pairs - num_available, 0) / PAIRS_PER_DRAW)
+        stage = INSTRUCTION_GENERATION if num_draws > self.state["num_draws"] else RESPONSE_GENERATION
+        print(f"Synthesized data is {shortfall} short of {self.size}, sending {shortfall} more pairs through the stages from {stage} on")
+        self.state.update(stage=stage, attempt=0, batch_id=None, num_pairs=num_pairs, num_draws=num_draws, top_ups=self.state.get("top_ups", 0) + 1)
+        self.save_state()
+        return True
+
+    def advance(self):
+        stage = self.state["stage"]
+        if stage == RESPONSE_FEEDBACK: self.write_feedback()
+        if stage == BATCH_STAGES[-1] and self.top_up(): return
+        next_stage = BATCH_STAGES[BATCH_STAGES.index(stage) + 1] if stage != BATCH_STAGES[-1] else None
+        self.state.update(stage=next_stage, attempt=0, batch_id=None)
+        self.save_state()
+
+    def run(self, wait=False):
+        """
+        Advances the pipeline as far as possible: ingests finished batches, writes and submits
+        the next stage's input file, and returns once a batch is still running (unless wait is
+        set) or synthesis is done.
+
+        Args:
+            wait (bool): poll running batches until they finish instead of returning
+
+        Returns:
+            bool: whether synthesis is done
+        """
+        while self.state["stage"] is not None:
+            stage,attempt = self.state["stage"],self.state["attempt"]
+            requests_path,results_path = self.requests_path(stage, attempt),self.results_path(stage, attempt)
+
+            if not os.path.exists(results_path) and self.state["batch_id"] is not None:
+                status = self.submitter.status(self.state["batch_id"])
+                if status in FAILED_STATUSES: raise RuntimeError(f"Batch {self.state['batch_id']} for {stage} {status}")
+                if status not in DOWNLOADABLE_STATUSES:
+                    if not wait:
+                        print(f"Batch {self.state['batch_id']} for {stage} is {status}, run again later to continue")
+                        return False
+                    time.sleep(self.poll_interval)
+                    continue
+                self.submitter.download(self.state["batch_id"], results_path)
+
+            if os.path.exists(results_path):
+                num_ingested,num_failed = self.ingest(stage, results_path)
+                print(f"Ingested {num_ingested} {stage} outputs from {results_path}, {num_failed} failed")
+                if num_failed and attempt + 1 < self.max_attempts:
+                    self.state.update(attempt=attempt + 1, batch_id=None)
+                    self.save_state()
+                else:
+                    self.advance()
+                continue
+
+            num_requests = self.write_requests(stage, attempt)
+            if num_requests == 0:
+                self.advance()
+                continue
+            print(f"Wrote {num_requests} {stage} requests to {requests_path}")
+            if self.submitter is None:
+                print(f"Submit {requests_path} to the Batch API and save its output file to {results_path}, then run again to continue")
+                return False
+            self.state["batch_id"] = self.submitter.submit(requests_path)
+            self.save_state()
+            print(f"Submitted batch {self.state['batch_id']} for {stage}")
+
+        num_records = self.write_synthesized_data()
+        print(f"Batch synthesis completed with {num_records} synthesized data")
+        if num_records < self.size: print(f"Warning: only {num_records} of the {self.size} synthesized data requested, after {self.state.get('top_ups', 0)} top-up rounds")
+        print(self.usage.summary("Total cost for the batches ingested in this run"))
+        print(self.parse_stats.summary())
+        return True
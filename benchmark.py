@@ -0,0 +1,259 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from backends import MockBackend,MockServer,OpenAIBackend
+from http_pool import HTTPPool
+from data_writer import JsonlDataWriter
+from rate_limiter import RateLimitedBackend,RateLimiter
+from router import Deployment,DeploymentRouter
+from token_budget import TokenBudget
+from prompts import PROMPT_LAYOUTS
+from usage import STAGES
+
+
+def synthetic_seed_dataset(num_samples, num_words=300):
+    """
+    Args:
+        num_samples (int): number of seed samples
+        num_words (int): approximate length of each instruction and response
+
+    Returns:
+        list: seed samples with instruction and response values
+    """
+    return [{
+        "instruction": f"Seed instruction {i}: " + " ".join(f"word{j}" for j in range(num_words // 10)),
+        "response": f"Seed response {i}: " + " ".join(f"word{j}" for j in range(num_words)),
+    } for i in range(num_samples)]
+
+
+def synthetic_reference_samples(num_samples, num_words=300, barren_fraction=0.0):
+    """
+    Args:
+        num_samples (int): number of reference samples
+        num_words (int): approximate length of each reference response
+        barren_fraction (float): fraction of reference samples with empty response feedback, which never produce a pair
+
+    Returns:
+        list: reference samples with feedback, in the format returned by collect_feedback
+    """
+    return [{
+        "instruction": elem["instruction"],
+        "reference_response": elem["response"],
+        "instruction_feedback_subject": "Subject areas " + " ".join(f"word{j}" for j in range(30)),
+        "instruction_feedback_skill": "Relevant skills " + " ".join(f"word{j}" for j in range(30)),
+        "response_feedback": "Response feedback " + " ".join(f"word{j}" for j in range(80)) if i >= num_samples * barren_fraction else "",
+    } for i,elem in enumerate(synthetic_seed_dataset(num_samples, num_words))]
+
+
+def stand_in_deployments(path, http=False, http_pool=None):
+    """
+    Builds one local stand-in per deployment listed in a JSON file, each entry holding the
+    arguments of MockBackend along with an optional "name", "weight", "requests_per_minute" and
+    "tokens_per_minute", so routing can be benchmarked against deployments with different
+    latency and throttling behaviour.
+
+    Args:
+        path (str): JSON file listing the stand-in deployments
+        http (bool): serve each stand-in over HTTP and go through the OpenAI client
+        http_pool (Optional[HTTPPool]): connection pool settings of the clients
+
+    Returns:
+        tuple: Deployment objects, their MockBackends and the servers to stop
+    """
+    with open(path, "r") as f: entries = json.load(f)
+    deployments,mock_backends,servers = [],[],[]
+    for i,entry in enumerate(entries):
+        entry = dict(entry)
+        options = {key: entry.pop(key) for key in ["weight", "requests_per_minute", "tokens_per_minute"] if key in entry}
+        name = entry.pop("name", f"mock-{i}")
+        mock_backends.append(MockBackend(**dict({"seed": i}, **entry)))
+        backend = mock_backends[-1]
+        if http:
+            servers.append(MockServer(backend).start())
+            backend = OpenAIBackend(base_url=servers[-1].base_url, http_pool=http_pool)
+        deployments.append(Deployment(name, backend, **options))
+    return deployments,mock_backends,servers
+
+
+def run_benchmark(args):
+    """
+    Runs a single benchmark configuration in this process against a local stand-in for the
+    teacher model.
+
+    Args:
+        args (argparse.Namespace): benchmark configuration
+
+    Returns:
+        dict: throughput, per-stage latency percentiles and peak RSS
+    """
+    from ReferenceLevelFeedbackCollector import ReferenceLevelFeedbackCollector
+    from ReferenceLevelFeedbackSynthesizer import ReferenceLevelFeedbackSynthesizer
+
+    http_pool = HTTPPool(args.num_workers) if args.http and not args.default_http_pool else None
+    router = None
+    if args.deployments:
+        deployments,mock_backends,servers = stand_in_deployments(args.deployments, args.http, http_pool)
+        backend = router = DeploymentRouter(deployments, seed=0)
+    else:
+        mock_backends,servers = [MockBackend(args.latency_median, args.latency_sigma, args.error_rate, args.rate_limit_rate, response_words=args.response_words, seed=0, requests_per_minute=args.quota_rpm, tokens_per_minute=args.quota_tpm)],[]
+        backend = mock_backends[0]
+        if args.http:
+            servers.append(MockServer(backend).start())
+            backend = OpenAIBackend(base_url=servers[0].base_url, http_pool=http_pool)
+    if args.requests_per_minute or args.tokens_per_minute:
+        backend = RateLimitedBackend(backend, RateLimiter(args.requests_per_minute, args.tokens_per_minute))
+
+    token_budget = TokenBudget(adaptive=not args.fixed_max_tokens)
+
+    class BenchmarkCollector(ReferenceLevelFeedbackCollector):
+        def process_seed_dataset(self, seed_dataset_name):
+            return synthetic_seed_dataset(args.num_references, args.reference_words)
+
+    with tempfile.TemporaryDirectory() as output_dir, open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if args.run == "collect":
+            pipeline = BenchmarkCollector("gpt-4o-mini", "synthetic", output_dir, backend=backend, token_budget=token_budget, prompt_layout=args.prompt_layout)
+            start = time.perf_counter()
+            num_samples = len(pipeline.collect_feedback(args.num_workers))
+        else:
+            pipeline = ReferenceLevelFeedbackSynthesizer(synthetic_reference_samples(args.num_references, args.reference_words, args.barren_fraction), "gpt-4o-mini", output_dir, "jsonl", num_workers=args.num_workers, seed=0, backend=backend, token_budget=token_budget, instructions_per_prompt=args.instructions_per_prompt, reference_sampling=args.reference_sampling, prompt_layout=args.prompt_layout)
+            start = time.perf_counter()
+            num_samples = sum(1 for _ in pipeline.synthesize_data(args.size))
+        elapsed = time.perf_counter() - start
+
+    for server in servers: server.stop()
+
+    totals = pipeline.usage.totals()
+    latencies = {stage: {"p50": pipeline.usage.latency_percentile(stage, 50), "p99": pipeline.usage.latency_percentile(stage, 99)} for stage in STAGES if pipeline.usage.stages[stage]["calls"]}
+    return {
+        "run": args.run,
+        "num_workers": args.num_workers,
+        "num_samples": num_samples,
+        "seconds": elapsed,
+        "samples_per_second": num_samples / elapsed,
+        "requests": sum(mock_backend.num_requests for mock_backend in mock_backends),
+        "rate_limited": sum(mock_backend.num_rate_limited for mock_backend in mock_backends),
+        "latency": latencies,
+        "calls_per_sample": pipeline.usage.totals()["calls"] / max(num_samples, 1),
+        "samples_per_dollar": num_samples / pipeline.usage.cost(totals["input_tokens"], totals["output_tokens"], totals["cached_tokens"]),
+        "cached_input_fraction": totals["cached_tokens"] / max(totals["input_tokens"], 1),
+        "input_tokens_per_sample": pipeline.usage.totals()["input_tokens"] / max(num_samples, 1),
+        "stages": pipeline.pipeline.stats() if args.run == "synthesize" else None,
+        "http_pool": http_pool.stats() if http_pool is not None else None,
+        "deployments": router.stats() if router is not None else None,
+        "max_tokens": {stage: token_budget.budget(stage) for stage in STAGES if pipeline.usage.stages[stage]["calls"]},
+        # ru_maxrss is reported in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_startup_benchmark(args, num_repeats=3):
+    """
+    Times how long a resumed run takes to start: generate.py against an output directory whose
+    feedback and synthesized data are already complete, so all it does is start up, load them
+    and exit. Each measurement is the fastest of a few fresh processes.
+
+    Args:
+        args (argparse.Namespace): benchmark configuration
+        num_repeats (int): processes started per measurement
+
+    Returns:
+        dict: interpreter startup, import and resumed run times in seconds
+    """
+    def fastest(command, env=None):
+        timings = []
+        for _ in range(num_repeats):
+            start = time.perf_counter()
+            subprocess.run(command, check=True, capture_output=True, env=env)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as output_dir:
+        with open(os.path.join(output_dir, "feedback.json"), "w") as f: json.dump(synthetic_reference_samples(args.num_references), f)
+        writer = JsonlDataWriter(output_dir)
+        writer.write([{"instruction": f"Synthesized instruction {i}", "response": "", "analysis": {}, "implementation_strategy": {}, "improved_response": ""} for i in range(args.size)])
+        writer.close()
+
+        # The Azure backend is configured with dummy credentials: nothing should be sent, or even set up
+        env = dict(os.environ, AZURE_OPENAI_KEY="unused", AZURE_ENDPOINT="http://127.0.0.1:9", AZURE_VERSION="2024-06-01", TQDM_DISABLE="1")
+        command = [sys.executable, os.path.join(directory, "generate.py"), "--teacher_model", "gpt-4o-mini", "--seed_dataset_name", "unused", "--size", str(args.size), "--output_dir", output_dir, "--output_format", "jsonl"]
+        return {
+            "run": "startup",
+            "interpreter_seconds": fastest([sys.executable, "-c", "pass"]),
+            "import_seconds": fastest([sys.executable, "-c", "import generate"], dict(os.environ, PYTHONPATH=directory)),
+            "resume_seconds": fastest(command, env),
+        }
+
+
+def print_startup_result(result):
+    print(f"startup: interpreter {result['interpreter_seconds']:.3f}s, import generate {result['import_seconds']:.3f}s, resumed run with cached feedback and data {result['resume_seconds']:.3f}s")
+
+
+def print_header():
+    print(f"{'run':<11}{'workers':>8}{'samples':>9}{'seconds':>9}{'samples/s':>11}{'429s':>7}{'rss MB':>9}  per-stage latency p50/p99 (s)")
+
+
+def print_result(result):
+    latency = ", ".join(f"{stage} {l['p50']:.3f}/{l['p99']:.3f}" for stage,l in result["latency"].items())
+    print(f"{result['run']:<11}{result['num_workers']:>8}{result['num_samples']:>9}{result['seconds']:>9.2f}{result['samples_per_second']:>11.2f}{result['rate_limited']:>7}{result['peak_rss_mb']:>9.1f}  {latency}")
+    print(f"    {result['cached_input_fraction']:.1%} of input tokens served from the prompt cache, {result['samples_per_dollar']:.0f} samples per dollar")
+    if result.get("deployments"): print("    " + ", ".join(f"{name}: {stats['requests']} requests, {stats['failures']} failed" for name,stats in result["deployments"].items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark of collect_feedback and synthesize_data against a local stand-in for the teacher model")
+    parser.add_argument("--runs", type=str, nargs="+", choices=["collect", "synthesize", "startup"], default=["collect", "synthesize", "startup"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--num_references", type=int, default=200)
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--latency_median", type=float, default=0.05)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0)
+    parser.add_argument("--response_words", type=int, default=200)
+    parser.add_argument("--reference_words", type=int, default=300, help="approximate length of the synthetic reference responses, prefixes under 1024 tokens are never cached")
+    parser.add_argument("--quota_rpm", type=float, default=None, help="RPM quota enforced by the stand-in with 429s")
+    parser.add_argument("--quota_tpm", type=float, default=None, help="TPM quota enforced by the stand-in with 429s")
+    parser.add_argument("--requests_per_minute", type=float, default=None, help="client-side RPM limit")
+    parser.add_argument("--tokens_per_minute", type=float, default=None, help="client-side TPM limit")
+    parser.add_argument("--instructions_per_prompt", type=int, default=1, help="synthesized instructions answered and improved per prompt")
+    parser.add_argument("--reference_sampling", type=str, choices=["uniform", "yield"], default="uniform")
+    parser.add_argument("--prompt_layout", type=str, choices=PROMPT_LAYOUTS, default="original", help="order of the prompt sections, \"original\" for the templates before they were reordered for prefix caching")
+    parser.add_argument("--barren_fraction", type=float, default=0.0, help="fraction of synthetic reference samples with empty response feedback")
+    parser.add_argument("--fixed_max_tokens", action="store_true", help="always request each stage's default max_tokens instead of adapting it")
+    parser.add_argument("--http", action="store_true", help="serve the stand-in over HTTP and go through the OpenAI client")
+    parser.add_argument("--default_http_pool", action="store_true", help="with --http, use the OpenAI client's default connection pool instead of one sized to the workers")
+    parser.add_argument("--deployments", type=str, default=None, help="JSON list of MockBackend arguments, with optional name, weight and quotas, to route requests over several stand-ins")
+    parser.add_argument("--output", type=str, default=None, help="write the results as JSON to this path")
+    # Internal: run a single configuration in this process
+    parser.add_argument("--run", type=str, choices=["collect", "synthesize"], default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--num_workers", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        print(json.dumps(run_benchmark(args)))
+        sys.exit(0)
+
+    # Each configuration runs in a fresh process so peak RSS is measured per configuration
+    results = []
+    if any(run != "startup" for run in args.runs): print_header()
+    for run in args.runs:
+        if run == "startup": continue
+        for num_workers in args.workers:
+            command = [sys.executable, __file__, "--run", run, "--num_workers", str(num_workers)] + sys.argv[1:]
+            output = subprocess.run(command, check=True, capture_output=True, text=True, env=dict(os.environ, TQDM_DISABLE="1")).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+            print_result(results[-1])
+    if "startup" in args.runs:
+        results.append(run_startup_benchmark(args))
+        print_startup_result(results[-1])
+
+    if args.output:
+        with open(args.output, "w") as f: json.dump(results, f, indent=4)
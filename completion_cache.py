@@ -0,0 +1,109 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class CacheMiss(Exception):
+    """Raised in replay mode when a request is not in the cache."""
+
+
+class CompletionCache():
+    def __init__(self, path, max_size_mb=None, read_only=False):
+        """
+        Content-addressed SQLite cache of teacher model completions, keyed by a hash of the
+        model, prompt, sampling parameters and an optional sample index.
+
+        Args:
+            path (str): path to the SQLite database file
+            max_size_mb (Optional[float]): evict least recently used entries beyond this size, None for unbounded
+            read_only (bool): replay mode, where a miss raises CacheMiss instead of reaching the network
+        """
+        self.path = path
+        self.max_size_bytes = max_size_mb * 1024 * 1024 if max_size_mb is not None else None
+        self.read_only = read_only
+
+        self.lock = threading.Lock()
+        if read_only:
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False, timeout=60)
+        else:
+            self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+            self.conn.commit()
+        self.size_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+        self.hits,self.misses,self.evictions = 0,0,0
+
+    @staticmethod
+    def key(model_name, prompt, temperature, max_tokens, top_p, stop=None, sample_index=None):
+        """
+        Returns:
+            str: hash identifying the request
+        """
+        request = {"model": model_name, "prompt": prompt, "temperature": temperature, "max_tokens": max_tokens, "top_p": top_p, "stop": stop, "sample_index": sample_index}
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Looks up a cached completion.
+
+        Args:
+            key (str): request hash from CompletionCache.key
+
+        Returns:
+            Optional[dict]: the cached response, or None on a miss outside replay mode
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.read_only: raise CacheMiss(f"Completion {key} is not in the cache at {self.path}")
+                return None
+
+            self.hits += 1
+            if not self.read_only:
+                self.conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (time.time(), key))
+                self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        """
+        Stores a completion, evicting least recently used entries if the cache is over its size limit.
+
+        Args:
+            key (str): request hash from CompletionCache.key
+            response (dict): response to cache
+        """
+        if self.read_only: return
+        value = json.dumps(response)
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO completions (key, response, size, last_access) VALUES (?, ?, ?, ?)", (key, value, len(value), time.time()))
+            self.size_bytes += len(value) - (old[0] if old else 0)
+            if self.max_size_bytes is not None and self.size_bytes > self.max_size_bytes: self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        # Evict down to 90% of the limit so eviction does not run on every insert
+        target = self.max_size_bytes * 0.9
+        for key,size in self.conn.execute("SELECT key, size FROM completions ORDER BY last_access").fetchall():
+            if self.size_bytes <= target: break
+            self.conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+            self.size_bytes -= size
+            self.evictions += 1
+
+    def summary(self):
+        """
+        Returns:
+            str: human readable hit/miss counters
+        """
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return f"Completion cache {self.path}: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), {self.evictions} evictions, {self.size_bytes / 1024 / 1024:.1f} MB"
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
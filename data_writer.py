@@ -0,0 +1,235 @@
+import argparse
+import glob
+import json
+import os
+import textwrap
+
+
+def write_pretty_json(records, filepath):
+    """
+    Streams records into a JSON list, formatted exactly like json.dump(records, f, indent=4).
+
+    Args:
+        records (iterable): records to write
+        filepath (str): path of the JSON file to write
+    """
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, "w") as f:
+        num_written = 0
+        for record in records:
+            f.write("[\n" if num_written == 0 else ",\n")
+            f.write(textwrap.indent(json.dumps(record, indent=4), " " * 4))
+            num_written += 1
+        f.write("\n]" if num_written else "[]")
+    os.replace(tmp_path, filepath)
+
+
+class JsonDataWriter():
+    def __init__(self, output_dir, checkpoint_every=5000):
+        """
+        Keeps synthesized data in memory and periodically rewrites synthesized_data.json. The
+        reference sampler state is kept in a sidecar file next to it, so a resumed run continues
+        the draw order instead of starting it again.
+
+        Args:
+            output_dir (str): directory to save the synthesized data
+            checkpoint_every (int): number of new records between checkpoint rewrites
+        """
+        self.filepath = os.path.join(output_dir, "synthesized_data.json")
+        self.state_path = os.path.join(output_dir, "synthesized_data.state.json")
+        self.checkpoint_every = checkpoint_every
+
+        self.records = []
+        if os.path.exists(self.filepath):
+            with open(self.filepath, "r") as file: self.records = json.load(file)
+        self.sampler_state = None
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as file: self.sampler_state = json.load(file).get("sampler_state")
+        self.next_checkpoint = (len(self.records) // checkpoint_every + 1) * checkpoint_every
+
+    @property
+    def num_records(self):
+        return len(self.records)
+
+    def write(self, records):
+        """
+        Adds records, checkpointing to disk every checkpoint_every records.
+
+        Args:
+            records (list): synthesized instruction-response pairs
+
+        Returns:
+            bool: whether a checkpoint was written
+        """
+        self.records += records
+        if self.num_records < self.next_checkpoint: return False
+
+        self.next_checkpoint = (self.num_records // self.checkpoint_every + 1) * self.checkpoint_every
+        self.flush()
+        return True
+
+    def flush(self):
+        print(f"\n\n\nSaving generated data to {self.filepath}")
+        # The state is written first: if the data write is interrupted, the resumed run skips a few draws rather than repeating them
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump({"num_records": self.num_records, "sampler_state": self.sampler_state}, f)
+        os.replace(self.state_path + ".tmp", self.state_path)
+        with open(self.filepath + ".tmp", "w") as f:
+            json.dump(self.records, f, indent=4)
+        os.replace(self.filepath + ".tmp", self.filepath)
+
+    def close(self):
+        self.flush()
+
+    def iter_records(self):
+        return iter(self.records)
+
+
+class JsonlDataWriter():
+    def __init__(self, output_dir, shard_size=None, index_every=100):
+        """
+        Appends synthesized data to JSONL shards, one flushed line per record. Resuming only
+        reads a small sidecar index with the record counts, plus whatever was appended to the last
+        shard after the index was written. The reference sampler state changes with every record,
+        so it is kept in its own sidecar, rewritten before each write that changes it: records
+        recovered from the tail then never have their draws issued again.
+
+        Args:
+            output_dir (str): directory to save the synthesized data
+            shard_size (Optional[int]): records per shard, or None to write a single file
+            index_every (int): number of new records between sidecar index updates
+        """
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.index_every = index_every
+        self.index_path = os.path.join(output_dir, "synthesized_data.index.json")
+        self.state_path = os.path.join(output_dir, "synthesized_data.state.json")
+
+        self.shards, self.sampler_state = [], None
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as file: index = json.load(file)
+            self.shards, self.sampler_state = index["shards"], index.get("sampler_state")
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as file: self.sampler_state = json.load(file)["sampler_state"]
+        self.saved_sampler_state = self.sampler_state
+        self.recover_tail()
+
+        self.file = None
+        self.records_since_index = 0
+
+    @property
+    def num_records(self):
+        return sum(shard["num_records"] for shard in self.shards)
+
+    def shard_path(self, shard_idx):
+        if self.shard_size is None: return os.path.join(self.output_dir, "synthesized_data.jsonl")
+        return os.path.join(self.output_dir, f"synthesized_data-{shard_idx:05d}.jsonl")
+
+    def recover_tail(self):
+        """
+        Counts records appended after the last index update and drops a partially written
+        trailing line left by a crash.
+        """
+        # Shards rotated in after the index was written are not in it yet, so count them in full
+        indexed_paths = {shard["path"] for shard in self.shards}
+        new_shards = [{"path": os.path.basename(path), "num_records": 0, "num_bytes": 0} for path in self.existing_shard_paths() if os.path.basename(path) not in indexed_paths]
+        stale_shards = self.shards[-1:] + new_shards
+        self.shards += new_shards
+
+        for shard in stale_shards:
+            path = os.path.join(self.output_dir, shard["path"])
+            if not os.path.exists(path): continue
+            with open(path, "rb+") as f:
+                f.seek(shard["num_bytes"])
+                tail = f.read()
+                complete = tail[:tail.rfind(b"\n") + 1]
+                shard["num_records"] += complete.count(b"\n")
+                shard["num_bytes"] += len(complete)
+                f.truncate(shard["num_bytes"])
+
+    def existing_shard_paths(self):
+        if self.shard_size is None:
+            path = self.shard_path(0)
+            return [path] if os.path.exists(path) else []
+        return sorted(glob.glob(os.path.join(self.output_dir, "synthesized_data-*.jsonl")))
+
+    def open_shard(self):
+        if not self.shards or (self.shard_size is not None and self.shards[-1]["num_records"] >= self.shard_size):
+            if self.file is not None: self.file.close()
+            self.file = None
+            self.shards.append({"path": os.path.basename(self.shard_path(len(self.shards))), "num_records": 0, "num_bytes": 0})
+        if self.file is None:
+            self.file = open(os.path.join(self.output_dir, self.shards[-1]["path"]), "ab")
+        return self.file
+
+    def write(self, records):
+        """
+        Appends records, one flushed JSONL line each.
+
+        Args:
+            records (list): synthesized instruction-response pairs
+
+        Returns:
+            bool: whether the sidecar index was updated
+        """
+        # Written first, like JsonDataWriter's state: an interrupted write skips a few draws rather than repeating them
+        if self.sampler_state != self.saved_sampler_state:
+            with open(self.state_path + ".tmp", "w") as f: json.dump({"sampler_state": self.sampler_state}, f)
+            os.replace(self.state_path + ".tmp", self.state_path)
+            self.saved_sampler_state = self.sampler_state
+        for record in records:
+            line = (json.dumps(record) + "\n").encode("utf-8")
+            f = self.open_shard()
+            f.write(line)
+            f.flush()
+            self.shards[-1]["num_records"] += 1
+            self.shards[-1]["num_bytes"] += len(line)
+
+        self.records_since_index += len(records)
+        if self.records_since_index < self.index_every: return False
+        self.flush()
+        return True
+
+    def flush(self):
+        """
+        Atomically rewrites the sidecar index.
+        """
+        self.records_since_index = 0
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"num_records": self.num_records, "shards": self.shards, "sampler_state": self.sampler_state}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def close(self):
+        self.flush()
+        if self.file is not None: self.file.close()
+        self.file = None
+
+    def iter_records(self):
+        for shard in self.shards:
+            with open(os.path.join(self.output_dir, shard["path"]), "r") as f:
+                for line in f: yield json.loads(line)
+
+    def export_json(self, filepath=None):
+        """
+        Converts the JSONL output into the pretty-printed synthesized_data.json format.
+
+        Args:
+            filepath (Optional[str]): destination path, defaults to synthesized_data.json in the output directory
+
+        Returns:
+            str: path of the written JSON file
+        """
+        filepath = filepath or os.path.join(self.output_dir, "synthesized_data.json")
+        write_pretty_json(self.iter_records(), filepath)
+        return filepath
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert JSONL synthesized data into pretty-printed JSON")
+    parser.add_argument("--output_dir", type=str)
+    parser.add_argument("--shard_size", type=int, default=None)
+    args = parser.parse_args()
+
+    writer = JsonlDataWriter(args.output_dir, args.shard_size)
+    print(f"Wrote {writer.num_records} records to {writer.export_json()}")
@@ -0,0 +1,132 @@
+import re
+import threading
+import zlib
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def shingles(text, size=5):
+    """
+    Character shingles of a text, after lowercasing and dropping punctuation, so trivial edits
+    to short instructions still share most of their shingles.
+
+    Args:
+        text (str): text to shingle
+        size (int): characters per shingle
+
+    Returns:
+        set: shingles of the text
+    """
+    text = " ".join(re.findall(r"\w+", text.lower()))
+    if len(text) <= size: return {text}
+    return {text[i:i+size] for i in range(len(text) - size + 1)}
+
+
+def lsh_params(threshold, num_perm):
+    """
+    Picks the number of LSH bands and rows per band whose collision curve best separates pairs
+    above the threshold from pairs below it.
+
+    Args:
+        threshold (float): Jaccard similarity at which texts are duplicates
+        num_perm (int): number of MinHash permutations
+
+    Returns:
+        tuple: number of bands and rows per band
+    """
+    def probability(s, bands, rows): return 1 - (1 - s**rows)**bands
+
+    best,best_error = None,None
+    steps = [i / 100 for i in range(101)]
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            false_positives = sum(probability(s, bands, rows) for s in steps if s < threshold)
+            false_negatives = sum(1 - probability(s, bands, rows) for s in steps if s >= threshold)
+            if best_error is None or false_positives + false_negatives < best_error: best,best_error = (bands, rows),false_positives + false_negatives
+    return best
+
+
+class MinHashDeduplicator():
+    def __init__(self, threshold=0.8, num_perm=128, shingle_size=5, seed=1):
+        """
+        Incremental MinHash/LSH index of texts, used to drop synthesized instructions that are
+        near-duplicates of ones already seen before paying for their response and improvement.
+        Candidates from the LSH buckets are confirmed against the estimated Jaccard similarity.
+
+        Args:
+            threshold (float): estimated Jaccard similarity of character shingles above which a text is a duplicate
+            num_perm (int): number of MinHash permutations
+            shingle_size (int): characters per shingle
+            seed (int): seed for the permutations, fixed so signatures are stable across runs
+        """
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+        import numpy as np
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.bands,self.rows = lsh_params(threshold, num_perm)
+
+        self.lock = threading.Lock()
+        self.signatures = []
+        self.buckets = [{} for _ in range(self.bands)]
+        self.num_checked,self.num_duplicates = 0,0
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def signature(self, text):
+        """
+        Args:
+            text (str): text to hash
+
+        Returns:
+            np.ndarray: MinHash signature of the text's shingles
+        """
+        import numpy as np
+        hashes = np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(text, self.shingle_size)], dtype=np.uint64)
+        permuted = ((hashes[:, None] * self.a + self.b) % MERSENNE_PRIME) & MAX_HASH
+        return permuted.min(axis=0)
+
+    def band_keys(self, signature):
+        return [signature[i*self.rows:(i+1)*self.rows].tobytes() for i in range(self.bands)]
+
+    def add(self, text, count=True):
+        """
+        Adds a text to the index unless it is a near-duplicate of a text already in it.
+
+        Args:
+            text (str): text to check
+            count (bool): whether the check counts towards the filter's counters, False when re-indexing existing output
+
+        Returns:
+            bool: True if the text was added, False if it is a near-duplicate
+        """
+        signature = self.signature(text)
+        keys = self.band_keys(signature)
+        with self.lock:
+            self.num_checked += count
+            candidates = set()
+            for bucket,key in zip(self.buckets, keys): candidates.update(bucket.get(key, ()))
+            for candidate in candidates:
+                if (self.signatures[candidate] == signature).mean() >= self.threshold:
+                    self.num_duplicates += count
+                    return False
+
+            idx = len(self.signatures)
+            self.signatures.append(signature)
+            for bucket,key in zip(self.buckets, keys): bucket.setdefault(key, []).append(idx)
+            return True
+
+    def summary(self, calls_per_duplicate=2):
+        """
+        Args:
+            calls_per_duplicate (int): teacher model calls each dropped duplicate would have cost
+
+        Returns:
+            str: human readable counters of the filter
+        """
+        return f"Near-duplicate filter: {self.num_duplicates} of {self.num_checked} synthesized instructions dropped at similarity >= {self.threshold}, saving {self.num_duplicates * calls_per_duplicate} calls ({len(self)} instructions indexed)"
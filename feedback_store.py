@@ -0,0 +1,177 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+OK,FAILED = "ok","failed"
+
+
+class FeedbackStore():
+    def __init__(self, path):
+        """
+        Incremental SQLite store of reference-level feedback, keyed by a hash of the seed sample,
+        the teacher model and the version of the feedback prompts. A seed set that grows only
+        needs feedback for its new samples, samples whose collection failed are retried by the
+        next run instead of being dropped, and references are looked up by row id without
+        loading the whole store into memory.
+
+        Args:
+            path (str): path to the SQLite database file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Row ids follow the order keys were first stored in, and are kept when a failed key is collected again
+        self.conn.execute("CREATE TABLE IF NOT EXISTS feedback (id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, teacher_model TEXT NOT NULL, prompt_version TEXT NOT NULL, status TEXT NOT NULL, sample TEXT, error TEXT, attempts INTEGER NOT NULL, updated REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS feedback_version_status ON feedback (teacher_model, prompt_version, status)")
+        self.conn.commit()
+
+    @staticmethod
+    def key(instruction, response, teacher_model, prompt_version):
+        """
+        Returns:
+            str: hash identifying the feedback of a seed sample
+        """
+        content = {"instruction": instruction, "response": response, "teacher_model": teacher_model, "prompt_version": str(prompt_version)}
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def lookup(self, key):
+        """
+        Args:
+            key (str): hash from FeedbackStore.key
+
+        Returns:
+            Optional[tuple]: row id and status of the key, None if it was never stored
+        """
+        with self.lock: return self.conn.execute("SELECT id, status FROM feedback WHERE key = ?", (key,)).fetchone()
+
+    def get(self, row_id):
+        """
+        Args:
+            row_id (int): row id of a stored reference sample
+
+        Returns:
+            dict: the reference sample with its feedback
+        """
+        with self.lock: row = self.conn.execute("SELECT sample FROM feedback WHERE id = ?", (row_id,)).fetchone()
+        if row is None or row[0] is None: raise KeyError(f"No feedback with id {row_id} in {self.path}")
+        return json.loads(row[0])
+
+    def get_many(self, row_ids):
+        """
+        Args:
+            row_ids (list): row ids of stored reference samples
+
+        Returns:
+            list: the reference samples with their feedback, in the order of row_ids
+        """
+        with self.lock: rows = dict(self.conn.execute(f"SELECT id, sample FROM feedback WHERE id IN ({','.join('?' * len(row_ids))})", row_ids).fetchall())
+        return [json.loads(rows[row_id]) for row_id in row_ids]
+
+    def upsert(self, key, teacher_model, prompt_version, status, sample, error):
+        with self.lock:
+            # A failure never overwrites feedback another process stored in the meantime
+            self.conn.execute(
+                "INSERT INTO feedback (key, teacher_model, prompt_version, status, sample, error, attempts, updated) VALUES (?, ?, ?, ?, ?, ?, 1, ?) "
+                "ON CONFLICT (key) DO UPDATE SET status = excluded.status, sample = excluded.sample, error = excluded.error, attempts = attempts + 1, updated = excluded.updated "
+                "WHERE excluded.status = ? OR feedback.status != ?",
+                (key, teacher_model, str(prompt_version), status, sample, error, time.time(), OK, OK)
+            )
+            row_id = self.conn.execute("SELECT id FROM feedback WHERE key = ?", (key,)).fetchone()[0]
+            self.conn.commit()
+        return row_id
+
+    def put(self, key, teacher_model, prompt_version, sample):
+        """
+        Stores the feedback collected for a seed sample.
+
+        Args:
+            key (str): hash from FeedbackStore.key
+            teacher_model (str): teacher model that gave the feedback
+            prompt_version (str): version of the feedback prompts
+            sample (dict): the seed sample with its feedback, in the format returned by collect_feedback
+
+        Returns:
+            int: row id of the sample
+        """
+        return self.upsert(key, teacher_model, prompt_version, OK, json.dumps(sample), None)
+
+    def put_failure(self, key, teacher_model, prompt_version, error):
+        """
+        Records a seed sample whose feedback could not be collected, so the next run retries it.
+
+        Args:
+            key (str): hash from FeedbackStore.key
+            teacher_model (str): teacher model the feedback was requested from
+            prompt_version (str): version of the feedback prompts
+            error (str): why the collection failed
+        """
+        self.upsert(key, teacher_model, prompt_version, FAILED, None, error[:1000])
+
+    def import_samples(self, samples, teacher_model, prompt_version):
+        """
+        Adds reference samples with feedback collected outside the store, e.g. an existing
+        feedback.json, keeping any feedback already stored for the same key.
+
+        Args:
+            samples (Iterable[dict]): reference samples in the format returned by collect_feedback
+            teacher_model (str): teacher model that gave the feedback
+            prompt_version (str): version of the feedback prompts
+
+        Returns:
+            int: number of samples added
+        """
+        rows = ((self.key(sample["instruction"], sample["reference_response"], teacher_model, prompt_version), teacher_model, str(prompt_version), OK, json.dumps(sample), time.time()) for sample in samples)
+        with self.lock:
+            num_rows = self.conn.total_changes
+            self.conn.executemany("INSERT OR IGNORE INTO feedback (key, teacher_model, prompt_version, status, sample, attempts, updated) VALUES (?, ?, ?, ?, ?, 1, ?)", rows)
+            self.conn.commit()
+            return self.conn.total_changes - num_rows
+
+    def counts(self, teacher_model, prompt_version):
+        """
+        Returns:
+            dict: status mapped to the number of keys with it, for the teacher model and prompt version
+        """
+        with self.lock: return dict(self.conn.execute("SELECT status, COUNT(*) FROM feedback WHERE teacher_model = ? AND prompt_version = ? GROUP BY status", (teacher_model, str(prompt_version))).fetchall())
+
+    def summary(self, teacher_model, prompt_version):
+        """
+        Returns:
+            str: human readable counts of stored and failed feedback
+        """
+        counts = self.counts(teacher_model, prompt_version)
+        return f"Feedback store {self.path}: {counts.get(OK, 0)} reference samples with feedback from {teacher_model} (prompt version {prompt_version}), {counts.get(FAILED, 0)} failed and retried on the next run"
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class StoredReferences():
+    def __init__(self, store, row_ids):
+        """
+        Read-only sequence of reference samples in a FeedbackStore. Only their row ids are held
+        in memory; each sample is read from the store when it is accessed, so it can be passed
+        to ReferenceLevelFeedbackSynthesizer and ShardCoordinator in place of a list.
+
+        Args:
+            store (FeedbackStore): store holding the samples
+            row_ids (list): row ids of the samples, in sequence order
+        """
+        self.store = store
+        self.row_ids = row_ids
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice): return StoredReferences(self.store, self.row_ids[index])
+        return self.store.get(self.row_ids[index])
+
+    def __iter__(self):
+        # Read in chunks, keeping each query well under SQLite's limit on bound parameters
+        for start in range(0, len(self.row_ids), 500):
+            yield from self.store.get_many(self.row_ids[start:start + 500])
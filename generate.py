@@ -1,10 +1,28 @@
 import argparse
 import json
+import os
+import subprocess
+import sys
 
 from ReferenceLevelFeedbackCollector import ReferenceLevelFeedbackCollector
 from ReferenceLevelFeedbackSynthesizer import ReferenceLevelFeedbackSynthesizer
+from data_writer import JsonlDataWriter
+from completion_cache import CompletionCache
+from feedback_store import FeedbackStore
+from backends import AzureBackend,MockBackend,OpenAIBackend
+from http_pool import HTTPPool
+from retry_policy import CircuitBreaker,RetryBudget,RetryPolicy
+from rate_limiter import RateLimitedBackend,RateLimiter
+from router import DeploymentRouter,load_deployments
+from batch import BatchPipeline,LocalBatchSubmitter,OpenAIBatchSubmitter
+from dedup import MinHashDeduplicator
+from seed_source import SeedSource
+from sharding import ShardCoordinator,merge_shards,worker_name
+from token_budget import TokenBudget
+from tracing import MetricsReporter,SamplingProfiler,Tracer
+from prompts import PROMPT_LAYOUTS
 
-def main(teacher_model, seed_dataset_name, size, output_dir):
+def main(teacher_model, seed_dataset_name, size, output_dir, num_workers=40, output_format="json", shard_size=None, export_json=False, seed=None, cache_path=None, cache_max_size_mb=None, cache_replay=False, backend_name="azure", base_url=None, deployments_path=None, max_attempts=6, retry_budget=0.2, circuit_breaker_threshold=0.5, requests_per_minute=None, tokens_per_minute=None, batch=None, batch_wait=False, stage_workers=None, dedup_threshold=None, seed_split="train", instruction_field=None, response_field=None, conversations_field="conversations", seed_streaming=False, max_seed_tokens=None, max_connections=None, http2=False, request_timeout=None, connect_timeout=None, max_tokens=4096, adaptive_max_tokens=True, instructions_per_prompt=1, reference_sampling="uniform", coverage_floor=0.3, num_shards=None, shard_lease_seconds=120, trace_path=None, metrics_path=None, metrics_port=None, metrics_interval=10.0, profile_dir=None, prompt_layout="original", feedback_store_path=None):
     """
     Runs the reference-level feedback guided data synthesis pipeline.
     
@@ -13,25 +31,255 @@ def main(teacher_model, seed_dataset_name, size, output_dir):
         seed_dataset_name (str): name of the seed dataset used for reference samples
         output_dir (str): directory to save the feedback files
         size (int): target number of samples to synthesize
+        num_workers (int): maximum number of concurrent requests to the teacher model
+        output_format (str): "json" for a single pretty-printed file, or "jsonl" for append-only JSONL shards
+        shard_size (Optional[int]): records per JSONL shard, or None for a single JSONL file
+        export_json (bool): convert the JSONL output into pretty-printed JSON once synthesis finishes
+        seed (Optional[int]): seed for reference sampling, so runs can be replayed
+        cache_path (Optional[str]): SQLite file caching teacher model completions, None to disable caching
+        cache_max_size_mb (Optional[float]): size limit of the completion cache
+        cache_replay (bool): only serve completions from the cache, without any network traffic
+        backend_name (str): "azure" for Azure OpenAI, "openai" for an OpenAI-compatible endpoint, or "mock" for an offline stand-in
+        base_url (Optional[str]): base URL of the OpenAI-compatible endpoint
+        deployments_path (Optional[str]): JSON file listing several deployments to spread requests over and fail over between, replacing backend_name
+        max_attempts (int): maximum attempts per request for transient errors
+        retry_budget (float): retries allowed per request sent, shared across all workers
+        circuit_breaker_threshold (float): error rate that pauses all requests
+        requests_per_minute (Optional[float]): requests-per-minute quota of the deployment, enforced client-side
+        tokens_per_minute (Optional[float]): tokens-per-minute quota of the deployment, enforced client-side
+        batch (Optional[str]): run each stage as a batch job instead of interactive requests: "api" submits to the backend's Batch API, "local" runs the batch files through the backend, "files" only writes them
+        batch_wait (bool): in batch mode, wait for running batches instead of exiting
+        stage_workers (Optional[dict]): concurrent requests per synthesis stage, overriding the split of num_workers
+        dedup_threshold (Optional[float]): similarity above which synthesized instructions are dropped as near-duplicates, None or 0 to keep them all
+        seed_split (str): split of the seed dataset to read
+        instruction_field (Optional[str]): field of the seed dataset holding the instruction, with dots for nested fields
+        response_field (Optional[str]): field of the seed dataset holding the response, with dots for nested fields
+        conversations_field (str): field of the seed dataset holding two-turn conversations, used when the instruction and response fields are not given
+        seed_streaming (bool): stream the seed dataset instead of downloading and memory-mapping it
+        max_seed_tokens (Optional[int]): skip seed samples longer than this before collecting feedback on them
+        max_connections (Optional[int]): size of the HTTP connection pool shared by all requests, defaults to num_workers once any pool setting is given
+        http2 (bool): use HTTP/2 for requests to the teacher model
+        request_timeout (Optional[float]): read and write timeout of a request in seconds, defaults to 600 once any pool setting is given
+        connect_timeout (Optional[float]): timeout for opening a connection in seconds, defaults to 10 once any pool setting is given
+        max_tokens (int): highest max_tokens of a request, truncated outputs are retried with larger budgets up to it
+        adaptive_max_tokens (bool): adapt each stage's max_tokens to the lengths of its outputs so far, instead of always requesting the stage's default
+        instructions_per_prompt (int): synthesized instructions of one reference sample answered, and improved, in a single batched prompt
+        reference_sampling (str): "uniform" to draw reference samples from shuffled decks, or "yield" to favour those producing more valid pairs per token
+        coverage_floor (float): with "yield" sampling, fraction of draws still taken uniformly so every reference keeps being drawn
+        num_shards (Optional[int]): partition the reference samples into this many shards, synthesized by every worker started on output_dir, then merged
+        shard_lease_seconds (float): seconds after which the shard of a worker that stopped renewing its lease can be taken over
+        trace_path (Optional[str]): JSONL file recording a span per request, parse, pipeline stage and checkpoint
+        metrics_path (Optional[str]): JSON file rewritten every metrics_interval seconds with throughput, in-flight requests, error rates and cost
+        metrics_port (Optional[int]): local port serving the same metrics on /metrics
+        metrics_interval (float): seconds between metrics snapshots
+        profile_dir (Optional[str]): directory of the sampling profiler's profiles, which SIGUSR1 or /profile?seconds=N switch on mid-run
+        prompt_layout (str): "cache" to put the sections prompts share first, so the provider's prefix cache serves them, or "original" for the templates' original order
+        feedback_store_path (Optional[str]): SQLite file storing feedback by seed sample, teacher model and prompt version across runs, so only new or previously failed seed samples are collected
     """
+    # The collector and synthesizer send every request through this one pool, if any of its settings is given; otherwise the openai package's default client is used
+    http_pool = None
+    if max_connections or http2 or request_timeout or connect_timeout:
+        http_pool = HTTPPool(max_connections or num_workers, http2=http2, timeout=request_timeout or 600.0, connect_timeout=connect_timeout or 10.0)
+    if backend_name == "openai": backend = OpenAIBackend(base_url=base_url, http_pool=http_pool)
+    elif backend_name == "mock": backend,http_pool = MockBackend(),None
+    else: backend = AzureBackend(http_pool=http_pool)
+    router = None
+    if deployments_path is not None:
+        if batch == "api": raise ValueError("Batch API jobs are submitted to a single deployment, run --batch api without --deployments")
+        backend = router = DeploymentRouter(load_deployments(deployments_path, http_pool))
+    # Batch API jobs are submitted through the client directly, outside the rate limiter
+    api_backend = backend
+
+    # The collector and synthesizer share one limiter, and so one quota
+    rate_limiter = None
+    if requests_per_minute or tokens_per_minute:
+        rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        backend = RateLimitedBackend(backend, rate_limiter)
+
+    seed_source = SeedSource(seed_dataset_name, seed_split, instruction_field, response_field, conversations_field, seed_streaming, max_seed_tokens)
+    retry_policy = RetryPolicy(max_attempts, budget=RetryBudget(retry_budget), circuit_breaker=CircuitBreaker(circuit_breaker_threshold))
+
+    if batch is not None:
+        if feedback_store_path: raise ValueError("Batch mode collects feedback into feedback.json, run --batch without --feedback_store")
+        if batch == "api": submitter = OpenAIBatchSubmitter(api_backend.client, "/chat/completions" if backend_name == "azure" else "/v1/chat/completions")
+        elif batch == "local": submitter = LocalBatchSubmitter(backend, os.path.join(output_dir, "batch", "local"), num_workers, retry_policy)
+        else: submitter = None
+        batchPipeline = BatchPipeline(teacher_model, output_dir, size, submitter, seed_source, output_format, shard_size, seed, dedup_threshold=dedup_threshold, prompt_layout=prompt_layout)
+        batchPipeline.run(batch_wait)
+        if http_pool is not None and http_pool.num_requests: print(http_pool.summary())
+        return
+
+    cache = CompletionCache(cache_path, cache_max_size_mb, cache_replay) if cache_path else None
+    token_budget = TokenBudget(max_tokens=max_tokens, adaptive=adaptive_max_tokens)
+
+    if num_shards is not None:
+        # Workers sharing output_dir each write their own trace and metrics files
+        trace_path,metrics_path = [f"{os.path.splitext(path)[0]}.{worker_name()}{os.path.splitext(path)[1]}" if path else path for path in [trace_path, metrics_path]]
+    tracer = Tracer(trace_path)
+    profiler = SamplingProfiler(profile_dir) if profile_dir else None
+    if profiler is not None and profiler.install_signal_handler(): print(f"Send SIGUSR1 to process {os.getpid()} to start or stop profiling")
+    metrics = None
+    if metrics_path or metrics_port is not None:
+        metrics = MetricsReporter(tracer, metrics_path, metrics_port, metrics_interval, profiler)
+        if http_pool is not None: metrics.add_source("http_pool", http_pool.stats)
+        if router is not None: metrics.add_source("deployments", router.stats)
+        metrics.start()
 
     # Reference-level feedback collection
-    referenceLevelFeedbackCollector = ReferenceLevelFeedbackCollector(teacher_model, seed_dataset_name, output_dir)
-    reference_samples_with_feedback = referenceLevelFeedbackCollector.collect_feedback()
+    feedback_store = FeedbackStore(feedback_store_path) if feedback_store_path else None
+    referenceLevelFeedbackCollector = ReferenceLevelFeedbackCollector(teacher_model, seed_dataset_name, output_dir, cache, backend, retry_policy, seed_source, token_budget, tracer, prompt_layout, feedback_store)
+    if metrics is not None: metrics.add_source("feedback_collection", referenceLevelFeedbackCollector.stats)
+    if num_shards is not None:
+        # One worker collects the feedback while the others wait for it
+        coordinator = ShardCoordinator(output_dir, num_shards, size, ttl=shard_lease_seconds, poll_interval=min(10, shard_lease_seconds / 3))
+        coordinator.exclusive("feedback", os.path.join(output_dir, "feedback.json"), lambda: referenceLevelFeedbackCollector.collect_feedback(num_workers))
+    # Only the worker that collected the feedback retries failed seed samples, so every worker partitions the same references
+    reference_samples_with_feedback = referenceLevelFeedbackCollector.collect_feedback(num_workers, collect_missing=num_shards is None)
 
     # Data synthesis with reference-level feedback
-    referenceLevelFeedbackSynthesizer = ReferenceLevelFeedbackSynthesizer(reference_samples_with_feedback, teacher_model, output_dir)
-    referenceLevelFeedbackSynthesizer.synthesize_data(size)
+    def make_synthesizer(reference_samples, synthesis_dir, synthesis_format, synthesis_seed):
+        deduplicator = MinHashDeduplicator(dedup_threshold) if dedup_threshold else None
+        synthesizer = ReferenceLevelFeedbackSynthesizer(reference_samples, teacher_model, synthesis_dir, synthesis_format, shard_size, num_workers, synthesis_seed, cache, backend, retry_policy, stage_workers, deduplicator, token_budget, instructions_per_prompt, reference_sampling, coverage_floor, tracer, prompt_layout)
+        if metrics is not None: metrics.add_source("synthesis", synthesizer.stats)
+        return synthesizer
+
+    if num_shards is not None:
+        # Shards are always JSONL, so they checkpoint every record and can be resumed by any worker
+        done = coordinator.run(reference_samples_with_feedback, lambda reference_samples, shard_dir, shard: make_synthesizer(reference_samples, shard_dir, "jsonl", seed + shard if seed is not None else None))
+        merged_path = os.path.join(output_dir, f"synthesized_data.{output_format}")
+        if done: coordinator.exclusive("merge", merged_path, lambda: merge_shards(output_dir, output_format, size, dedup_threshold))
+    else:
+        make_synthesizer(reference_samples_with_feedback, output_dir, output_format, seed).synthesize_data(size)
+
+    if output_format == "jsonl" and export_json and num_shards is None:
+        filepath = JsonlDataWriter(output_dir, shard_size).export_json()
+        print(f"Exported synthesized data to {filepath}")
+
+    if rate_limiter is not None: print(rate_limiter.summary())
+    if router is not None: print(router.summary())
+    if http_pool is not None and http_pool.num_requests: print(http_pool.summary())
+    if profiler is not None: profiler.stop()
+    if metrics is not None: metrics.stop()
+    tracer.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--teacher_model", type=str)
     parser.add_argument("--seed_dataset_name", type=str)
+    parser.add_argument("--seed_split", type=str, default="train")
+    parser.add_argument("--instruction_field", type=str, default=None)
+    parser.add_argument("--response_field", type=str, default=None)
+    parser.add_argument("--conversations_field", type=str, default="conversations")
+    parser.add_argument("--seed_streaming", action="store_true")
+    parser.add_argument("--max_seed_tokens", type=int, default=None)
     parser.add_argument("--size", type=str)
     parser.add_argument("--output_dir", type=str)
+    parser.add_argument("--num_workers", type=int, default=40)
+    parser.add_argument("--output_format", type=str, choices=["json", "jsonl"], default="json")
+    parser.add_argument("--shard_size", type=int, default=None)
+    parser.add_argument("--export_json", action="store_true")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--cache_path", type=str, default=None)
+    parser.add_argument("--feedback_store", type=str, default=None)
+    parser.add_argument("--cache_max_size_mb", type=float, default=None)
+    parser.add_argument("--cache_replay", action="store_true")
+    parser.add_argument("--backend", type=str, choices=["azure", "openai", "mock"], default="azure")
+    parser.add_argument("--base_url", type=str, default=None)
+    parser.add_argument("--deployments", type=str, default=None)
+    parser.add_argument("--max_connections", type=int, default=None)
+    parser.add_argument("--http2", action="store_true")
+    parser.add_argument("--request_timeout", type=float, default=None)
+    parser.add_argument("--connect_timeout", type=float, default=None)
+    parser.add_argument("--max_attempts", type=int, default=6)
+    parser.add_argument("--retry_budget", type=float, default=0.2)
+    parser.add_argument("--circuit_breaker_threshold", type=float, default=0.5)
+    parser.add_argument("--requests_per_minute", type=float, default=None)
+    parser.add_argument("--tokens_per_minute", type=float, default=None)
+    parser.add_argument("--max_tokens", type=int, default=4096)
+    parser.add_argument("--fixed_max_tokens", action="store_true")
+    parser.add_argument("--instruction_workers", type=int, default=None)
+    parser.add_argument("--response_workers", type=int, default=None)
+    parser.add_argument("--improvement_workers", type=int, default=None)
+    parser.add_argument("--instructions_per_prompt", type=int, default=1)
+    parser.add_argument("--reference_sampling", type=str, choices=["uniform", "yield"], default="uniform")
+    parser.add_argument("--coverage_floor", type=float, default=0.3)
+    parser.add_argument("--dedup_threshold", type=float, default=None)
+    parser.add_argument("--prompt_layout", type=str, choices=PROMPT_LAYOUTS, default="original")
+    parser.add_argument("--num_shards", type=int, default=None)
+    parser.add_argument("--num_processes", type=int, default=1)
+    parser.add_argument("--shard_lease_seconds", type=float, default=120)
+    parser.add_argument("--merge", action="store_true")
+    parser.add_argument("--trace_path", type=str, default=None)
+    parser.add_argument("--metrics_path", type=str, default=None)
+    parser.add_argument("--metrics_port", type=int, default=None)
+    parser.add_argument("--metrics_interval", type=float, default=10.0)
+    parser.add_argument("--profile_dir", type=str, default=None)
+    parser.add_argument("--batch", type=str, choices=["api", "local", "files"], default=None)
+    parser.add_argument("--batch_wait", action="store_true")
 
     args = parser.parse_args()
     print(args)
 
-    main(args.teacher_model, args.seed_dataset_name, int(args.size), args.output_dir)
\ No newline at end of file
+    if args.merge:
+        merge_shards(args.output_dir, args.output_format, int(args.size) if args.size else None, args.dedup_threshold)
+        sys.exit(0)
+
+    if args.num_processes > 1:
+        # Each process is a sharded worker with an equal share of the quotas
+        command = [sys.executable, __file__] + sys.argv[1:] + ["--num_processes", "1", "--num_shards", str(args.num_shards or args.num_processes)]
+        for flag in ["requests_per_minute", "tokens_per_minute"]:
+            if getattr(args, flag): command += [f"--{flag}", str(getattr(args, flag) / args.num_processes)]
+        # Each process serves its metrics on its own port
+        processes = [subprocess.Popen(command + (["--metrics_port", str(args.metrics_port + i)] if args.metrics_port is not None else [])) for i in range(args.num_processes)]
+        sys.exit(max(process.wait() for process in processes))
+
+    stage_workers = {"instruction_generation": args.instruction_workers, "response_generation": args.response_workers, "improvement": args.improvement_workers}
+
+    main(
+        args.teacher_model, args.seed_dataset_name, int(args.size), args.output_dir,
+        num_workers=args.num_workers,
+        output_format=args.output_format,
+        shard_size=args.shard_size,
+        export_json=args.export_json,
+        seed=args.seed,
+        cache_path=args.cache_path,
+        cache_max_size_mb=args.cache_max_size_mb,
+        cache_replay=args.cache_replay,
+        backend_name=args.backend,
+        base_url=args.base_url,
+        deployments_path=args.deployments,
+        max_connections=args.max_connections,
+        http2=args.http2,
+        request_timeout=args.request_timeout,
+        connect_timeout=args.connect_timeout,
+        max_attempts=args.max_attempts,
+        retry_budget=args.retry_budget,
+        circuit_breaker_threshold=args.circuit_breaker_threshold,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        max_tokens=args.max_tokens,
+        adaptive_max_tokens=not args.fixed_max_tokens,
+        batch=args.batch,
+        batch_wait=args.batch_wait,
+        dedup_threshold=args.dedup_threshold,
+        instructions_per_prompt=args.instructions_per_prompt,
+        reference_sampling=args.reference_sampling,
+        coverage_floor=args.coverage_floor,
+        num_shards=args.num_shards,
+        shard_lease_seconds=args.shard_lease_seconds,
+        trace_path=args.trace_path,
+        metrics_path=args.metrics_path,
+        metrics_port=args.metrics_port,
+        metrics_interval=args.metrics_interval,
+        profile_dir=args.profile_dir,
+        prompt_layout=args.prompt_layout,
+        feedback_store_path=args.feedback_store,
+        seed_split=args.seed_split,
+        instruction_field=args.instruction_field,
+        response_field=args.response_field,
+        conversations_field=args.conversations_field,
+        seed_streaming=args.seed_streaming,
+        max_seed_tokens=args.max_seed_tokens,
+        stage_workers={stage: workers for stage,workers in stage_workers.items() if workers is not None},
+    )
\ No newline at end of file
@@ -0,0 +1,144 @@
+import threading
+import time
+
+
+class InstrumentedTransport():
+    def __init__(self, transport, pool):
+        """
+        Wraps an httpx transport to time how long each request waits for a pooled connection and
+        to count the connections and TLS handshakes it opens, using httpcore's trace extension.
+
+        Args:
+            transport (httpx.HTTPTransport): transport to send requests through
+            pool (HTTPPool): pool whose counters are updated
+        """
+        self.transport = transport
+        self.pool = pool
+        # Each client has its own connections, so whether a request has to wait depends on its client's requests only
+        self.in_flight = 0
+
+    def handle_request(self, request):
+        start = time.monotonic()
+        # Only requests sent while every connection is busy have to queue for one
+        acquired = not self.pool.record_start(self)
+
+        def trace(event_name, info):
+            nonlocal acquired
+            # The first event of a request is sent once the pool has handed it a connection
+            if not acquired:
+                acquired = True
+                self.pool.record_wait(time.monotonic() - start)
+            if event_name == "connection.connect_tcp.complete": self.pool.record_event("connections_opened")
+            elif event_name == "connection.start_tls.complete": self.pool.record_event("tls_handshakes")
+
+        request.extensions["trace"] = trace
+        try:
+            return self.transport.handle_request(request)
+        finally:
+            self.pool.record_end(self)
+
+    def close(self):
+        self.transport.close()
+
+    def __enter__(self):
+        self.transport.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.transport.__exit__(*args)
+
+
+class HTTPPool():
+    def __init__(self, max_connections=100, max_keepalive_connections=None, keepalive_expiry=60.0, http2=False, timeout=600.0, connect_timeout=10.0):
+        """
+        Settings and counters of the HTTP connection pool shared by every request a backend sends.
+        One pool sized to the number of workers keeps connections alive between requests instead
+        of opening (and TLS handshaking) new ones under load. Each client made from it, e.g. one
+        per deployment, has connections of its own up to max_connections; the counters cover
+        all of them.
+
+        Args:
+            max_connections (int): maximum number of open connections, usually the number of workers
+            max_keepalive_connections (Optional[int]): idle connections kept alive, defaults to max_connections
+            keepalive_expiry (float): seconds an idle connection is kept alive
+            http2 (bool): negotiate HTTP/2, which multiplexes requests over fewer connections (needs httpx[http2])
+            timeout (float): read and write timeout of a request in seconds
+            connect_timeout (float): timeout for opening a connection in seconds
+        """
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections if max_keepalive_connections is not None else max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.request_timeout,self.connect_timeout = timeout,connect_timeout
+
+        self.lock = threading.Lock()
+        self.num_requests,self.in_flight,self.max_in_flight = 0,0,0
+        self.num_waited,self.seconds_waiting,self.max_wait = 0,0.0,0.0
+        self.events = {"connections_opened": 0, "tls_handshakes": 0}
+
+    def timeout(self):
+        import httpx
+        return httpx.Timeout(self.request_timeout, connect=self.connect_timeout, pool=self.request_timeout)
+
+    def make_client(self):
+        """
+        Returns:
+            httpx.Client: client sending its requests through this pool
+        """
+        import httpx
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_keepalive_connections, keepalive_expiry=self.keepalive_expiry)
+        transport = httpx.HTTPTransport(limits=limits, http2=self.http2)
+        return httpx.Client(transport=InstrumentedTransport(transport, self), timeout=self.timeout())
+
+    def record_start(self, transport):
+        """
+        Args:
+            transport (InstrumentedTransport): transport of the client sending the request
+
+        Returns:
+            bool: whether all connections of the client were busy when the request was sent
+        """
+        with self.lock:
+            self.num_requests += 1
+            self.in_flight += 1
+            transport.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            return transport.in_flight > self.max_connections
+
+    def record_end(self, transport):
+        with self.lock:
+            self.in_flight -= 1
+            transport.in_flight -= 1
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.num_waited += 1
+            self.seconds_waiting += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def record_event(self, name):
+        with self.lock: self.events[name] += 1
+
+    def stats(self):
+        """
+        Returns:
+            dict: counters of the pool
+        """
+        with self.lock:
+            return {
+                "max_connections": self.max_connections,
+                "requests": self.num_requests,
+                "max_in_flight": self.max_in_flight,
+                "requests_waited": self.num_waited,
+                "seconds_waiting": self.seconds_waiting,
+                "max_wait": self.max_wait,
+                **self.events,
+            }
+
+    def summary(self):
+        """
+        Returns:
+            str: human readable counters of the pool
+        """
+        stats = self.stats()
+        return f"HTTP pool: {stats['requests']} requests over {stats['connections_opened']} connections opened ({stats['tls_handshakes']} TLS handshakes, max {stats['max_connections']}), {stats['requests_waited']} requests waited {stats['seconds_waiting']:.1f}s in total (max {stats['max_wait']:.2f}s) for a connection, peak {stats['max_in_flight']} in flight"
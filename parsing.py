@@ -0,0 +1,144 @@
+import json
+import re
+import threading
+
+# Markdown code fence models often wrap their JSON output in
+CODE_FENCE = re.compile(r"^```(?:json)?\s*(.*?)\s*```$", re.DOTALL)
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def load_json(text):
+    """
+    Parses a JSON output with json.loads, only falling back to json_repair when it is malformed.
+
+    Args:
+        text (str): model output
+
+    Returns:
+        tuple: the parsed output and whether it had to be repaired
+    """
+    text = text.strip()
+    match = CODE_FENCE.match(text)
+    if match: text = match.group(1)
+    try:
+        return json.loads(text),False
+    except json.JSONDecodeError:
+        from json_repair import repair_json
+        return repair_json(text, return_objects=True),True
+
+
+def validate(value, schema, path="output"):
+    """
+    Checks a parsed output against a schema from prompts.py: a dict schema maps required keys to
+    their schemas, a one-element list schema is a list of that schema, and a type is a leaf.
+
+    Args:
+        value (Any): parsed output
+        schema (Union[dict, list, type]): expected structure
+        path (str): location of value in the output, for error messages
+
+    Raises:
+        SchemaError: if the output does not match the schema
+    """
+    if isinstance(schema, dict):
+        if not isinstance(value, dict): raise SchemaError(f"{path} should be an object")
+        for key,value_schema in schema.items():
+            if key not in value: raise SchemaError(f"{path} is missing {key}")
+            validate(value[key], value_schema, f"{path}.{key}")
+    elif isinstance(schema, list):
+        if not isinstance(value, list): raise SchemaError(f"{path} should be a list")
+        for i,item in enumerate(value): validate(item, schema[0], f"{path}[{i}]")
+    elif not isinstance(value, schema):
+        raise SchemaError(f"{path} should be a {schema.__name__}")
+
+
+class ParseStats():
+    def __init__(self):
+        """
+        Thread-safe per-stage counts of outputs that parsed as-is, needed repair, or failed.
+        """
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.batches = {}
+
+    def record(self, stage, repaired=False, failed=False):
+        with self.lock:
+            counters = self.stages.setdefault(stage, {"outputs": 0, "repaired": 0, "failed": 0})
+            counters["outputs"] += 1
+            counters["repaired"] += repaired
+            counters["failed"] += failed
+
+    def record_batch(self, stage, num_items, num_answered):
+        with self.lock:
+            counters = self.batches.setdefault(stage, {"prompts": 0, "items": 0, "answered": 0})
+            counters["prompts"] += 1
+            counters["items"] += num_items
+            counters["answered"] += num_answered
+
+    def summary(self):
+        """
+        Returns:
+            str: human readable repair and failure rates per stage
+        """
+        lines = ["Output parsing:"]
+        with self.lock:
+            for stage,counters in self.stages.items():
+                lines.append(f"    {stage}: {counters['outputs']} outputs, {counters['repaired'] / counters['outputs']:.1%} repaired, {counters['failed'] / counters['outputs']:.1%} failed")
+            for stage,counters in self.batches.items():
+                lines.append(f"    {stage} batched: {counters['items']} items in {counters['prompts']} prompts, {1 - counters['answered'] / counters['items']:.1%} fell back to single-item prompts")
+        return "\n".join(lines)
+
+
+def parse_output(text, schema, stats=None, stage=None, span=None):
+    """
+    Parses a JSON output and validates it against the schema of the prompt it answers.
+
+    Args:
+        text (str): model output
+        schema (dict): output schema of the prompt, from prompts.py
+        stats (Optional[ParseStats]): counters to record the outcome in
+        stage (Optional[str]): pipeline stage the output belongs to, for the counters
+
+    Returns:
+        dict: the fields of the schema
+
+    Raises:
+        SchemaError: if the output does not match the schema
+    """
+    output,repaired = load_json(text)
+    try:
+        validate(output, schema)
+    except SchemaError:
+        if stats is not None: stats.record(stage, repaired, failed=True)
+        if span is not None: span["outcome"] = "failed"
+        raise
+    if stats is not None: stats.record(stage, repaired)
+    if span is not None: span["outcome"] = "repaired" if repaired else "ok"
+    return {key: output[key] for key in schema}
+
+
+def parse_batched_items(items, num_items, schema):
+    """
+    Picks the valid items out of the keyed array a batched prompt answers with. Items are
+    validated one by one, so a malformed item only costs its own single-item fallback.
+
+    Args:
+        items (list): objects of the array, each with the 1-based id of the item it answers
+        num_items (int): number of items the prompt asked for
+        schema (dict): output schema of the single-item prompt, from prompts.py
+
+    Returns:
+        dict: 0-based item index mapped to the fields of the schema, for the items answered
+    """
+    answered = {}
+    for item in items:
+        try:
+            index = int(item["id"]) - 1
+            validate(item, schema)
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 <= index < num_items and index not in answered: answered[index] = {key: item[key] for key in schema}
+    return answered
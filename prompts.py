@@ -1,5 +1,38 @@
-def get_instruction_feedback_prompt(instruction, response):
-    return f"""# Task
+# Sections of a prompt, from most to least widely shared between requests: static text shared
+# by every request of a stage, context shared by the requests of one reference sample, the content
+# of the request itself, and a static closing line
+STATIC,SHARED,ITEM,SUFFIX = "static","shared","item","suffix"
+# "cache" puts the sections in that order, "original" keeps the order they are listed in
+PROMPT_LAYOUTS = ["cache", "original"]
+
+
+def build_prompt(sections, layout="original"):
+    """
+    Joins the sections of a prompt. Providers cache the longest prefix a prompt shares with
+    recent requests (from 1024 tokens on) and bill the cached tokens at a discount, so the
+    "cache" layout puts every static section first and per-request content last: requests of a
+    stage share the static prefix, and requests for the same reference sample share the
+    reference context after it. Only a short static closing line follows the request's content.
+
+    Args:
+        sections (list): (kind, text) tuples, in the order of the original layout
+        layout (str): "cache" or "original"
+
+    Returns:
+        str: the prompt
+    """
+    if layout == "original": return "".join(text for _,text in sections)
+    if layout != "cache": raise ValueError(f"Unknown prompt layout {layout}, expected one of {PROMPT_LAYOUTS}")
+    return "".join(text for kind in [STATIC, SHARED, ITEM, SUFFIX] for section_kind,text in sections if section_kind == kind)
+
+# Version of the feedback prompts and schemas, part of the key of stored feedback: bump it when
+# they change so feedback collected with the old ones is collected again. Reordering the
+# sections with a different layout does not change it
+FEEDBACK_PROMPT_VERSION = "1"
+
+def get_instruction_feedback_prompt(instruction, response, layout="original"):
+    return build_prompt([
+        (STATIC, f"""# Task
 Analyze the following instruction to extract key features that make it effective for instruction tuning. This analysis will help create high-quality instruction-response pairs for training language models to better follow instructions.
 
 # Context
@@ -8,13 +41,15 @@ The analysis will be used to create training data for instruction tuning languag
 - Recognize instruction patterns
 - Generate appropriate responses
 
-# Input
+"""),
+        (ITEM, f"""# Input
 {{
   "instruction": {instruction},
   "reference_response": {response},
 }}
 
-# Output Format
+"""),
+        (STATIC, f"""# Output Format
 ```json
 {{
   "subject_areas": str, # This should be a description of the relevant subject areas and domains the instruction covers
@@ -26,22 +61,27 @@ The analysis will be used to create training data for instruction tuning languag
 - Identify all relevant domains and skills
 - Note structural elements that enhance instruction clarity
 
-Output only a JSON object, in the format specified
-"""
+"""),
+        (SUFFIX, """Output only a JSON object, in the format specified
+"""),
+    ], layout)
 
-def get_response_feedback_prompt(instruction, response):
-    return f"""# Task
+def get_response_feedback_prompt(instruction, response, layout="original"):
+    return build_prompt([
+        (STATIC, f"""# Task
 Analyze the instruction-response pair and provide detailed feedback on how well it addresses the instruction. The feedback should:
 - Highlight the specific qualities that make the response effective
 - Provide actionable feedback for improvement
 
-# Input
+"""),
+        (ITEM, f"""# Input
 {{
   "instruction": {instruction},
   "reference_response": {response},
 }}
 
-# Evaluation Criteria
+"""),
+        (STATIC, f"""# Evaluation Criteria
 ## Content Quality
 - Accuracy and factual correctness
 - Quality and depth of coverage
@@ -62,32 +102,41 @@ Analyze the instruction-response pair and provide detailed feedback on how well
   "response_feedback" : str # Feedback describing strengths of the response and how it can be improved
 }}
 
-Output only a JSON object, in the format specified."""
+"""),
+        (SUFFIX, """Output only a JSON object, in the format specified."""),
+    ], layout)
 
-def get_instruction_generation_prompt(instruction, instruction_feedback):
-  return f"""# Task
+def get_instruction_generation_prompt(instruction, instruction_feedback, layout="original"):
+  return build_prompt([
+      (STATIC, f"""# Task
 Generate 10 new instructions based on the provided instruction feature and sample. Each instruction should:
 - Be of similar complexity and length to the sample instruction
 - Be practical and reasonable to answer
 - Be diverse and high-quality
 
-# Sample Instruction:
+"""),
+      (SHARED, f"""# Sample Instruction:
 {instruction}
 
-# Instruction Features:
+"""),
+      (ITEM, f"""# Instruction Features:
 {instruction_feedback}
 
-# Output Format 
+"""),
+      (STATIC, f"""# Output Format 
 ```json
 {{
   "instructions": list # List of 10 distinct instructions. Each instruction should be a single string.
 }}
 ```
 
-Output only a JSON object, in the format specified."""      
+"""),
+      (SUFFIX, """Output only a JSON object, in the format specified."""),
+  ], layout)
 
-def get_response_generation_prompt(instruction, reference_instruction, reference_response):
-  return f"""# Task
+def get_response_generation_prompt(instruction, reference_instruction, reference_response, layout="original"):
+  return build_prompt([
+      (STATIC, f"""# Task
 I will provide an instruction. Generate a high-quality, helpful response to the instruction. The response should demonstrate expertise, clear reasoning, and natural language use.
 
 # Response Requirements
@@ -99,30 +148,33 @@ I will provide an instruction. Generate a high-quality, helpful response to the
 - Maintain appropriate length and detail level
 - Use proper formatting (lists, paragraphs) as needed
 
-Here is an example of a response to an instruction:
+"""),
+      (SHARED, f"""Here is an example of a response to an instruction:
 # Sample Input Instruction:
 {reference_instruction}
 # Sample Response:
 {reference_response}
 
-# Output Format
+"""),
+      (STATIC, f"""# Output Format
 {{
   "response": "The complete response text here"
 }}
 
-# Input
+"""),
+      (ITEM, f"""# Input
 {{
   "instruction": {instruction},
 }}
 
-Generate a properly formatted JSON response, as specified by the Output Format, that addresses this instruction.
-"""
+"""),
+      (SUFFIX, """Generate a properly formatted JSON response, as specified by the Output Format, that addresses this instruction.
+"""),
+  ], layout)
 
-def get_improved_response_prompt(instruction, response, response_feedback):
-   return f"""# Task
-Given an instruction-response pair and feedback, generate an improved version of the response by applying the feedback. The feedback was given for a similar but different instruction-response pair. Not all aspects of the feedback may be directly applicable, so make sure to only apply relevant aspects of the feedback.
-
-# Input
+def get_improved_response_prompt(instruction, response, response_feedback, layout="original"):
+   if layout == "original":
+      inputs = [(ITEM, f"""# Input
 {{
   "instruction": {instruction},
   "original_response": {response},
@@ -130,7 +182,28 @@ Given an instruction-response pair and feedback, generate an improved version of
 }}
 
 
-# Quality Assessment Process
+""")]
+   else:
+      # The feedback is shared by every response improved for a reference sample, so it goes ahead of the pair
+      inputs = [(SHARED, f"""# Feedback
+{{
+  "feedback": {response_feedback}
+}}
+
+"""), (ITEM, f"""# Input
+{{
+  "instruction": {instruction},
+  "original_response": {response}
+}}
+
+""")]
+   return build_prompt([
+      (STATIC, f"""# Task
+Given an instruction-response pair and feedback, generate an improved version of the response by applying the feedback. The feedback was given for a similar but different instruction-response pair. Not all aspects of the feedback may be directly applicable, so make sure to only apply relevant aspects of the feedback.
+
+"""),
+      *inputs,
+      (STATIC, f"""# Quality Assessment Process
 1. Analyze Original Response
 - Core strengths and effective elements
 - Structure and organization
@@ -163,5 +236,124 @@ Given an instruction-response pair and feedback, generate an improved version of
     "improved_response": "The revised and improved response"
 }}
 
-Output only a JSON object, in the format specified."""
-            
\ No newline at end of file
+"""),
+      (SUFFIX, """Output only a JSON object, in the format specified."""),
+   ], layout)
+            
+
+def get_batched_response_generation_prompt(instructions, reference_instruction, reference_response, layout="original"):
+  numbered_instructions = "\n".join(f"## Instruction {i}\n{instruction}" for i,instruction in enumerate(instructions, 1))
+  return build_prompt([
+      (STATIC, f"""# Task
+I will provide several instructions. Generate a high-quality, helpful response to each instruction. Each response should demonstrate expertise, clear reasoning, and natural language use.
+
+# Response Requirements
+- Directly address all aspects of the instruction
+- Response should demonstrate clear reasoning and expertise
+- Use clear, natural language
+- Include examples or evidence when relevant
+- Show step-by-step reasoning where appropriate
+- Maintain appropriate length and detail level
+- Use proper formatting (lists, paragraphs) as needed
+- Answer each instruction independently of the others
+
+"""),
+      (SHARED, f"""Here is an example of a response to an instruction:
+# Sample Input Instruction:
+{reference_instruction}
+# Sample Response:
+{reference_response}
+
+"""),
+      (STATIC, f"""# Output Format
+{{
+  "responses": [
+    {{"id": 1, "response": "The complete response text to instruction 1 here"}},
+    ... one object for each instruction, with the number of the instruction as its id
+  ]
+}}
+
+"""),
+      (ITEM, f"""# Input
+{numbered_instructions}
+
+Generate a properly formatted JSON response, as specified by the Output Format, that addresses each of these {len(instructions)} instructions.
+"""),
+  ], layout)
+
+def get_batched_improved_response_prompt(instruction_response_pairs, response_feedback, layout="original"):
+   numbered_pairs = "\n".join(f"## Pair {i}\n{{\n  \"instruction\": {instruction},\n  \"original_response\": {response}\n}}" for i,(instruction,response) in enumerate(instruction_response_pairs, 1))
+   return build_prompt([
+      (STATIC, f"""# Task
+Given several instruction-response pairs and feedback, generate an improved version of each response by applying the feedback. The feedback was given for a similar but different instruction-response pair. Not all aspects of the feedback may be directly applicable, so make sure to only apply relevant aspects of the feedback to each response.
+
+"""),
+      (SHARED, f"""# Feedback
+{{
+  "feedback": {response_feedback}
+}}
+
+"""),
+      (ITEM, f"""# Input
+{numbered_pairs}
+
+
+"""),
+      (STATIC, f"""# Quality Assessment Process
+For each pair, independently of the others:
+1. Analyze Original Response
+- Core strengths and effective elements
+- Structure and organization
+- Depth and comprehensiveness
+- Alignment with instruction
+
+2. Evaluate Feedback
+- Identify feedback points that are relevant to improving this response, and ignore points that are not relevant
+- Identify actionable improvement suggestions
+- Assess potential impact of each change
+- Check alignment with original instruction
+- Validate that suggested changes maintain or enhance quality
+
+3. Improvement Strategy
+- Prioritize changes with highest impact
+- Preserve effective elements of the original response
+- Ensure feedback applied enhance the response and do not remove valuable elements
+
+# Output Format 
+{{
+    "improved_responses": [
+        {{
+            "id": 1,
+            "analysis": {{
+                "original_strengths": ["list of key effective elements to preserve"],
+                "improvement_opportunities": ["list of specific areas that will benefit from enhancement"],
+                "relevant_feedback": ["list of feedback points that are relevant and beneficial"]
+            }},
+            "implementation_strategy": {{
+                "planned_changes": ["identify what feedback will be applied"],
+                "rationale": "explain how this feedback will improve the original response"
+            }},
+            "improved_response": "The revised and improved response to pair 1"
+        }},
+        ... one object for each pair, with the number of the pair as its id
+    ]
+}}
+
+"""),
+      (ITEM, f"""Output only a JSON object, in the format specified, covering all {len(instruction_response_pairs)} pairs."""),
+  ], layout)
+
+
+# Output schemas of the prompts above, matching their Output Format sections
+INSTRUCTION_FEEDBACK_SCHEMA = {"subject_areas": str, "relevant_skills": str}
+RESPONSE_FEEDBACK_SCHEMA = {"response_feedback": str}
+INSTRUCTION_GENERATION_SCHEMA = {"instructions": [str]}
+RESPONSE_GENERATION_SCHEMA = {"response": str}
+IMPROVED_RESPONSE_SCHEMA = {
+    "analysis": {"original_strengths": [str], "improvement_opportunities": [str], "relevant_feedback": [str]},
+    "implementation_strategy": {"planned_changes": [str], "rationale": str},
+    "improved_response": str,
+}
+# Batched prompts answer several items at once, each item validated on its own against the single-item schema
+BATCHED_RESPONSE_GENERATION_SCHEMA = {"responses": [dict]}
+BATCHED_IMPROVED_RESPONSE_SCHEMA = {"improved_responses": [dict]}
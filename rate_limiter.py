@@ -0,0 +1,155 @@
+import threading
+import time
+
+
+def estimate_prompt_tokens(prompt):
+    """
+    Cheap estimate of the number of tokens in a prompt, at roughly four characters per token.
+
+    Args:
+        prompt (str): prompt for the model
+
+    Returns:
+        int: estimated number of prompt tokens
+    """
+    return len(prompt) // 4 + 1
+
+
+class TokenBucket():
+    def __init__(self, per_minute, burst_seconds=60):
+        """
+        Bucket refilled continuously at the per-minute quota.
+
+        Args:
+            per_minute (float): quota per minute
+            burst_seconds (float): seconds worth of quota the bucket holds
+        """
+        self.rate = per_minute / 60
+        self.capacity = self.rate * burst_seconds
+        self.level = self.capacity
+        self.last_refill = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.level + (now - self.last_refill) * self.rate, self.capacity)
+        self.last_refill = now
+
+    def wait_time(self, amount):
+        """
+        Returns:
+            float: seconds until the bucket holds amount
+        """
+        return max(min(amount, self.capacity) - self.level, 0) / self.rate
+
+
+class RateLimiter():
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, burst_seconds=10):
+        """
+        Client-side requests-per-minute and tokens-per-minute limiter shared by every thread
+        sending requests to one deployment. Each request is charged its estimated prompt tokens
+        plus max_tokens before it is sent, like the deployment's own quota accounting, and the
+        difference is refunded once the actual usage comes back.
+
+        Args:
+            requests_per_minute (Optional[float]): RPM quota, None for no limit
+            tokens_per_minute (Optional[float]): TPM quota, None for no limit
+            burst_seconds (float): seconds worth of quota that can be sent at once, kept short because deployments evaluate quotas over short windows
+        """
+        self.requests = TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+
+        self.lock = threading.Lock()
+        self.num_requests,self.num_throttled,self.seconds_throttled = 0,0,0.0
+
+    def acquire(self, num_tokens):
+        """
+        Blocks until the request fits in both quotas, then charges it.
+
+        Args:
+            num_tokens (int): tokens to charge the request
+
+        Returns:
+            int: tokens charged, to pass to settle
+        """
+        start,throttled = time.monotonic(),False
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                buckets = [(bucket, amount) for bucket,amount in [(self.requests, 1), (self.tokens, num_tokens)] if bucket is not None]
+                for bucket,_ in buckets: bucket.refill(now)
+
+                wait = max([bucket.wait_time(amount) for bucket,amount in buckets], default=0)
+                if wait == 0:
+                    for bucket,amount in buckets: bucket.level -= amount
+                    self.num_requests += 1
+                    if throttled:
+                        self.num_throttled += 1
+                        self.seconds_throttled += now - start
+                    return num_tokens
+            throttled = True
+            time.sleep(wait)
+
+    def wait_time(self, num_tokens):
+        """
+        Args:
+            num_tokens (int): tokens the request would be charged
+
+        Returns:
+            float: seconds acquire would currently block for, without charging anything
+        """
+        with self.lock:
+            now = time.monotonic()
+            buckets = [(bucket, amount) for bucket,amount in [(self.requests, 1), (self.tokens, num_tokens)] if bucket is not None]
+            for bucket,_ in buckets: bucket.refill(now)
+            return max([bucket.wait_time(amount) for bucket,amount in buckets], default=0)
+
+    def settle(self, charged_tokens, actual_tokens):
+        """
+        Refunds the difference between the tokens charged up front and those actually used.
+
+        Args:
+            charged_tokens (int): tokens charged by acquire
+            actual_tokens (int): tokens the request actually used
+        """
+        if self.tokens is None: return
+        with self.lock:
+            self.tokens.refill(time.monotonic())
+            self.tokens.level = min(self.tokens.level + charged_tokens - actual_tokens, self.tokens.capacity)
+
+    def summary(self):
+        """
+        Returns:
+            str: human readable throttling counters
+        """
+        return f"Rate limiter: {self.num_requests} requests, {self.num_throttled} throttled for a total of {self.seconds_throttled:.1f}s"
+
+
+class RateLimitedBackend():
+    def __init__(self, backend, rate_limiter):
+        """
+        Wraps a backend so every request, including each retry, goes through a rate limiter.
+        Sharing one RateLimitedBackend between the collector and the synthesizer makes them
+        share the deployment's quota.
+
+        Args:
+            backend (OpenAIBackend): backend sending the requests
+            rate_limiter (RateLimiter): limiter for the deployment behind the backend
+        """
+        self.backend = backend
+        self.rate_limiter = rate_limiter
+
+    def complete(self, prompt, model_name, temperature, max_tokens, top_p, stop=None):
+        """
+        Same interface as OpenAIBackend.complete.
+        """
+        charged_tokens = self.rate_limiter.acquire(estimate_prompt_tokens(prompt) + max_tokens)
+        try:
+            response = self.backend.complete(prompt, model_name, temperature, max_tokens, top_p, stop)
+        except Exception:
+            # Rejected requests do not consume token quota
+            self.rate_limiter.settle(charged_tokens, 0)
+            raise
+
+        usage = response["usage"]
+        actual_tokens = usage["prompt_tokens"] + usage["completion_tokens"] if usage else charged_tokens
+        self.rate_limiter.settle(charged_tokens, actual_tokens)
+        return response
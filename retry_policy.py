@@ -0,0 +1,238 @@
+import collections
+import email.utils
+import random
+import sys
+import threading
+import time
+
+from tenacity import Retrying,stop_after_attempt
+
+# Status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+def get_status_code(e):
+    return getattr(e, "status_code", None)
+
+
+def is_retryable(e):
+    """
+    Args:
+        e (Exception): error raised by a backend
+
+    Returns:
+        bool: whether the error is transient and the request should be retried
+    """
+    status_code = get_status_code(e)
+    if status_code is not None: return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    # openai is only imported by the backends that use it, and an error from it means it is loaded
+    openai = sys.modules.get("openai")
+    if openai is not None and isinstance(e, openai.APIConnectionError): return True
+    return isinstance(e, (ConnectionError, TimeoutError))
+
+
+def get_retry_after(e):
+    """
+    Reads how long the server asked us to wait from an error's Retry-After headers.
+
+    Args:
+        e (Exception): error raised by a backend
+
+    Returns:
+        Optional[float]: seconds to wait, or None if the server did not say
+    """
+    if getattr(e, "retry_after", None) is not None: return float(e.retry_after)
+
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers: return None
+    if headers.get("retry-after-ms") is not None:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after") is not None:
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            # Retry-After may also be an HTTP date
+            try:
+                return max(email.utils.parsedate_to_datetime(headers["retry-after"]).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+class RetryBudget():
+    def __init__(self, ratio=0.2, min_retries_per_second=1.0, max_tokens=100):
+        """
+        Global cap on retries shared by all threads. Each request earns ratio retry tokens and
+        each retry spends one, with a small time-based allowance so retries never stop entirely.
+
+        Args:
+            ratio (float): retries allowed per request sent
+            min_retries_per_second (float): retries always allowed per second regardless of traffic
+            max_tokens (float): maximum number of retries that can be saved up
+        """
+        self.ratio = ratio
+        self.min_retries_per_second = min_retries_per_second
+        self.max_tokens = max_tokens
+
+        self.lock = threading.Lock()
+        self.tokens = max_tokens
+        self.last_refill = time.monotonic()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def try_spend(self):
+        """
+        Returns:
+            bool: whether a retry is allowed
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.last_refill) * self.min_retries_per_second, self.max_tokens)
+            self.last_refill = now
+            if self.tokens < 1: return False
+            self.tokens -= 1
+            return True
+
+
+class CircuitBreaker():
+    def __init__(self, error_rate_threshold=0.5, min_requests=20, window_seconds=30, cooldown_seconds=30):
+        """
+        Opens when the transient error rate over a sliding window spikes, pausing every request
+        until the cooldown has passed.
+
+        Args:
+            error_rate_threshold (float): fraction of failed attempts in the window that opens the breaker
+            min_requests (int): minimum number of attempts in the window before the breaker can open
+            window_seconds (float): length of the sliding window
+            cooldown_seconds (float): how long the breaker stays open
+        """
+        self.error_rate_threshold = error_rate_threshold
+        self.min_requests = min_requests
+        self.window_seconds = window_seconds
+        self.cooldown_seconds = cooldown_seconds
+
+        self.lock = threading.Lock()
+        self.outcomes = collections.deque()
+        self.num_failures = 0
+        self.open_until = 0.0
+        self.times_opened = 0
+
+    def record(self, success):
+        """
+        Args:
+            success (bool): whether the attempt succeeded, or failed with a transient error
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.outcomes.append((now, success))
+            self.num_failures += not success
+            while self.outcomes and self.outcomes[0][0] < now - self.window_seconds:
+                self.num_failures -= not self.outcomes.popleft()[1]
+
+            if now >= self.open_until and len(self.outcomes) >= self.min_requests and self.num_failures / len(self.outcomes) >= self.error_rate_threshold:
+                self.open_until = now + self.cooldown_seconds
+                self.times_opened += 1
+                self.outcomes.clear()
+                self.num_failures = 0
+                print(f"Circuit breaker opened: error rate above {self.error_rate_threshold:.0%}, pausing requests for {self.cooldown_seconds}s")
+
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def wait_until_closed(self):
+        """
+        Blocks while the breaker is open.
+        """
+        while True:
+            remaining = self.open_until - time.monotonic()
+            if remaining <= 0: return
+            time.sleep(remaining)
+
+
+class RetryPolicy():
+    def __init__(self, max_attempts=6, base_delay=1.0, max_delay=60.0, max_parse_attempts=3, budget=None, circuit_breaker=None):
+        """
+        Retry policy for teacher model requests: only transient errors are retried, with
+        exponential backoff and full jitter that never waits less than the server's Retry-After,
+        a bounded number of attempts per request, a global retry budget and a circuit breaker.
+
+        Args:
+            max_attempts (int): maximum attempts per request for transport errors
+            base_delay (float): backoff before the first retry, in seconds
+            max_delay (float): maximum backoff, in seconds
+            max_parse_attempts (int): maximum attempts per request when the output fails to parse
+            budget (Optional[RetryBudget]): global retry budget, defaults to RetryBudget()
+            circuit_breaker (Optional[CircuitBreaker]): breaker pausing requests when the error rate spikes, defaults to CircuitBreaker()
+        """
+        self.max_attempts = max_attempts
+        self.base_delay,self.max_delay = base_delay,max_delay
+        self.max_parse_attempts = max_parse_attempts
+        self.budget = budget or RetryBudget()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+
+        self.lock = threading.Lock()
+        self.transport_retries,self.parse_retries,self.budget_exhausted = 0,0,0
+
+    def should_retry(self, retry_state):
+        e = retry_state.outcome.exception()
+        if e is None or not is_retryable(e) or retry_state.attempt_number >= self.max_attempts: return False
+        if not self.budget.try_spend():
+            with self.lock: self.budget_exhausted += 1
+            return False
+        with self.lock: self.transport_retries += 1
+        return True
+
+    def wait(self, retry_state):
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry_state.attempt_number - 1)))
+        retry_after = get_retry_after(retry_state.outcome.exception())
+        if retry_after is None: return backoff
+        # Jitter on top of Retry-After so throttled threads do not all come back at once
+        return retry_after + random.uniform(0, self.base_delay)
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Calls fn, retrying transient errors according to the policy.
+
+        Args:
+            fn (Callable): function sending the request
+
+        Returns:
+            Any: the return value of fn
+        """
+        self.budget.deposit()
+
+        def attempt():
+            self.circuit_breaker.wait_until_closed()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if is_retryable(e): self.circuit_breaker.record(False)
+                raise
+            self.circuit_breaker.record(True)
+            return result
+
+        retrying = Retrying(stop=stop_after_attempt(self.max_attempts), wait=self.wait, retry=self.should_retry, reraise=True)
+        return retrying(attempt)
+
+    def record_parse_retry(self):
+        with self.lock: self.parse_retries += 1
+
+    def stats(self):
+        """
+        Returns:
+            dict: retry counters and the state of the circuit breaker
+        """
+        with self.lock:
+            return {"transport_retries": self.transport_retries, "parse_retries": self.parse_retries, "budget_exhausted": self.budget_exhausted, "circuit_breaker_open": self.circuit_breaker.is_open(), "circuit_breaker_opened": self.circuit_breaker.times_opened}
+
+    def summary(self):
+        """
+        Returns:
+            str: human readable retry counters
+        """
+        return f"Retries: {self.transport_retries} transport, {self.parse_retries} parse, {self.budget_exhausted} denied by the retry budget, circuit breaker opened {self.circuit_breaker.times_opened} times"
@@ -0,0 +1,240 @@
+import json
+import os
+import random
+import threading
+import time
+
+from backends import AzureBackend,MockBackend,OpenAIBackend
+from rate_limiter import RateLimitedBackend,RateLimiter,estimate_prompt_tokens
+from retry_policy import get_retry_after,get_status_code,is_retryable
+
+
+class Deployment():
+    def __init__(self, name, backend, model=None, weight=1.0, requests_per_minute=None, tokens_per_minute=None, latency_alpha=0.1, error_alpha=0.1):
+        """
+        One deployment of the teacher model behind a DeploymentRouter, with its own quota and a
+        running estimate of its health: exponentially weighted latency of successful requests
+        and rate of transient failures (429s, 5xx and connection errors).
+
+        Args:
+            name (str): name of the deployment, e.g. its region
+            backend (OpenAIBackend): backend sending requests to the deployment
+            model (Optional[str]): model or Azure deployment name to request, defaults to the teacher model name
+            weight (float): share of the traffic the deployment gets relative to the others while all are healthy
+            requests_per_minute (Optional[float]): RPM quota of the deployment, enforced client-side
+            tokens_per_minute (Optional[float]): TPM quota of the deployment, enforced client-side
+            latency_alpha (float): weight of the latest request in the latency estimate
+            error_alpha (float): weight of the latest request in the error rate estimate
+        """
+        self.name = name
+        self.model = model
+        self.weight = weight
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute) if requests_per_minute or tokens_per_minute else None
+        self.backend = RateLimitedBackend(backend, self.rate_limiter) if self.rate_limiter is not None else backend
+        self.latency_alpha,self.error_alpha = latency_alpha,error_alpha
+
+        self.lock = threading.Lock()
+        self.latency,self.error_rate = None,0.0
+        self.cooldown_until,self.consecutive_failures = 0.0,0
+        self.in_flight = 0
+        self.num_requests,self.num_failures,self.num_rate_limited,self.num_ejected = 0,0,0,0
+
+    def quota_wait(self, num_tokens):
+        """
+        Returns:
+            float: seconds a request of num_tokens would wait for the client-side quota
+        """
+        return self.rate_limiter.wait_time(num_tokens) if self.rate_limiter is not None else 0.0
+
+    def score(self, best_latency):
+        """
+        Args:
+            best_latency (Optional[float]): lowest latency estimate among the deployments
+
+        Returns:
+            float: weight scaled down by the deployment's error rate and latency relative to the best
+        """
+        with self.lock:
+            relative_latency = best_latency / self.latency if self.latency and best_latency else 1.0
+            # Kept above zero, so a degraded deployment still gets the odd request and its estimates can recover
+            return self.weight * max((1 - self.error_rate) ** 2 * relative_latency, 0.05)
+
+    def record_start(self):
+        with self.lock:
+            self.in_flight += 1
+            self.num_requests += 1
+
+    def record_success(self, latency):
+        with self.lock:
+            self.in_flight -= 1
+            self.latency = latency if self.latency is None else (1 - self.latency_alpha) * self.latency + self.latency_alpha * latency
+            self.error_rate *= 1 - self.error_alpha
+            self.consecutive_failures = 0
+
+    def record_failure(self, e, base_cooldown, max_cooldown, max_consecutive_failures):
+        """
+        Records a transient failure. A 429 takes the deployment out of rotation for its
+        Retry-After; repeated failures eject it for a cooldown that doubles each time.
+        """
+        with self.lock:
+            self.in_flight -= 1
+            self.num_failures += 1
+            self.error_rate = (1 - self.error_alpha) * self.error_rate + self.error_alpha
+            self.consecutive_failures += 1
+            now = time.monotonic()
+            if get_status_code(e) == 429:
+                self.num_rate_limited += 1
+                self.cooldown_until = max(self.cooldown_until, now + (get_retry_after(e) or base_cooldown))
+            if self.consecutive_failures >= max_consecutive_failures:
+                self.num_ejected += 1
+                cooldown = min(base_cooldown * 2 ** (self.consecutive_failures - max_consecutive_failures), max_cooldown)
+                self.cooldown_until = max(self.cooldown_until, now + cooldown)
+                print(f"Deployment {self.name} failed {self.consecutive_failures} requests in a row, taking it out of rotation for {cooldown:.0f}s")
+
+    def record_other(self):
+        with self.lock: self.in_flight -= 1
+
+    def stats(self):
+        """
+        Returns:
+            dict: traffic and health of the deployment
+        """
+        with self.lock:
+            return {
+                "weight": self.weight,
+                "requests": self.num_requests,
+                "failures": self.num_failures,
+                "rate_limited": self.num_rate_limited,
+                "ejected": self.num_ejected,
+                "in_flight": self.in_flight,
+                "latency": self.latency,
+                "error_rate": self.error_rate,
+                "cooling_down": time.monotonic() < self.cooldown_until,
+            }
+
+
+class DeploymentRouter():
+    def __init__(self, deployments, max_failovers=None, base_cooldown=5.0, max_cooldown=120.0, max_consecutive_failures=3, seed=None):
+        """
+        Spreads requests over several deployments of the teacher model, e.g. in different regions,
+        and fails over between them. Each request goes to a deployment drawn with probability
+        proportional to its weight scaled by its health, among those not cooling down after
+        429s or repeated failures and, when possible, with quota to spare. A request failing
+        with a transient error is re-sent to another deployment before the error reaches the
+        retry policy. Has the same interface as OpenAIBackend.
+
+        Args:
+            deployments (list): Deployment objects
+            max_failovers (Optional[int]): other deployments a failed request is re-sent to, defaults to all of them
+            base_cooldown (float): seconds a deployment is taken out of rotation after max_consecutive_failures failures, or after a 429 without Retry-After
+            max_cooldown (float): longest cooldown, doubling from base_cooldown while failures continue
+            max_consecutive_failures (int): failures in a row after which a deployment is taken out of rotation
+            seed (Optional[int]): seed for the choice of deployments
+        """
+        if not deployments: raise ValueError("DeploymentRouter needs at least one deployment")
+        self.deployments = deployments
+        self.max_failovers = max_failovers if max_failovers is not None else len(deployments) - 1
+        self.base_cooldown,self.max_cooldown = base_cooldown,max_cooldown
+        self.max_consecutive_failures = max_consecutive_failures
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.num_failovers = 0
+
+    def choose(self, num_tokens, exclude):
+        """
+        Args:
+            num_tokens (int): tokens the request will be charged against a quota
+            exclude (list): deployments the request already failed on
+
+        Returns:
+            Optional[Deployment]: deployment to send the request to, None if every deployment was tried
+        """
+        candidates = [deployment for deployment in self.deployments if deployment not in exclude]
+        if not candidates: return None
+        now = time.monotonic()
+        available = [deployment for deployment in candidates if deployment.cooldown_until <= now]
+        # With every deployment cooling down, the one recovering first is probed
+        if not available: return min(candidates, key=lambda deployment: deployment.cooldown_until)
+
+        waits = {deployment: deployment.quota_wait(num_tokens) for deployment in available}
+        ready = [deployment for deployment in available if waits[deployment] == 0] or [min(available, key=waits.get)]
+        latencies = [deployment.latency for deployment in ready if deployment.latency is not None]
+        best_latency = min(latencies) if latencies else None
+        scores = [deployment.score(best_latency) for deployment in ready]
+        with self.lock: return self.rng.choices(ready, weights=scores)[0]
+
+    def complete(self, prompt, model_name, temperature, max_tokens, top_p, stop=None):
+        """
+        Same interface as OpenAIBackend.complete.
+        """
+        num_tokens = estimate_prompt_tokens(prompt) + max_tokens
+        tried = []
+        while True:
+            deployment = self.choose(num_tokens, tried)
+            deployment.record_start()
+            start = time.monotonic()
+            try:
+                response = deployment.backend.complete(prompt, deployment.model or model_name, temperature, max_tokens, top_p, stop)
+            except Exception as e:
+                if not is_retryable(e):
+                    deployment.record_other()
+                    raise
+                deployment.record_failure(e, self.base_cooldown, self.max_cooldown, self.max_consecutive_failures)
+                tried.append(deployment)
+                if len(tried) > self.max_failovers or len(tried) == len(self.deployments): raise
+                with self.lock: self.num_failovers += 1
+                continue
+            deployment.record_success(time.monotonic() - start)
+            return response
+
+    def stats(self):
+        """
+        Returns:
+            dict: deployment name mapped to its traffic and health
+        """
+        return {deployment.name: deployment.stats() for deployment in self.deployments}
+
+    def summary(self):
+        """
+        Returns:
+            str: human readable traffic and health per deployment
+        """
+        stats = self.stats()
+        num_requests = sum(deployment["requests"] for deployment in stats.values())
+        lines = [f"Deployments: {num_requests} requests, {self.num_failovers} failed over to another deployment"]
+        for name,deployment in stats.items():
+            latency = f"{deployment['latency']:.2f}s" if deployment["latency"] is not None else "n/a"
+            lines.append(f"    {name}: {deployment['requests']} requests ({deployment['requests'] / max(num_requests, 1):.1%}, weight {deployment['weight']}), {deployment['failures']} failed ({deployment['rate_limited']} rate limited), latency {latency}, error rate {deployment['error_rate']:.1%}, taken out of rotation {deployment['ejected']} times")
+        return "\n".join(lines)
+
+
+def load_deployments(path, http_pool=None):
+    """
+    Reads deployments from a JSON list. Each entry has a "type" ("azure", "openai" or "mock"),
+    and optionally a "name", "weight", "requests_per_minute", "tokens_per_minute" and "model"
+    (the Azure deployment name). Azure entries take an "endpoint" and "api_version", OpenAI
+    entries a "base_url"; keys are read from the environment variable named by "api_key_env".
+    Mock entries take the arguments of MockBackend.
+
+    Args:
+        path (str): JSON file listing the deployments
+        http_pool (Optional[HTTPPool]): connection pool settings shared by the HTTP backends
+
+    Returns:
+        list: Deployment objects
+    """
+    with open(path, "r") as f: entries = json.load(f)
+    deployments = []
+    for i,entry in enumerate(entries):
+        entry = dict(entry)
+        kind = entry.pop("type", "azure")
+        name = entry.pop("name", f"{kind}-{i}")
+        options = {key: entry.pop(key) for key in ["model", "weight", "requests_per_minute", "tokens_per_minute"] if key in entry}
+        api_key = os.getenv(entry.pop("api_key_env")) if "api_key_env" in entry else None
+        if kind == "azure": backend = AzureBackend(entry.pop("endpoint", None), api_key, entry.pop("api_version", None), http_pool=http_pool)
+        elif kind == "openai": backend = OpenAIBackend(entry.pop("base_url", None), api_key, http_pool=http_pool)
+        elif kind == "mock": backend = MockBackend(**entry)
+        else: raise ValueError(f"Unknown deployment type {kind} in {path}")
+        if kind != "mock" and entry: raise ValueError(f"Unknown keys {sorted(entry)} for deployment {name} in {path}")
+        deployments.append(Deployment(name, backend, **options))
+    return deployments
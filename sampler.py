@@ -0,0 +1,281 @@
+import json
+import os
+import random
+import threading
+
+
+class ReferenceSampler():
+    def __init__(self, num_references, seed=None, num_draws=0):
+        """
+        Draws reference sample indices without replacement from a shuffled deck, starting a
+        freshly shuffled deck once every reference has been drawn. The deck for each epoch is
+        derived from the seed alone, so the sampler state is just (seed, number of draws) and
+        can be persisted and replayed. Draws are thread-safe; processes do not share a sampler,
+        since a sharded run gives each shard its own references, sampler and checkpoint, and a
+        shard's state travels between processes through that checkpoint.
+
+        Args:
+            num_references (int): number of reference samples to draw from
+            seed (Optional[int]): seed for the shuffles, a random one is picked if None
+            num_draws (int): number of draws already made, used to resume a previous run
+        """
+        if num_references <= 0: raise ValueError("ReferenceSampler needs at least one reference sample")
+
+        self.num_references = num_references
+        self.seed = seed if seed is not None else random.randrange(2**32)
+
+        self.lock = threading.Lock()
+        self.num_draws = num_draws
+
+        self.deck_lock = threading.Lock()
+        self.decks = {}
+
+    def next_draw(self):
+        """
+        Claims the next draw number.
+
+        Returns:
+            int: draw number, unique across all threads sharing the sampler
+        """
+        with self.lock:
+            draw = self.num_draws
+            self.num_draws += 1
+        return draw
+
+    def deck(self, epoch):
+        """
+        Returns the shuffled deck for an epoch, building it once per epoch.
+
+        Args:
+            epoch (int): epoch number
+
+        Returns:
+            list: permutation of the reference sample indices
+        """
+        with self.deck_lock:
+            if epoch not in self.decks:
+                deck = list(range(self.num_references))
+                random.Random(f"{self.seed}:{epoch}").shuffle(deck)
+                self.decks[epoch] = deck
+                # Workers can straddle an epoch boundary, so keep the previous deck around
+                for old_epoch in [e for e in self.decks if e < epoch - 1]: del self.decks[old_epoch]
+            return self.decks[epoch]
+
+    def reference_for(self, draw):
+        """
+        Maps a draw number to the reference sample it selects.
+
+        Args:
+            draw (int): draw number from next_draw
+
+        Returns:
+            int: index into the reference samples
+        """
+        epoch,position = divmod(draw, self.num_references)
+        return self.deck(epoch)[position]
+
+    def draw(self):
+        """
+        Draws the next reference sample index.
+
+        Returns:
+            int: index into the reference samples
+        """
+        return self.reference_for(self.next_draw())
+
+    def release(self, draw):
+        """
+        Called once every yield of a draw has been recorded. Draws map to references through
+        the decks, so there is nothing to forget.
+
+        Args:
+            draw (int): draw number from next_draw
+        """
+
+    def state(self):
+        """
+        Returns:
+            dict: seed and number of draws, enough to replay or resume the sampler
+        """
+        with self.lock: return {"seed": self.seed, "num_draws": self.num_draws}
+
+
+class ReferenceYield():
+    def __init__(self, num_references):
+        """
+        Thread-safe per-reference draws, valid pairs produced and tokens spent, used to measure
+        which reference samples are worth drawing.
+
+        Args:
+            num_references (int): number of reference samples
+        """
+        import numpy as np
+        self.lock = threading.Lock()
+        self.draws = np.zeros(num_references)
+        self.pairs = np.zeros(num_references)
+        self.tokens = np.zeros(num_references)
+
+    def record(self, reference, draws=0, pairs=0, tokens=0):
+        """
+        Args:
+            reference (int): index of the reference sample
+            draws (int): draws of the reference to add
+            pairs (int): valid pairs it produced
+            tokens (int): tokens spent on it
+        """
+        with self.lock:
+            self.draws[reference] += draws
+            self.pairs[reference] += pairs
+            self.tokens[reference] += tokens
+
+    def load(self, path):
+        """
+        Restores the counters saved by a previous run.
+
+        Args:
+            path (str): JSON file written by save
+        """
+        with open(path, "r") as f: stats = json.load(f)
+        with self.lock:
+            for elem in stats:
+                if elem["reference"] >= len(self.draws): continue
+                self.draws[elem["reference"]],self.pairs[elem["reference"]],self.tokens[elem["reference"]] = elem["draws"],elem["pairs"],elem["tokens"]
+
+    def save(self, path):
+        """
+        Writes the counters of every drawn reference sample, with its pairs per thousand tokens.
+
+        Args:
+            path (str): JSON file to write
+        """
+        with self.lock:
+            stats = [{
+                "reference": i,
+                "draws": int(self.draws[i]),
+                "pairs": int(self.pairs[i]),
+                "tokens": int(self.tokens[i]),
+                "pairs_per_1k_tokens": 1000 * self.pairs[i] / self.tokens[i] if self.tokens[i] else None,
+            } for i in self.draws.nonzero()[0].tolist()]
+        with open(path + ".tmp", "w") as f: json.dump(stats, f, indent=4)
+        os.replace(path + ".tmp", path)
+
+    def yields(self):
+        """
+        Returns:
+            tuple: pairs per token of the draws made, and the estimate for uniform sampling, where every drawn reference weighs the same
+        """
+        with self.lock:
+            drawn = self.draws > 0
+            if not drawn.any() or not self.tokens.sum(): return None,None
+            actual = self.pairs.sum() / self.tokens.sum()
+            per_draw_tokens = (self.tokens[drawn] / self.draws[drawn]).mean()
+            uniform = (self.pairs[drawn] / self.draws[drawn]).mean() / per_draw_tokens if per_draw_tokens else None
+        return actual,uniform
+
+    def summary(self, dollars_per_token=None):
+        """
+        Args:
+            dollars_per_token (Optional[float]): average cost of a token, to report pairs per dollar
+
+        Returns:
+            str: human readable yield of the draws made, compared with uniform sampling
+        """
+        actual,uniform = self.yields()
+        if actual is None: return "Reference yield: no draws yet"
+
+        def describe(pairs_per_token):
+            if pairs_per_token is None: return "n/a"
+            description = f"{1000 * pairs_per_token:.3f} pairs per 1k tokens"
+            if dollars_per_token: description += f" ({pairs_per_token / dollars_per_token:.1f} pairs per dollar)"
+            return description
+
+        with self.lock: num_drawn,num_barren = int((self.draws > 0).sum()),int(((self.draws > 0) & (self.pairs == 0)).sum())
+        return f"Reference yield: {describe(actual)}, estimated {describe(uniform)} with uniform sampling; {num_drawn} of {len(self.draws)} references drawn, {num_barren} without any valid pair"
+
+
+class YieldAwareSampler(ReferenceSampler):
+    def __init__(self, num_references, reference_yield, seed=None, num_draws=0, coverage=0.3, num_coverage_draws=0, greed=1.0, prior_pairs=0.1):
+        """
+        Reference sampler that favours reference samples producing many valid pairs per token.
+        Until every reference has been drawn once, and for a coverage fraction of draws after
+        that, references come from the shuffled decks of ReferenceSampler, so every reference
+        keeps being drawn at least at that fraction of the uniform rate. The other draws pick a
+        reference with probability proportional to its estimated pairs per token (raised to
+        greed), which spreads them over all productive references instead of concentrating on
+        the single best one.
+
+        Draws depend on the yields observed so far, so unlike ReferenceSampler the choices are
+        not replayed from the sampler state alone.
+
+        Args:
+            num_references (int): number of reference samples to draw from
+            reference_yield (ReferenceYield): per-reference counters the draws are based on
+            seed (Optional[int]): seed for the shuffles and the proportional draws, a random one is picked if None
+            num_draws (int): number of draws already made, used to resume a previous run
+            coverage (float): fraction of draws taken from the shuffled decks after the first pass
+            num_coverage_draws (int): number of deck draws already made, used to resume a previous run
+            greed (float): exponent on the estimated yields, higher values favour the best references more strongly
+            prior_pairs (float): weight of the overall yield in each reference's estimate, in pairs
+        """
+        import numpy as np
+        super().__init__(num_references, seed, num_draws)
+        self.reference_yield = reference_yield
+        self.coverage = coverage
+        self.num_coverage_draws = num_coverage_draws
+        self.greed,self.prior_pairs = greed,prior_pairs
+        self.rng = np.random.default_rng([self.seed, num_draws])
+        self.assigned = {}
+
+    def choose(self):
+        # Called under self.lock
+        if self.num_coverage_draws < self.num_references or self.rng.random() < self.coverage:
+            epoch,position = divmod(self.num_coverage_draws, self.num_references)
+            self.num_coverage_draws += 1
+            return self.deck(epoch)[position]
+
+        reference_yield = self.reference_yield
+        with reference_yield.lock:
+            # Each estimate starts from a prior worth a fraction of a pair at the overall yield
+            overall_yield = (reference_yield.pairs.sum() + 1) / (reference_yield.tokens.sum() + 1)
+            estimates = (reference_yield.pairs + self.prior_pairs) / (reference_yield.tokens + self.prior_pairs / overall_yield)
+        weights = estimates ** self.greed
+        return int(self.rng.choice(len(weights), p=weights / weights.sum()))
+
+    def next_draw(self):
+        """
+        Claims the next draw number and picks its reference sample.
+
+        Returns:
+            int: draw number
+        """
+        with self.lock:
+            draw = self.num_draws
+            self.num_draws += 1
+            self.assigned[draw] = self.choose()
+        return draw
+
+    def reference_for(self, draw):
+        """
+        Args:
+            draw (int): draw number from next_draw, not yet released
+
+        Returns:
+            int: index into the reference samples
+        """
+        with self.lock: return self.assigned[draw]
+
+    def release(self, draw):
+        """
+        Forgets the reference sample of a draw whose yield has been recorded.
+
+        Args:
+            draw (int): draw number from next_draw
+        """
+        with self.lock: self.assigned.pop(draw, None)
+
+    def state(self):
+        """
+        Returns:
+            dict: seed, number of draws and number of deck draws, enough to resume the sampler
+        """
+        with self.lock: return {"seed": self.seed, "num_draws": self.num_draws, "num_coverage_draws": self.num_coverage_draws}
@@ -0,0 +1,155 @@
+import collections
+import concurrent.futures
+import threading
+import time
+
+
+class PipelineStage():
+    def __init__(self, name, fn, num_workers, max_queue=None):
+        """
+        One stage of a StagedPipeline.
+
+        Args:
+            name (str): name of the stage
+            fn (Callable[[Any], list]): processes one item, returning the items passed on to the next stage
+            num_workers (int): maximum number of items processed at once by this stage
+            max_queue (Optional[int]): queue depth above which no new work enters the pipeline, defaults to 4 * num_workers
+        """
+        self.name = name
+        self.fn = fn
+        self.num_workers = num_workers
+        self.max_queue = max_queue or 4 * num_workers
+
+        self.queue = collections.deque()
+        self.in_flight = 0
+        self.num_completed,self.num_failed,self.max_queue_depth = 0,0,0
+
+    def stats(self, elapsed):
+        """
+        Args:
+            elapsed (float): seconds since the pipeline started
+
+        Returns:
+            dict: queue depth, items in flight and throughput of the stage
+        """
+        return {
+            "queued": len(self.queue),
+            "in_flight": self.in_flight,
+            "completed": self.num_completed,
+            "failed": self.num_failed,
+            "max_queued": self.max_queue_depth,
+            "per_second": self.num_completed / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class StagedPipeline():
+    def __init__(self, stages, circuit_breaker=None, report_every=60):
+        """
+        Runs items through a chain of stages, each with its own queue and concurrency limit, on
+        one shared thread pool. Items move to the next stage as soon as they are processed, so
+        independent items progress at the same time instead of one long serial chain per source
+        item. New work is only pulled from the source while every queue is below its limit.
+
+        Args:
+            stages (list): PipelineStage objects, in order
+            circuit_breaker (Optional[CircuitBreaker]): no new tasks are started while it is open
+            report_every (Optional[float]): seconds between queue depth and throughput reports, None to disable them
+        """
+        self.stages = stages
+        self.circuit_breaker = circuit_breaker
+        self.report_every = report_every
+        self.stop_event = threading.Event()
+        self.start_time = None
+
+    def stop(self):
+        """
+        Stops pulling new work and drops queued items. Items already in flight run to completion,
+        but their outputs are not passed on.
+        """
+        self.stop_event.set()
+
+    def stopped(self):
+        return self.stop_event.is_set()
+
+    def stats(self):
+        """
+        Returns:
+            dict: stage name mapped to its queue depth, items in flight and throughput
+        """
+        elapsed = time.monotonic() - self.start_time if self.start_time is not None else 0.0
+        return {stage.name: stage.stats(elapsed) for stage in self.stages}
+
+    def summary(self):
+        """
+        Returns:
+            str: human readable per-stage queue depths and throughput
+        """
+        lines = ["Pipeline stages:"]
+        for name,stats in self.stats().items():
+            lines.append(f"    {name}: {stats['completed']} completed ({stats['per_second']:.2f}/s), {stats['failed']} failed, {stats['queued']} queued (max {stats['max_queued']}), {stats['in_flight']} in flight")
+        return "\n".join(lines)
+
+    def accepting(self):
+        first = self.stages[0]
+        return first.in_flight + len(first.queue) < first.num_workers and all(len(stage.queue) < stage.max_queue for stage in self.stages[1:])
+
+    def run(self, source, on_output, on_error=None):
+        """
+        Runs until stop() is called or the source runs dry, then waits for the in-flight items.
+
+        Args:
+            source (Callable[[], Optional[list]]): returns the next items for the first stage, or None once there are no more
+            on_output (Callable[[Any], None]): called on the scheduling thread with each output of the last stage
+            on_error (Optional[Callable[[str, Exception], None]]): called on the scheduling thread with the stage name when an item raises
+        """
+        self.start_time = last_report = time.monotonic()
+        in_flight = {}
+        source_done = False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=sum(stage.num_workers for stage in self.stages)) as executor:
+            while True:
+                if self.stopped():
+                    for stage in self.stages: stage.queue.clear()
+                elif not source_done:
+                    while self.accepting():
+                        items = source()
+                        if items is None:
+                            source_done = True
+                            break
+                        self.stages[0].queue.extend(items)
+
+                # Later stages go first, so finished work drains before new work starts
+                breaker_open = self.circuit_breaker is not None and self.circuit_breaker.is_open()
+                if not breaker_open:
+                    for idx in reversed(range(len(self.stages))):
+                        stage = self.stages[idx]
+                        while stage.queue and stage.in_flight < stage.num_workers:
+                            in_flight[executor.submit(stage.fn, stage.queue.popleft())] = idx
+                            stage.in_flight += 1
+                if not in_flight:
+                    if self.stopped() or source_done: break
+                    # Let the breaker cool down before starting new work
+                    if breaker_open: self.circuit_breaker.wait_until_closed()
+                    continue
+
+                done,_ = concurrent.futures.wait(in_flight, timeout=self.report_every, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    idx = in_flight.pop(future)
+                    stage = self.stages[idx]
+                    stage.in_flight -= 1
+                    stage.num_completed += 1
+                    try:
+                        outputs = future.result()
+                    except Exception as e:
+                        stage.num_failed += 1
+                        if on_error is not None: on_error(stage.name, e)
+                        continue
+                    if self.stopped(): continue
+                    if idx + 1 == len(self.stages):
+                        for output in outputs: on_output(output)
+                    else:
+                        self.stages[idx + 1].queue.extend(outputs)
+                        self.stages[idx + 1].max_queue_depth = max(self.stages[idx + 1].max_queue_depth, len(self.stages[idx + 1].queue))
+
+                if self.report_every is not None and time.monotonic() - last_report >= self.report_every:
+                    last_report = time.monotonic()
+                    print(self.summary())
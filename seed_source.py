@@ -0,0 +1,113 @@
+import json
+import os
+
+from rate_limiter import estimate_prompt_tokens
+
+
+def get_field(record, path):
+    """
+    Args:
+        record (dict): seed record
+        path (str): field name, with dots for nested fields, e.g. "turns.0.content"
+
+    Returns:
+        Any: value of the field
+    """
+    value = record
+    for key in path.split("."):
+        value = value[int(key)] if isinstance(value, list) else value[key]
+    return value
+
+
+def turn_text(turn):
+    # Conversation turns are either plain strings (LIMA) or chat messages
+    if isinstance(turn, dict): return turn.get("content", turn.get("value"))
+    return turn
+
+
+class SeedSource():
+    def __init__(self, name_or_path, split="train", instruction_field=None, response_field=None, conversations_field="conversations", streaming=False, max_tokens=None, count_tokens=None):
+        """
+        Iterable over the instruction/response pairs of a seed dataset, read lazily on every pass
+        instead of being copied into memory up front. Local .jsonl/.json and .parquet files are
+        streamed from disk; anything else is loaded with datasets.load_dataset, either memory-mapped
+        from the Arrow cache or with streaming=True.
+
+        Samples come either from an instruction and a response field, or from a two-turn
+        conversation field (LIMA's schema). Samples that are too long are skipped before any
+        feedback prompt is paid for.
+
+        Args:
+            name_or_path (str): Hugging Face dataset name, or path to a local .jsonl, .json or .parquet file
+            split (str): dataset split to read
+            instruction_field (Optional[str]): field holding the instruction, with dots for nested fields
+            response_field (Optional[str]): field holding the response, with dots for nested fields
+            conversations_field (str): field holding two-turn conversations, used when the instruction and response fields are not given
+            streaming (bool): stream Hugging Face datasets instead of downloading and memory-mapping them
+            max_tokens (Optional[int]): skip samples whose instruction and response together are longer than this
+            count_tokens (Optional[Callable[[str], int]]): token counter for the length filter, defaults to a four characters per token estimate
+        """
+        if (instruction_field is None) != (response_field is None): raise ValueError("instruction_field and response_field must be given together")
+
+        self.name_or_path = name_or_path
+        self.split = split
+        self.instruction_field,self.response_field = instruction_field,response_field
+        self.conversations_field = conversations_field
+        self.streaming = streaming
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens or estimate_prompt_tokens
+        self.num_skipped = 0
+
+    @property
+    def columns(self):
+        fields = [self.instruction_field, self.response_field] if self.instruction_field is not None else [self.conversations_field]
+        return list(dict.fromkeys(field.split(".")[0] for field in fields))
+
+    def records(self):
+        """
+        Yields the raw records of the dataset.
+        """
+        extension = os.path.splitext(self.name_or_path)[1]
+        if extension == ".jsonl":
+            with open(self.name_or_path, "r") as f:
+                for line in f:
+                    if line.strip(): yield json.loads(line)
+        elif extension == ".json":
+            with open(self.name_or_path, "r") as f: yield from json.load(f)
+        elif extension == ".parquet":
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(self.name_or_path).iter_batches(columns=self.columns):
+                yield from batch.to_pylist()
+        else:
+            from datasets import load_dataset
+            ds = load_dataset(self.name_or_path, split=self.split, streaming=self.streaming)
+            # Only the mapped columns are decoded
+            yield from ds.select_columns(self.columns)
+
+    def sample(self, record):
+        """
+        Args:
+            record (dict): raw record
+
+        Returns:
+            Optional[dict]: instruction and response values, or None if the record is not a usable sample
+        """
+        if self.instruction_field is not None:
+            instruction,response = get_field(record, self.instruction_field),get_field(record, self.response_field)
+        else:
+            conversations = get_field(record, self.conversations_field)
+            if len(conversations) != 2: return None
+            instruction,response = turn_text(conversations[0]),turn_text(conversations[1])
+
+        if not instruction or not response: return None
+        return {"instruction": instruction, "response": response}
+
+    def __iter__(self):
+        self.num_skipped = 0
+        for record in self.records():
+            sample = self.sample(record)
+            if sample is None: continue
+            if self.max_tokens is not None and self.count_tokens(sample["instruction"]) + self.count_tokens(sample["response"]) > self.max_tokens:
+                self.num_skipped += 1
+                continue
+            yield sample
@@ -0,0 +1,334 @@
+import glob
+import json
+import os
+import socket
+import threading
+import time
+
+from data_writer import write_pretty_json
+from dedup import MinHashDeduplicator
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Lease():
+    def __init__(self, path, owner, ttl=120):
+        """
+        Lease on a piece of work, held as a file on a filesystem shared by every worker. The
+        holder renews it while it works; a worker that dies stops renewing, and once the lease
+        expires any other worker can take the work over. Expiry uses wall-clock time, so the
+        clocks of the hosts are assumed to agree to well within the ttl.
+
+        Args:
+            path (str): lease file
+            owner (str): name of the worker taking the lease
+            ttl (float): seconds a lease stays valid without being renewed
+        """
+        self.path = path
+        self.owner = owner
+        self.ttl = ttl
+        self.stopped = threading.Event()
+
+    def read(self):
+        try:
+            with open(self.path, "r") as f: return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def acquire(self):
+        """
+        Returns:
+            bool: whether the lease was free or expired, and is now held by this worker
+        """
+        lease = self.read()
+        if lease is not None and lease["expires"] < time.time():
+            # Only one worker wins the rename of an expired lease
+            expired_path = f"{self.path}.expired-{self.owner}"
+            try:
+                os.rename(self.path, expired_path)
+            except FileNotFoundError:
+                return False
+            # Another worker that saw the same expired lease may have taken it over between the
+            # read and the rename, in which case the renamed file is its fresh lease: put it back
+            try:
+                with open(expired_path, "r") as f: renamed = json.load(f)
+            except json.JSONDecodeError:
+                renamed = None
+            if renamed != lease:
+                try:
+                    os.link(expired_path, self.path)
+                except FileExistsError:
+                    pass
+                os.remove(expired_path)
+                return False
+            os.remove(expired_path)
+            print(f"Taking over {self.path} from {lease['owner']}, whose lease expired")
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f: json.dump({"owner": self.owner, "expires": time.time() + self.ttl}, f)
+        self.stopped.clear()
+        return True
+
+    def renew(self):
+        """
+        Returns:
+            bool: whether the lease is still held by this worker
+        """
+        lease = self.read()
+        if lease is None or lease["owner"] != self.owner: return False
+        tmp_path = f"{self.path}.{self.owner}.tmp"
+        with open(tmp_path, "w") as f: json.dump({"owner": self.owner, "expires": time.time() + self.ttl}, f)
+        os.replace(tmp_path, self.path)
+        return True
+
+    def release(self):
+        self.stopped.set()
+        lease = self.read()
+        if lease is not None and lease["owner"] == self.owner: os.remove(self.path)
+
+    def keep_alive(self, on_lost):
+        """
+        Renews the lease in a background thread until it is released.
+
+        Args:
+            on_lost (Callable[[], None]): called if another worker took the lease over
+        """
+        def renew_until_released():
+            while not self.stopped.wait(self.ttl / 3):
+                if not self.renew():
+                    print(f"Lost {self.path} to another worker")
+                    on_lost()
+                    return
+        threading.Thread(target=renew_until_released, daemon=True).start()
+
+
+class ShardCoordinator():
+    def __init__(self, output_dir, num_shards, size, owner=None, ttl=120, poll_interval=10):
+        """
+        Coordinates workers, processes or hosts sharing output_dir, that synthesize one dataset
+        together. The reference samples are partitioned deterministically into num_shards
+        shards, each with its own share of size, output directory and checkpoint. Workers claim
+        shards through leases, so the shard of a worker that dies is resumed by whichever worker
+        claims it next.
+
+        Args:
+            output_dir (str): output directory shared by all workers
+            num_shards (int): number of shards the reference samples are partitioned into
+            size (int): target number of samples over all shards
+            owner (Optional[str]): name of this worker, defaults to the host name and process id
+            ttl (float): seconds a shard lease stays valid without being renewed
+            poll_interval (float): seconds between checks while waiting for work held by other workers
+        """
+        self.output_dir = output_dir
+        self.num_shards = num_shards
+        self.size = size
+        self.owner = owner or worker_name()
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        os.makedirs(os.path.join(output_dir, "shards"), exist_ok=True)
+
+    def shard_dir(self, shard):
+        return os.path.join(self.output_dir, "shards", f"shard-{shard:05d}")
+
+    def shard_target(self, shard):
+        return self.size // self.num_shards + (shard < self.size % self.num_shards)
+
+    def partition(self, reference_samples, shard):
+        """
+        Args:
+            reference_samples (list): all reference samples with feedback
+            shard (int): shard index
+
+        Returns:
+            list: reference samples of the shard
+        """
+        if len(reference_samples) < self.num_shards: raise ValueError(f"Cannot split {len(reference_samples)} reference samples into {self.num_shards} shards")
+        return reference_samples[shard::self.num_shards]
+
+    def lease(self, name):
+        return Lease(os.path.join(self.output_dir, "shards", f"{name}.lease"), self.owner, self.ttl)
+
+    def is_done(self, shard):
+        return os.path.exists(os.path.join(self.shard_dir(shard), "DONE"))
+
+    def mark_done(self, shard):
+        open(os.path.join(self.shard_dir(shard), "DONE"), "w").close()
+
+    def shard_records(self, shard):
+        # The sidecar index lags by at most index_every records, which is enough for progress
+        try:
+            with open(os.path.join(self.shard_dir(shard), "synthesized_data.index.json"), "r") as f: return json.load(f)["num_records"]
+        except (FileNotFoundError, json.JSONDecodeError):
+            return 0
+
+    def exclusive(self, name, done_path, fn):
+        """
+        Runs fn in exactly one worker, e.g. feedback collection before synthesis, while the other
+        workers wait for done_path. If the worker running it dies, another one takes over.
+
+        Args:
+            name (str): name of the lease
+            done_path (str): file that exists once fn has finished
+            fn (Callable[[], Any]): work to run, resuming any progress of a previous holder
+
+        Returns:
+            Any: result of fn, or None in the workers that waited
+        """
+        lease = self.lease(name)
+        while True:
+            if os.path.exists(done_path) and lease.read() is None: return None
+            if lease.acquire():
+                lease.keep_alive(lambda: None)
+                try:
+                    return fn()
+                finally:
+                    lease.release()
+            time.sleep(self.poll_interval)
+
+    def claim(self):
+        """
+        Claims an unfinished shard that no live worker holds, starting from a worker-specific
+        offset so workers starting together do not all race for shard 0.
+
+        Returns:
+            Optional[tuple]: shard index and its lease, or None if every unfinished shard is held
+        """
+        offset = hash(self.owner) % self.num_shards
+        for i in range(self.num_shards):
+            shard = (offset + i) % self.num_shards
+            if self.is_done(shard): continue
+            lease = self.lease(f"shard-{shard:05d}")
+            if lease.acquire():
+                # The shard may have been finished between the check and the claim
+                if self.is_done(shard):
+                    lease.release()
+                    continue
+                return shard,lease
+        return None
+
+    def all_done(self):
+        return all(self.is_done(shard) for shard in range(self.num_shards))
+
+    def run(self, reference_samples, make_synthesizer):
+        """
+        Claims and synthesizes shards until every shard is done, waiting while the remaining
+        shards are held by other workers in case one of them dies.
+
+        Args:
+            reference_samples (list): all reference samples with feedback
+            make_synthesizer (Callable[[list, str, int], ReferenceLevelFeedbackSynthesizer]): builds the synthesizer of a shard from its reference samples, output directory and index
+
+        Returns:
+            bool: whether every shard is done, False if this worker stopped on a shard it could not finish
+        """
+        print(self.summary())
+        while not self.all_done():
+            claim = self.claim()
+            if claim is None:
+                time.sleep(self.poll_interval)
+                continue
+
+            shard,lease = claim
+            print(f"Synthesizing shard {shard} ({self.shard_target(shard)} samples) in {self.shard_dir(shard)}")
+            os.makedirs(self.shard_dir(shard), exist_ok=True)
+            synthesizer = make_synthesizer(self.partition(reference_samples, shard), self.shard_dir(shard), shard)
+            lost = threading.Event()
+
+            def on_lost():
+                lost.set()
+                if synthesizer.pipeline is not None: synthesizer.pipeline.stop()
+
+            lease.keep_alive(on_lost)
+            try:
+                synthesizer.synthesize_data(self.shard_target(shard))
+                finished = self.shard_records(shard) >= self.shard_target(shard)
+                if finished and not lost.is_set(): self.mark_done(shard)
+            finally:
+                lease.release()
+            print(self.summary())
+            # Claiming the shard again would stop the same way, e.g. on cache misses in replay mode
+            if not finished and not lost.is_set():
+                print(f"Shard {shard} stopped short of its target, leaving it for another worker")
+                return False
+        return True
+
+    def summary(self):
+        """
+        Returns:
+            str: human readable progress of all workers towards size
+        """
+        num_records = sum(self.shard_target(shard) if self.is_done(shard) else min(self.shard_records(shard), self.shard_target(shard)) for shard in range(self.num_shards))
+        num_done = sum(self.is_done(shard) for shard in range(self.num_shards))
+        num_leased = len(glob.glob(os.path.join(self.output_dir, "shards", "shard-*.lease")))
+        return f"Global progress: {num_records}/{self.size} samples, {num_done}/{self.num_shards} shards done, {num_leased} being synthesized"
+
+
+def iter_shard_records(shard_dir):
+    """
+    Reads the records of a shard without modifying it, skipping a partially written last line,
+    so it is safe while the shard is still being written.
+
+    Args:
+        shard_dir (str): output directory of the shard
+
+    Yields:
+        dict: synthesized records
+    """
+    for path in sorted(glob.glob(os.path.join(shard_dir, "synthesized_data*.jsonl"))):
+        with open(path, "r") as f:
+            for line in f:
+                if line.endswith("\n"): yield json.loads(line)
+
+
+def merge_shards(output_dir, output_format="json", size=None, dedup_threshold=None):
+    """
+    Combines the shards of a sharded run into one dataset in output_dir. Instructions that
+    are exact or near-duplicates of an earlier one, possibly from another shard, are dropped.
+
+    Args:
+        output_dir (str): output directory of the sharded run
+        output_format (str): "json" for synthesized_data.json, or "jsonl" for synthesized_data.jsonl
+        size (Optional[int]): maximum number of records to keep
+        dedup_threshold (Optional[float]): similarity above which instructions are dropped as near-duplicates, None or 0 to only drop exact duplicates
+
+    Returns:
+        str: path of the merged dataset
+    """
+    shard_dirs = sorted(glob.glob(os.path.join(output_dir, "shards", "shard-*[0-9]")))
+    unfinished = [shard_dir for shard_dir in shard_dirs if not os.path.exists(os.path.join(shard_dir, "DONE"))]
+    if unfinished: print(f"Warning: merging {len(unfinished)} unfinished shards")
+
+    deduplicator = MinHashDeduplicator(dedup_threshold) if dedup_threshold else None
+    counts = {"read": 0, "exact": 0, "near": 0, "kept": 0}
+    seen = set()
+
+    def unique_records():
+        for shard_dir in shard_dirs:
+            for record in iter_shard_records(shard_dir):
+                if size is not None and counts["kept"] >= size: return
+                counts["read"] += 1
+                if record["instruction"] in seen:
+                    counts["exact"] += 1
+                    continue
+                seen.add(record["instruction"])
+                if deduplicator is not None and not deduplicator.add(record["instruction"]):
+                    counts["near"] += 1
+                    continue
+                counts["kept"] += 1
+                yield record
+
+    if output_format == "jsonl":
+        filepath = os.path.join(output_dir, "synthesized_data.jsonl")
+        with open(filepath + ".tmp", "w") as f:
+            for record in unique_records(): f.write(json.dumps(record) + "\n")
+        os.replace(filepath + ".tmp", filepath)
+    else:
+        filepath = os.path.join(output_dir, "synthesized_data.json")
+        write_pretty_json(unique_records(), filepath)
+
+    print(f"Merged {len(shard_dirs)} shards: {counts['kept']} of {counts['read']} records kept, {counts['exact']} exact and {counts['near']} near-duplicate instructions dropped")
+    return filepath
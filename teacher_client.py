@@ -0,0 +1,139 @@
+import time
+
+from backends import CONTENT_FILTER_MESSAGE
+from parsing import parse_output
+
+
+class TeacherClient():
+    def __init__(self, teacher_model, backend, retry_policy, token_budget, tracer, usage, parse_stats, cache=None, on_usage=None):
+        """
+        Sends the requests of the feedback collector and the synthesizer to the teacher model:
+        completion cache lookups, transport retries, trace spans, token accounting, adaptive
+        max_tokens with truncated outputs re-sent under a larger budget, and output parsing with
+        a bounded number of re-asks.
+
+        Args:
+            teacher_model (str): name of the teacher model (or Azure deployment)
+            backend (OpenAIBackend): backend serving the teacher model
+            retry_policy (RetryPolicy): retry policy for transport errors and re-asks
+            token_budget (TokenBudget): per-stage max_tokens
+            tracer (Tracer): records spans of requests and parses
+            usage (UsageTracker): per-stage token usage and cost
+            parse_stats (ParseStats): per-stage parsing counters
+            cache (Optional[CompletionCache]): persistent cache of teacher model completions
+            on_usage (Optional[Callable[[Optional[int], dict], None]]): called with the sample index and token usage of each request not served from the cache
+        """
+        self.teacher_model = teacher_model
+        self.backend = backend
+        self.retry_policy = retry_policy
+        self.token_budget = token_budget
+        self.tracer = tracer
+        self.usage = usage
+        self.parse_stats = parse_stats
+        self.cache = cache
+        self.on_usage = on_usage
+
+    def complete(self, prompt, model_name, temperature, max_tokens, top_p, stop=None, sample_index=None, stage=None):
+        """
+        Make an API call to the teacher model backend for chat completion.
+
+        Args:
+            prompt (str): prompt for the model
+            model_name (str): name of the model to use
+            temperature (float): sampling temperature
+            max_tokens (int): maximum number of tokens to generate
+            top_p (float): nucleus sampling parameter
+            stop (Optional[str]): stop sequence for text generation
+            sample_index (Optional[Any]): index distinguishing repeated requests with the same prompt in the completion cache
+            stage (Optional[str]): pipeline stage sending the request, for its trace span
+
+        Returns:
+            dict: Response containing generated text, the token usage reported by the API and the finish reason
+        """
+        caller = self.tracer.current()
+        with self.tracer.span("request", stage=stage, max_tokens=max_tokens) as span:
+            if self.cache is not None:
+                # Keyed on the budget ceiling rather than the adaptive budget, so cached completions stay valid as it adapts
+                cache_key = self.cache.key(model_name, prompt, temperature, self.token_budget.max_tokens, top_p, stop, sample_index)
+                cached_response = self.cache.get(cache_key)
+                if cached_response is not None:
+                    span["cached"] = True
+                    return dict(cached_response, cached=True)
+
+            def attempt(*args):
+                span["attempts"] = span.get("attempts", 0) + 1
+                # Retries are rolled up into the calling span, e.g. ask_gpt
+                if span["attempts"] > 1 and caller is not None: caller["transport_retries"] = caller.get("transport_retries", 0) + 1
+                return self.backend.complete(*args)
+
+            try:
+                response = self.retry_policy.call(attempt, prompt, model_name, temperature, max_tokens, top_p, stop)
+                response["text"] = response["text"].strip()
+                span["finish_reason"] = response.get("finish_reason")
+                # Outputs truncated below the ceiling are re-sent with a larger budget, so they are not cached
+                truncated = response.get("finish_reason") == "length" and max_tokens < self.token_budget.max_tokens
+                if self.cache is not None and not truncated: self.cache.put(cache_key, response)
+                return response
+            except Exception as e:
+                if CONTENT_FILTER_MESSAGE in str(e):
+                    print(f"Error in API call: {e}")
+                    span["finish_reason"] = "content_filter"
+                    return {"text": "", "usage": None, "finish_reason": "content_filter"}
+                else:
+                    raise
+
+    def ask(self, prompt, stage, sample_index=None, schema=None, num_items=1):
+        """
+        Submits a request to the teacher model
+
+        Args:
+            prompt (str): input prompt for the model
+            stage (str): pipeline stage sending the request, used for token accounting
+            sample_index (Optional[int]): index of the reference draw the request belongs to, used as part of the cache key
+            schema (Optional[dict]): output schema from prompts.py, only this request is re-sent, a bounded number of times, if the output does not match it
+            num_items (int): items a batched prompt answers at once, scaling its token budget
+
+        Returns:
+            Union[str, dict]: Generated response, or its validated fields if schema is given
+        """
+        with self.tracer.span("ask_gpt", stage=stage, sample_index=sample_index, num_items=num_items) as span:
+            for attempt in range(self.retry_policy.max_parse_attempts):
+                max_tokens = self.token_budget.budget(stage, num_items)
+                while True:
+                    start = time.perf_counter()
+                    response = self.complete(
+                        prompt=prompt,
+                        model_name=self.teacher_model,
+                        temperature =1.0,
+                        max_tokens=max_tokens,
+                        top_p=1.0,
+                        # Re-asks need completions of their own rather than the cached one that failed to parse
+                        sample_index=sample_index if attempt == 0 else attempt if sample_index is None else [sample_index, attempt],
+                        stage=stage
+                    )
+                    if not response.get("cached"):
+                        usage = self.usage.record(stage, prompt, response["text"], response["usage"], time.perf_counter() - start)
+                        if self.on_usage is not None: self.on_usage(sample_index, usage)
+                        self.tracer.count("prompt_tokens", usage["prompt_tokens"])
+                        self.tracer.count("completion_tokens", usage["completion_tokens"])
+                        self.tracer.count("cached_tokens", usage.get("cached_tokens", 0))
+                    self.token_budget.record(stage, response, num_items)
+                    # A truncated output is re-sent with a larger budget instead of being parsed
+                    if response.get("finish_reason") != "length": break
+                    max_tokens = self.token_budget.escalate(stage, max_tokens)
+                    if max_tokens is None: break
+                    self.tracer.count("escalations")
+                span["finish_reason"] = response.get("finish_reason")
+                if schema is None: return response["text"]
+
+                try:
+                    with self.tracer.span("parse", stage=stage) as parse_span:
+                        output = parse_output(response["text"], schema, self.parse_stats, stage, parse_span)
+                    span["parse"] = parse_span["outcome"]
+                    return output
+                except (KeyError, IndexError, TypeError, ValueError):
+                    span["parse"] = "failed"
+                    # Asking again will not get past the content filter
+                    if attempt + 1 == self.retry_policy.max_parse_attempts or response.get("finish_reason") == "content_filter": raise
+                    self.retry_policy.record_parse_retry()
+                    self.tracer.count("parse_retries")
@@ -0,0 +1,47 @@
+import json
+import os
+import zlib
+
+from backends import MockBackend
+from batch import BatchPipeline,LocalBatchSubmitter
+
+
+class EmptyImprovementsBackend():
+    def __init__(self, backend):
+        self.backend = backend
+
+    def complete(self, prompt, model_name, temperature, max_tokens, top_p, stop=None):
+        response = self.backend.complete(prompt, model_name, temperature, max_tokens, top_p, stop)
+        output = json.loads(response["text"])
+        # Every third improvement comes back empty
+        if "improved_response" in output and zlib.crc32(prompt.encode("utf-8")) % 3 == 0:
+            response = dict(response, text=json.dumps(dict(output, improved_response="")))
+        return response
+
+
+def run_batch(output_dir, backend, size, **kwargs):
+    seeds = [{"instruction": f"Explain topic {i}.", "response": f"Topic {i} is explained here."} for i in range(10)]
+    submitter = LocalBatchSubmitter(backend, os.path.join(output_dir, "local_batches"), num_workers=4)
+    pipeline = BatchPipeline("gpt-4o-mini", output_dir, size, submitter, seeds, seed=0, **kwargs)
+    assert pipeline.run(wait=True)
+    with open(os.path.join(output_dir, "synthesized_data.json"), "r") as f: return pipeline,json.load(f)
+
+
+def test_lost_pairs_are_topped_up_and_empty_improvements_dropped(tmp_path):
+    backend = EmptyImprovementsBackend(MockBackend(latency_median=0.001, filter_rate=0.1, seed=0))
+    pipeline,records = run_batch(str(tmp_path), backend, 40, max_attempts=1)
+    assert len(records) == 40
+    assert all(record["improved_response"] != "" for record in records)
+    assert len({record["instruction"] for record in records}) == 40
+    assert pipeline.state["top_ups"] >= 1
+
+    # Running again once done rewrites nothing
+    _,rerun_records = run_batch(str(tmp_path), backend, 40, max_attempts=1)
+    assert rerun_records == records
+
+
+def test_shortfall_is_reported_once_top_ups_run_out(tmp_path, capsys):
+    backend = EmptyImprovementsBackend(MockBackend(latency_median=0.001, seed=0))
+    _,records = run_batch(str(tmp_path), backend, 40, max_top_ups=0)
+    assert len(records) < 40
+    assert f"only {len(records)} of the 40 synthesized data requested" in capsys.readouterr().out
@@ -0,0 +1,35 @@
+import pytest
+
+from completion_cache import CacheMiss,CompletionCache
+
+
+def key(prompt, sample_index=None):
+    return CompletionCache.key("model", prompt, 1.0, 256, 1.0, sample_index=sample_index)
+
+
+def test_key_covers_the_request_and_sample_index():
+    assert key("prompt") == key("prompt")
+    assert len({key("prompt"), key("other"), key("prompt", 0), key("prompt", 1)}) == 4
+
+
+def test_completions_persist_and_replay(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = CompletionCache(path)
+    assert cache.get(key("prompt")) is None
+    cache.put(key("prompt"), {"text": "answer"})
+    cache.close()
+
+    replay = CompletionCache(path, read_only=True)
+    assert replay.get(key("prompt")) == {"text": "answer"}
+    with pytest.raises(CacheMiss): replay.get(key("other"))
+    assert (replay.hits, replay.misses) == (1, 1)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = CompletionCache(str(tmp_path / "cache.db"), max_size_mb=3000 / 1024 / 1024)
+    for i in range(3): cache.put(key(f"prompt {i}"), {"text": "x" * 900})
+    cache.get(key("prompt 0"))
+    cache.put(key("prompt 3"), {"text": "x" * 900})
+    assert cache.evictions > 0 and cache.size_bytes <= 3000
+    assert cache.get(key("prompt 0")) is not None
+    assert cache.get(key("prompt 1")) is None
@@ -0,0 +1,50 @@
+from data_writer import JsonDataWriter,JsonlDataWriter
+
+
+def make_records(start, stop):
+    return [{"instruction": f"instruction {i}", "response": f"response {i}"} for i in range(start, stop)]
+
+
+def test_json_writer_resumes_records_and_sampler_state(tmp_path):
+    writer = JsonDataWriter(str(tmp_path), checkpoint_every=2)
+    writer.sampler_state = {"seed": 7, "num_draws": 3}
+    writer.write(make_records(0, 3))
+    writer.close()
+
+    resumed = JsonDataWriter(str(tmp_path))
+    assert resumed.records == make_records(0, 3)
+    assert resumed.sampler_state == {"seed": 7, "num_draws": 3}
+
+
+def test_jsonl_writer_recovers_records_appended_after_the_index(tmp_path):
+    writer = JsonlDataWriter(str(tmp_path), shard_size=2, index_every=100)
+    writer.sampler_state = {"seed": 7, "num_draws": 2}
+    writer.write(make_records(0, 3))
+    writer.flush()
+    # Written after the last index update, then a line cut short by a crash
+    writer.write(make_records(3, 5))
+    writer.file.write(b'{"instruction": "cut')
+    writer.file.close()
+
+    resumed = JsonlDataWriter(str(tmp_path), shard_size=2)
+    assert resumed.num_records == 5
+    assert resumed.sampler_state == {"seed": 7, "num_draws": 2}
+    assert list(resumed.iter_records()) == make_records(0, 5)
+
+    resumed.write(make_records(5, 6))
+    resumed.close()
+    assert list(JsonlDataWriter(str(tmp_path), shard_size=2).iter_records()) == make_records(0, 6)
+
+
+def test_jsonl_writer_keeps_the_sampler_state_of_records_after_the_index(tmp_path):
+    writer = JsonlDataWriter(str(tmp_path), index_every=100)
+    writer.sampler_state = {"seed": 7, "num_draws": 2}
+    writer.write(make_records(0, 1))
+    writer.flush()
+    writer.sampler_state = {"seed": 7, "num_draws": 5}
+    writer.write(make_records(1, 2))
+    writer.file.close()
+
+    resumed = JsonlDataWriter(str(tmp_path))
+    assert resumed.num_records == 2
+    assert resumed.sampler_state == {"seed": 7, "num_draws": 5}
@@ -0,0 +1,43 @@
+from dedup import MinHashDeduplicator,lsh_params,shingles
+
+
+def jaccard(a, b):
+    a,b = shingles(a),shingles(b)
+    return len(a & b) / len(a | b)
+
+
+BASE = "Write a short story about a lighthouse keeper who discovers a message in a bottle washed ashore after a storm."
+NEAR = "Write a short story about a lighthouse keeper who discovers a message in a bottle washed ashore after a big storm."
+HALF = "Write a short story about a lighthouse keeper who discovers a map in a cave hidden behind the old harbor walls."
+OTHER = "List five practical tips for reducing the memory usage of a Python web service under heavy load."
+
+
+def test_lsh_bands_collide_around_the_threshold():
+    bands,rows = lsh_params(0.8, 128)
+    assert bands * rows <= 128
+    def probability(s): return 1 - (1 - s**rows)**bands
+    assert probability(0.95) > 0.99 and probability(0.4) < 0.05
+
+
+def test_near_duplicates_above_the_threshold_are_dropped():
+    assert jaccard(BASE, NEAR) > 0.9 and jaccard(BASE, HALF) < 0.5
+    deduplicator = MinHashDeduplicator(threshold=0.8)
+    assert deduplicator.add(BASE)
+    assert not deduplicator.add(NEAR)
+    assert deduplicator.add(HALF)
+    assert deduplicator.add(OTHER)
+    assert (deduplicator.num_checked, deduplicator.num_duplicates, len(deduplicator)) == (4, 1, 3)
+
+
+def test_reindexed_texts_do_not_count():
+    deduplicator = MinHashDeduplicator(threshold=0.8)
+    deduplicator.add(BASE, count=False)
+    assert not deduplicator.add(NEAR)
+    assert (deduplicator.num_checked, deduplicator.num_duplicates) == (1, 1)
+
+
+def test_lower_threshold_drops_looser_paraphrases():
+    assert 0.35 < jaccard(BASE, HALF) < 0.45
+    deduplicator = MinHashDeduplicator(threshold=0.3)
+    assert deduplicator.add(BASE)
+    assert not deduplicator.add(HALF)
@@ -0,0 +1,36 @@
+import json
+import os
+
+from ReferenceLevelFeedbackCollector import ReferenceLevelFeedbackCollector
+from backends import MockBackend
+
+
+def make_seeds(names):
+    return [{"instruction": f"Explain {name}.", "response": f"{name} is explained here."} for name in names]
+
+
+def collect(output_dir, seeds):
+    backend = MockBackend(latency_median=0.001, seed=0)
+    collector = ReferenceLevelFeedbackCollector(output_dir=str(output_dir), backend=backend, seed_source=seeds)
+    return collector, collector.collect_feedback(num_workers=2), backend
+
+
+def test_feedback_checkpoint_resumes_by_content(tmp_path):
+    first_collector,first_run,first_backend = collect(tmp_path / "first", make_seeds(["a", "b", "c"]))
+    requests_per_sample = first_backend.num_requests // 3
+    assert requests_per_sample > 0
+    assert not os.path.exists(tmp_path / "first" / "feedback_checkpoint.jsonl")
+
+    # The interrupted run saw a, b and c, then the seed set gained samples before and after them
+    os.makedirs(tmp_path / "second")
+    with open(tmp_path / "second" / "feedback_checkpoint.jsonl", "w") as f:
+        for sample in first_run: f.write(json.dumps({"key": first_collector.sample_key(sample["instruction"], sample["reference_response"]), "sample": sample}) + "\n")
+        f.write('{"key": "cut')
+
+    seeds = make_seeds(["z", "a", "b", "c", "d"])
+    _,second_run,second_backend = collect(tmp_path / "second", seeds)
+    assert second_backend.num_requests == 2 * requests_per_sample
+    assert [sample["instruction"] for sample in second_run] == [seed["instruction"] for seed in seeds]
+    assert second_run[1:4] == first_run
+    assert not os.path.exists(tmp_path / "second" / "feedback_checkpoint.jsonl")
+    with open(tmp_path / "second" / "feedback.json", "r") as f: assert json.load(f) == second_run
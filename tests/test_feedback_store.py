@@ -0,0 +1,41 @@
+from feedback_store import FAILED,OK,FeedbackStore,StoredReferences
+
+
+def sample(name):
+    return {"instruction": f"Explain {name}.", "reference_response": f"{name} explained.", "response_feedback": "feedback"}
+
+
+def key(name, prompt_version="1"):
+    return FeedbackStore.key(f"Explain {name}.", f"{name} explained.", "teacher", prompt_version)
+
+
+def test_keys_depend_on_content_teacher_and_prompt_version():
+    assert key("a") == key("a")
+    assert len({key("a"), key("b"), key("a", "2"), FeedbackStore.key("Explain a.", "a explained.", "other", "1")}) == 4
+
+
+def test_failures_are_retried_without_overwriting_feedback(tmp_path):
+    store = FeedbackStore(str(tmp_path / "feedback.db"))
+    store.put_failure(key("a"), "teacher", "1", "timeout")
+    assert store.lookup(key("a"))[1] == FAILED
+    row_id = store.put(key("a"), "teacher", "1", sample("a"))
+    assert store.lookup(key("a")) == (row_id, OK)
+
+    # A failure recorded later, e.g. by another process, keeps the stored feedback
+    store.put_failure(key("a"), "teacher", "1", "timeout")
+    assert store.lookup(key("a")) == (row_id, OK)
+    assert store.get(row_id) == sample("a")
+    assert store.counts("teacher", "1") == {OK: 1}
+
+
+def test_stored_references_read_samples_on_access(tmp_path):
+    store = FeedbackStore(str(tmp_path / "feedback.db"))
+    assert store.import_samples([sample("a"), sample("b")], "teacher", "1") == 2
+    assert store.import_samples([sample("a")], "teacher", "1") == 0
+    row_ids = [store.lookup(key(name))[0] for name in ["b", "a"]]
+
+    references = StoredReferences(store, row_ids)
+    assert len(references) == 2
+    assert references[0] == sample("b")
+    assert list(references) == [sample("b"), sample("a")]
+    assert list(references[1:]) == [sample("a")]
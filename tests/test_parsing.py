@@ -0,0 +1,36 @@
+import pytest
+
+from parsing import ParseStats,SchemaError,load_json,parse_batched_items,parse_output
+
+SCHEMA = {"instructions": [str], "score": int}
+
+
+def test_load_json_strips_code_fences():
+    assert load_json('```json\n{"score": 3}\n```') == ({"score": 3}, False)
+    assert load_json('  ```\n[1, 2]\n```  ') == ([1, 2], False)
+    assert load_json('{"score": 3}') == ({"score": 3}, False)
+
+
+def test_load_json_falls_back_to_repair():
+    assert load_json('{"score": 3, "instructions": ["a", "b",]}') == ({"score": 3, "instructions": ["a", "b"]}, True)
+    assert load_json('```json\n{"score": 3\n```') == ({"score": 3}, True)
+
+
+def test_parse_output_validates_and_counts():
+    stats = ParseStats()
+    assert parse_output('{"instructions": ["a"], "score": 2, "extra": 1}', SCHEMA, stats, "stage") == {"instructions": ["a"], "score": 2}
+    with pytest.raises(SchemaError): parse_output('{"instructions": "a", "score": 2}', SCHEMA, stats, "stage")
+    with pytest.raises(SchemaError): parse_output('{"instructions": ["a"]}', SCHEMA, stats, "stage")
+    assert stats.stages["stage"] == {"outputs": 3, "repaired": 0, "failed": 2}
+
+
+def test_batched_items_keep_only_valid_answers():
+    items = [
+        {"id": 2, "instructions": ["b"], "score": 1},
+        {"id": "1", "instructions": ["a"], "score": 0},
+        {"id": 3, "instructions": ["c"]},
+        {"id": 9, "instructions": ["z"], "score": 0},
+        {"id": 1, "instructions": ["again"], "score": 0},
+        {"instructions": ["no id"], "score": 0},
+    ]
+    assert parse_batched_items(items, 3, SCHEMA) == {1: {"instructions": ["b"], "score": 1}, 0: {"instructions": ["a"], "score": 0}}
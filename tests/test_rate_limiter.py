@@ -0,0 +1,36 @@
+import pytest
+
+from rate_limiter import RateLimitedBackend,RateLimiter,estimate_prompt_tokens
+
+
+class StubBackend():
+    def __init__(self, usage=None, error=None):
+        self.usage,self.error = usage,error
+
+    def complete(self, prompt, model_name, temperature, max_tokens, top_p, stop=None):
+        if self.error is not None: raise self.error
+        return {"text": "ok", "usage": self.usage, "finish_reason": "stop"}
+
+
+def test_acquire_charges_and_waits_once_the_quota_is_spent():
+    limiter = RateLimiter(tokens_per_minute=6000, burst_seconds=10)
+    assert limiter.wait_time(1000) == 0
+    limiter.acquire(1000)
+    # 1000 tokens refill in 10 seconds at 6000 per minute
+    assert 9 < limiter.wait_time(1000) <= 10
+
+
+def test_unused_tokens_are_refunded():
+    limiter = RateLimiter(tokens_per_minute=6000, burst_seconds=10)
+    backend = RateLimitedBackend(StubBackend(usage={"prompt_tokens": 100, "completion_tokens": 50}), limiter)
+    backend.complete("x" * 400, "model", 1.0, 800, 1.0)
+    charged = estimate_prompt_tokens("x" * 400) + 800
+    assert charged > 150
+    assert limiter.tokens.level == pytest.approx(1000 - 150, abs=1)
+
+
+def test_rejected_requests_are_refunded_in_full():
+    limiter = RateLimiter(tokens_per_minute=6000, burst_seconds=10)
+    backend = RateLimitedBackend(StubBackend(error=RuntimeError("rejected")), limiter)
+    with pytest.raises(RuntimeError): backend.complete("x" * 400, "model", 1.0, 800, 1.0)
+    assert limiter.tokens.level == pytest.approx(1000, abs=1)
@@ -0,0 +1,68 @@
+import email.utils
+import time
+
+import pytest
+
+from retry_policy import CircuitBreaker,RetryBudget,RetryPolicy,get_retry_after,is_retryable
+
+
+class StatusError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = type("Response", (), {"headers": headers or {}})()
+
+
+def test_only_transient_errors_are_retryable():
+    assert all(is_retryable(StatusError(code)) for code in [408, 409, 429, 500, 503])
+    assert not any(is_retryable(StatusError(code)) for code in [400, 401, 403, 404])
+    assert is_retryable(ConnectionError()) and is_retryable(TimeoutError())
+    assert not is_retryable(ValueError())
+
+
+def test_retry_after_headers():
+    assert get_retry_after(StatusError(429, {"retry-after-ms": "1500"})) == 1.5
+    assert get_retry_after(StatusError(429, {"retry-after": "3"})) == 3.0
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < get_retry_after(StatusError(429, {"retry-after": date})) <= 30
+    assert get_retry_after(StatusError(429, {"retry-after": "soon"})) is None
+    assert get_retry_after(StatusError(429)) is None
+
+
+def test_wait_never_undercuts_retry_after():
+    policy = RetryPolicy(base_delay=0.5)
+    outcome = type("Outcome", (), {"exception": lambda self: StatusError(429, {"retry-after": "7"})})()
+    retry_state = type("RetryState", (), {"outcome": outcome, "attempt_number": 1})()
+    assert all(7 <= policy.wait(retry_state) <= 7.5 for _ in range(20))
+
+
+def make_policy(max_attempts=3):
+    return RetryPolicy(max_attempts=max_attempts, base_delay=0.0, circuit_breaker=CircuitBreaker(min_requests=1000))
+
+
+def test_call_retries_transient_errors_up_to_max_attempts():
+    calls = []
+    def fail(): calls.append(1); raise StatusError(503)
+    with pytest.raises(StatusError): make_policy(max_attempts=3).call(fail)
+    assert len(calls) == 3
+
+    results = iter([StatusError(429, {"retry-after-ms": "1"}), "ok"])
+    def flaky():
+        result = next(results)
+        if isinstance(result, Exception): raise result
+        return result
+    policy = make_policy()
+    assert policy.call(flaky) == "ok"
+    assert policy.stats()["transport_retries"] == 1
+
+
+def test_call_does_not_retry_permanent_errors():
+    calls = []
+    def fail(): calls.append(1); raise StatusError(401)
+    with pytest.raises(StatusError): make_policy().call(fail)
+    assert len(calls) == 1
+
+
+def test_retry_budget_denies_retries_once_spent():
+    budget = RetryBudget(ratio=0.0, min_retries_per_second=0.0, max_tokens=2)
+    assert [budget.try_spend() for _ in range(3)] == [True, True, False]
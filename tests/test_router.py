@@ -0,0 +1,63 @@
+import pytest
+
+from router import Deployment,DeploymentRouter
+
+
+class StatusError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = type("Response", (), {"headers": headers or {}})()
+
+
+class StubBackend():
+    def __init__(self, name, error=None):
+        self.name,self.error = name,error
+        self.num_requests = 0
+
+    def complete(self, prompt, model_name, temperature, max_tokens, top_p, stop=None):
+        self.num_requests += 1
+        if self.error is not None: raise self.error
+        return {"text": self.name, "usage": {"prompt_tokens": 1, "completion_tokens": 1}, "finish_reason": "stop"}
+
+
+def complete(router):
+    return router.complete("prompt", "model", 1.0, 16, 1.0)["text"]
+
+
+def test_transient_failures_fail_over_to_another_deployment():
+    throttled = StubBackend("throttled", StatusError(429, {"retry-after": "30"}))
+    healthy = StubBackend("healthy")
+    router = DeploymentRouter([Deployment("throttled", throttled, weight=1000), Deployment("healthy", healthy)], seed=0)
+
+    assert complete(router) == "healthy"
+    # The 429 takes the throttled deployment out of rotation for its Retry-After
+    assert all(complete(router) == "healthy" for _ in range(20))
+    assert throttled.num_requests == 1
+    assert router.num_failovers == 1
+    assert router.stats()["throttled"]["cooling_down"]
+
+
+def test_permanent_errors_are_not_failed_over():
+    broken = StubBackend("broken", StatusError(400))
+    healthy = StubBackend("healthy")
+    router = DeploymentRouter([Deployment("broken", broken, weight=1000), Deployment("healthy", healthy, weight=0.001)], seed=0)
+    with pytest.raises(StatusError): complete(router)
+    assert healthy.num_requests == 0 and router.num_failovers == 0
+
+
+def test_error_reaches_the_caller_once_every_deployment_failed():
+    backends = [StubBackend(f"down-{i}", StatusError(503)) for i in range(3)]
+    router = DeploymentRouter([Deployment(backend.name, backend) for backend in backends], seed=0)
+    with pytest.raises(StatusError): complete(router)
+    assert [backend.num_requests for backend in backends] == [1, 1, 1]
+    assert router.num_failovers == 2
+
+
+def test_repeated_failures_eject_a_deployment():
+    flaky = StubBackend("flaky", StatusError(503))
+    router = DeploymentRouter([Deployment("flaky", flaky)], max_consecutive_failures=2, base_cooldown=60)
+    for _ in range(2):
+        with pytest.raises(StatusError): complete(router)
+    stats = router.stats()["flaky"]
+    assert stats["ejected"] == 1 and stats["cooling_down"]
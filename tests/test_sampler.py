@@ -0,0 +1,26 @@
+import concurrent.futures
+
+from sampler import ReferenceSampler
+
+
+def test_reference_sampler_is_reproducible_and_resumable():
+    sampler = ReferenceSampler(5, seed=3)
+    draws = [sampler.draw() for _ in range(12)]
+
+    # Every epoch draws each reference exactly once
+    assert sorted(draws[:5]) == list(range(5)) and sorted(draws[5:10]) == list(range(5))
+
+    replayed = ReferenceSampler(5, seed=3)
+    assert [replayed.draw() for _ in range(12)] == draws
+
+    state = ReferenceSampler(5, seed=3, num_draws=7).state()
+    resumed = ReferenceSampler(5, state["seed"], state["num_draws"])
+    assert [resumed.draw() for _ in range(5)] == draws[7:12]
+
+
+def test_reference_sampler_draws_are_unique_across_threads():
+    sampler = ReferenceSampler(50, seed=3)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        draws = list(executor.map(lambda _: sampler.next_draw(), range(200)))
+    assert sorted(draws) == list(range(200))
+    assert sorted(sampler.reference_for(draw) for draw in range(50)) == list(range(50))
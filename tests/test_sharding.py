@@ -0,0 +1,41 @@
+import json
+import time
+
+from sharding import Lease
+
+
+def write_lease(path, owner, expires):
+    with open(path, "w") as f: json.dump({"owner": owner, "expires": expires}, f)
+
+
+def test_lease_is_exclusive_until_released(tmp_path):
+    path = str(tmp_path / "shard.lease")
+    first,second = Lease(path, "first"),Lease(path, "second")
+    assert first.acquire()
+    assert not second.acquire()
+    assert second.renew() is False and first.renew()
+    first.release()
+    assert second.acquire()
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    path = str(tmp_path / "shard.lease")
+    write_lease(path, "dead", time.time() - 1)
+    assert Lease(path, "taker").acquire()
+    assert Lease(path, "other").read()["owner"] == "taker"
+
+
+def test_lease_taken_over_by_another_worker_is_not_taken_again(tmp_path):
+    path = str(tmp_path / "shard.lease")
+    write_lease(path, "dead", time.time() - 1)
+    # The slower worker read the expired lease before the faster one took it over
+    slower = Lease(path, "slower")
+    stale = slower.read()
+    faster = Lease(path, "faster")
+    assert faster.acquire()
+
+    slower.read = lambda: stale
+    assert not slower.acquire()
+    assert faster.read()["owner"] == "faster"
+    assert faster.renew()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["shard.lease"]
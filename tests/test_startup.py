@@ -0,0 +1,12 @@
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_importing_generate_defers_heavy_dependencies():
+    heavy = ["openai", "datasets", "tiktoken", "tqdm", "numpy", "json_repair"]
+    code = f"import sys, generate; print(','.join(m for m in {heavy!r} if m in sys.modules))"
+    loaded = subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, check=True, capture_output=True, text=True).stdout.strip()
+    assert loaded == ""
@@ -0,0 +1,71 @@
+import pytest
+
+from backends import CONTENT_FILTER_MESSAGE
+from completion_cache import CompletionCache
+from parsing import ParseStats
+from retry_policy import CircuitBreaker,RetryPolicy
+from teacher_client import TeacherClient
+from token_budget import TokenBudget
+from tracing import Tracer
+from usage import UsageTracker
+
+SCHEMA = {"response": str}
+
+
+class ScriptedBackend():
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+        self.requests = []
+
+    def complete(self, prompt, model_name, temperature, max_tokens, top_p, stop=None):
+        self.requests.append(max_tokens)
+        text,finish_reason = self.outputs.pop(0)
+        if text is None: raise RuntimeError(CONTENT_FILTER_MESSAGE)
+        return {"text": text, "usage": {"prompt_tokens": 10, "completion_tokens": 5}, "finish_reason": finish_reason}
+
+
+class WordEncoder():
+    """Counts words instead of tokens, so usage-less responses do not need tiktoken encodings."""
+    def encode(self, text):
+        return text.split()
+
+
+def make_client(backend, cache=None, on_usage=None):
+    usage = UsageTracker("gpt-4o-mini")
+    usage._encoder = WordEncoder()
+    retry_policy = RetryPolicy(max_attempts=1, max_parse_attempts=2, circuit_breaker=CircuitBreaker(min_requests=1000))
+    token_budget = TokenBudget(defaults={"stage": 512}, max_tokens=2048)
+    return TeacherClient("gpt-4o-mini", backend, retry_policy, token_budget, Tracer(), usage, ParseStats(), cache, on_usage)
+
+
+def test_truncated_outputs_are_resent_with_a_larger_budget():
+    backend = ScriptedBackend([("cut", "length"), ("cut again", "length"), ('  {"response": "done"}  ', "stop")])
+    usages = []
+    client = make_client(backend, on_usage=lambda sample_index, usage: usages.append(sample_index))
+    assert client.ask("prompt", "stage", sample_index=4, schema=SCHEMA) == {"response": "done"}
+    assert backend.requests == [512, 1024, 2048]
+    assert usages == [4, 4, 4]
+
+
+def test_unparsable_outputs_are_asked_again_under_their_own_cache_key(tmp_path):
+    cache = CompletionCache(str(tmp_path / "cache.db"))
+    backend = ScriptedBackend([("not json", "stop"), ('{"response": "ok"}', "stop")])
+    assert make_client(backend, cache).ask("prompt", "stage", sample_index=4, schema=SCHEMA) == {"response": "ok"}
+    assert cache.get(cache.key("gpt-4o-mini", "prompt", 1.0, 2048, 1.0, None, 4))["text"] == "not json"
+    assert cache.get(cache.key("gpt-4o-mini", "prompt", 1.0, 2048, 1.0, None, [4, 1]))["text"] == '{"response": "ok"}'
+
+    # A second run is served from the cache
+    replay = ScriptedBackend([])
+    assert make_client(replay, cache).ask("prompt", "stage", sample_index=4, schema=SCHEMA) == {"response": "ok"}
+    assert replay.requests == []
+
+
+def test_filtered_outputs_are_not_asked_again():
+    backend = ScriptedBackend([(None, None)])
+    client = make_client(backend)
+    assert client.ask("prompt", "stage") == ""
+    assert len(backend.requests) == 1
+
+    backend = ScriptedBackend([(None, None)])
+    with pytest.raises(ValueError): make_client(backend).ask("prompt", "stage", schema=SCHEMA)
+    assert len(backend.requests) == 1
@@ -0,0 +1,35 @@
+from token_budget import TokenBudget
+
+
+def response(completion_tokens, finish_reason="stop"):
+    return {"text": "", "usage": {"prompt_tokens": 10, "completion_tokens": completion_tokens}, "finish_reason": finish_reason}
+
+
+def test_budget_adapts_to_the_percentile_of_observed_lengths():
+    budget = TokenBudget(defaults={"stage": 2048}, min_samples=20, bucket_size=16, margin=0.25, min_tokens=64)
+    for _ in range(19): budget.record("stage", response(100))
+    assert budget.budget("stage") == 2048
+    budget.record("stage", response(100))
+    # 100 tokens fall in the bucket ending at 112, plus 25%
+    assert budget.budget("stage") == 140
+    assert budget.budget("stage", num_items=3) == 420
+
+
+def test_batched_outputs_are_recorded_per_item_and_filtered_outputs_ignored():
+    budget = TokenBudget(min_samples=1, bucket_size=16, margin=0.0, min_tokens=1)
+    budget.record("stage", response(320), num_items=4)
+    budget.record("stage", response(4000, "content_filter"))
+    assert budget.budget("stage") == 96
+
+
+def test_truncated_outputs_escalate_up_to_the_ceiling():
+    budget = TokenBudget(max_tokens=4096)
+    assert budget.escalate("stage", 1024) == 2048
+    assert budget.escalate("stage", 3000) == 4096
+    assert budget.escalate("stage", 4096) is None
+
+
+def test_fixed_budgets_ignore_observed_lengths():
+    budget = TokenBudget(defaults={"stage": 1000}, min_samples=1, adaptive=False)
+    budget.record("stage", response(10))
+    assert budget.budget("stage") == 1000
@@ -0,0 +1,48 @@
+from ReferenceLevelFeedbackSynthesizer import ReferenceLevelFeedbackSynthesizer
+from backends import MockBackend
+from sampler import ReferenceYield,YieldAwareSampler
+
+
+def test_yield_sampler_forgets_finished_draws(tmp_path):
+    references = [{
+        "instruction": f"Explain topic {i}.",
+        "reference_response": f"Topic {i} is explained here.",
+        "instruction_feedback_subject": "subject feedback",
+        "instruction_feedback_skill": "skill feedback",
+        "response_feedback": "" if i % 5 == 0 else "response feedback",
+    } for i in range(20)]
+    backend = MockBackend(latency_median=0.001, filter_rate=0.05, seed=0)
+    synthesizer = ReferenceLevelFeedbackSynthesizer(references, output_dir=str(tmp_path), seed=0, backend=backend, reference_sampling="yield", num_workers=8)
+
+    max_assigned = 0
+    record_yield = synthesizer.record_yield
+    def tracked_record_yield(sample_index, **counters):
+        nonlocal max_assigned
+        record_yield(sample_index, **counters)
+        max_assigned = max(max_assigned, len(synthesizer.sampler.assigned))
+    synthesizer.record_yield = tracked_record_yield
+
+    synthesizer.synthesize_data(400)
+    # Only draws with items still in the pipeline keep their reference
+    assert synthesizer.sampler.num_draws > 20
+    assert max_assigned < synthesizer.sampler.num_draws // 3
+    assert not synthesizer.sampler.assigned
+
+
+def test_yield_aware_sampler_is_reproducible_for_the_same_yields():
+    def run():
+        reference_yield = ReferenceYield(6)
+        sampler = YieldAwareSampler(6, reference_yield, seed=11)
+        references = []
+        for _ in range(40):
+            draw = sampler.next_draw()
+            reference = sampler.reference_for(draw)
+            references.append(reference)
+            reference_yield.record(reference, draws=1, pairs=reference % 3, tokens=100)
+            sampler.release(draw)
+        assert not sampler.assigned
+        return references
+
+    references = run()
+    assert sorted(references[:6]) == list(range(6))
+    assert run() == references
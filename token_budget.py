@@ -0,0 +1,115 @@
+import math
+import threading
+
+from rate_limiter import estimate_prompt_tokens
+from usage import FEEDBACK,INSTRUCTION_GENERATION,RESPONSE_GENERATION,IMPROVEMENT
+
+# Starting max_tokens of each stage, before enough outputs have been seen to adapt it
+DEFAULT_MAX_TOKENS = {
+    FEEDBACK: 1024,
+    INSTRUCTION_GENERATION: 2048,
+    RESPONSE_GENERATION: 4096,
+    IMPROVEMENT: 4096,
+}
+
+
+class TokenBudget():
+    def __init__(self, defaults=None, percentile=99, margin=0.25, min_samples=20, min_tokens=256, max_tokens=4096, bucket_size=16, adaptive=True):
+        """
+        Per-stage max_tokens derived from a running histogram of completion lengths. Deployments
+        charge max_tokens against the TPM quota when they admit a request, so a budget close to
+        what a stage actually generates admits more concurrent requests under the same quota.
+        Truncated outputs are re-sent with a doubled budget, up to max_tokens.
+
+        Args:
+            defaults (Optional[dict]): starting max_tokens per stage, defaults to DEFAULT_MAX_TOKENS
+            percentile (float): percentile of observed completion lengths the budget covers
+            margin (float): fraction added on top of the percentile
+            min_samples (int): outputs of a stage to observe before its budget adapts
+            min_tokens (int): lowest budget a stage can adapt down to
+            max_tokens (int): highest budget, also the ceiling truncated outputs are retried up to
+            bucket_size (int): width of the histogram buckets in tokens
+            adaptive (bool): adapt the budgets, False to always request the defaults
+        """
+        self.defaults = dict(DEFAULT_MAX_TOKENS, **(defaults or {}))
+        self.percentile = percentile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.min_tokens,self.max_tokens = min_tokens,max_tokens
+        self.bucket_size = bucket_size
+        self.adaptive = adaptive
+
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def stage_counters(self, stage):
+        return self.counters.setdefault(stage, {"outputs": 0, "truncated": 0, "escalated": 0})
+
+    def record(self, stage, response, num_items=1):
+        """
+        Adds the completion length of a response to its stage's histogram.
+
+        Args:
+            stage (str): pipeline stage that sent the request
+            response (dict): response returned by the backend
+            num_items (int): items the request answered at once, the histogram holds lengths per item
+        """
+        if response.get("finish_reason") == "content_filter": return
+        usage = response.get("usage")
+        num_tokens = (usage["completion_tokens"] if usage is not None else estimate_prompt_tokens(response["text"])) // num_items
+        with self.lock:
+            histogram = self.histograms.setdefault(stage, {})
+            bucket = num_tokens // self.bucket_size
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+            counters = self.stage_counters(stage)
+            counters["outputs"] += 1
+            counters["truncated"] += response.get("finish_reason") == "length"
+
+    def budget(self, stage, num_items=1):
+        """
+        Args:
+            stage (str): pipeline stage about to send a request
+            num_items (int): items the request answers at once
+
+        Returns:
+            int: max_tokens to request
+        """
+        default = min(self.defaults.get(stage, self.max_tokens) * num_items, self.max_tokens)
+        if not self.adaptive: return default
+        with self.lock:
+            histogram = self.histograms.get(stage, {})
+            num_outputs = sum(histogram.values())
+            if num_outputs < self.min_samples: return default
+
+            # Upper edge of the bucket holding the percentile
+            rank,seen = math.ceil(num_outputs * self.percentile / 100),0
+            for bucket in sorted(histogram):
+                seen += histogram[bucket]
+                if seen >= rank: break
+        length = (bucket + 1) * self.bucket_size
+        return min(max(math.ceil(length * (1 + self.margin)), self.min_tokens) * num_items, self.max_tokens)
+
+    def escalate(self, stage, max_tokens):
+        """
+        Args:
+            stage (str): pipeline stage whose output was truncated
+            max_tokens (int): budget the truncated output was generated with
+
+        Returns:
+            Optional[int]: larger budget to retry with, or None if max_tokens is already the ceiling
+        """
+        if max_tokens >= self.max_tokens: return None
+        with self.lock: self.stage_counters(stage)["escalated"] += 1
+        return min(max_tokens * 2, self.max_tokens)
+
+    def summary(self):
+        """
+        Returns:
+            str: human readable budget and truncation counters per stage
+        """
+        lines = ["Token budgets:"]
+        with self.lock: counters = {stage: dict(stage_counters) for stage,stage_counters in self.counters.items()}
+        for stage,stage_counters in counters.items():
+            lines.append(f"    {stage}: max_tokens {self.budget(stage)} after {stage_counters['outputs']} outputs, {stage_counters['truncated']} truncated, {stage_counters['escalated']} retried with a larger budget")
+        return "\n".join(lines)
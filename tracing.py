@@ -0,0 +1,337 @@
+import collections
+import contextlib
+import itertools
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+from urllib.parse import parse_qs,urlparse
+
+
+class Tracer():
+    def __init__(self, path=None, flush_interval=1.0):
+        """
+        Records spans around requests, parsing, pipeline stages and checkpoints. Finished spans
+        are appended to an in-memory queue and written to a JSONL trace file by a background
+        thread, so the threads being traced never wait on the file. Per-span counters for the
+        metrics snapshot are kept whether or not a trace file is written.
+
+        Args:
+            path (Optional[str]): JSONL file the spans are appended to, None to only keep the counters
+            flush_interval (float): seconds between writes of the queued spans
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.start_time = time.monotonic()
+
+        self.ids = itertools.count(1)
+        self.local = threading.local()
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.counters = {}
+
+        self.stopped = threading.Event()
+        self.file,self.thread = None,None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, "a")
+            self.thread = threading.Thread(target=self.write_until_closed, daemon=True)
+            self.thread.start()
+
+    def stack(self):
+        if not hasattr(self.local, "stack"): self.local.stack = []
+        return self.local.stack
+
+    def current(self):
+        """
+        Returns:
+            Optional[dict]: innermost open span of the calling thread
+        """
+        stack = self.stack()
+        return stack[-1] if stack else None
+
+    def counters_for(self, key):
+        return self.counters.setdefault(key, {"count": 0, "errors": 0, "in_flight": 0, "seconds": 0.0, "max_seconds": 0.0})
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """
+        Times the enclosed block. The span is yielded as a dict, so attributes known only once
+        the block has run, like token counts, can be added to it. Counters are kept per name and
+        stage, e.g. "ask_gpt/improvement".
+
+        Args:
+            name (str): name of the span
+            **attributes: attributes of the span, e.g. stage and sample_index
+
+        Yields:
+            dict: the span
+        """
+        stack = self.stack()
+        span = {"name": name, "id": next(self.ids), "parent": stack[-1]["id"] if stack else None, "thread": threading.current_thread().name, "start": time.time(), **attributes}
+        key = f"{name}/{attributes['stage']}" if attributes.get("stage") is not None else name
+        with self.lock: self.counters_for(key)["in_flight"] += 1
+        stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span["error"] = f"{type(e).__name__}: {e}"[:500]
+            raise
+        finally:
+            span["duration"] = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                counters = self.counters_for(key)
+                counters["in_flight"] -= 1
+                counters["count"] += 1
+                counters["errors"] += "error" in span
+                counters["seconds"] += span["duration"]
+                counters["max_seconds"] = max(counters["max_seconds"], span["duration"])
+            if self.file is not None: self.queue.append(span)
+
+    def count(self, key, value=1):
+        """
+        Adds value to a counter attribute of the innermost open span, if any.
+
+        Returns:
+            Optional[float]: the counter after the addition
+        """
+        span = self.current()
+        if span is None: return None
+        span[key] = span.get(key, 0) + value
+        return span[key]
+
+    def stats(self):
+        """
+        Returns:
+            dict: span name (and stage) mapped to its counts, in-flight spans, errors and seconds spent
+        """
+        elapsed = time.monotonic() - self.start_time
+        with self.lock:
+            return {key: dict(counters, per_second=counters["count"] / elapsed if elapsed > 0 else 0.0, error_rate=counters["errors"] / counters["count"] if counters["count"] else 0.0, mean_seconds=counters["seconds"] / counters["count"] if counters["count"] else 0.0) for key,counters in self.counters.items()}
+
+    def flush(self):
+        lines = []
+        while self.queue: lines.append(json.dumps(self.queue.popleft(), default=str) + "\n")
+        if lines:
+            self.file.write("".join(lines))
+            self.file.flush()
+
+    def write_until_closed(self):
+        while not self.stopped.wait(self.flush_interval): self.flush()
+
+    def close(self):
+        """
+        Writes the remaining spans and closes the trace file.
+        """
+        if self.file is None: return
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+        self.file = None
+
+
+class SamplingProfiler():
+    def __init__(self, output_dir, interval=0.01):
+        """
+        Statistical profiler sampling the stacks of every thread from a background thread. It can
+        be switched on and off mid-run, e.g. with a signal, and writes each profile as folded
+        stacks, which flamegraph.pl and speedscope read.
+
+        Args:
+            output_dir (str): directory the profiles are written to
+            interval (float): seconds between samples
+        """
+        self.output_dir = output_dir
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread,self.stopped = None,threading.Event()
+        self.stacks = collections.Counter()
+
+    def running(self):
+        return self.thread is not None
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        for ident,frame in sys._current_frames().items():
+            if ident == own: continue
+            frames = [f"{os.path.basename(entry.filename)}:{entry.name}" for entry in traceback.extract_stack(frame)]
+            # Worker threads of a pool share one root, e.g. ThreadPoolExecutor-0 for ThreadPoolExecutor-0_3
+            self.stacks[";".join([names.get(ident, str(ident)).split("_")[0]] + frames)] += 1
+
+    def sample_until_stopped(self):
+        while not self.stopped.wait(self.interval): self.sample()
+
+    def start(self):
+        with self.lock:
+            if self.running(): return
+            print(f"Profiler started, sampling every {self.interval * 1000:.0f}ms")
+            self.stacks.clear()
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.sample_until_stopped, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Returns:
+            Optional[str]: path of the profile written, None if the profiler was not running
+        """
+        with self.lock:
+            if not self.running(): return None
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+            with open(path, "w") as f:
+                for stack,count in self.stacks.most_common(): f.write(f"{stack} {count}\n")
+        print(f"Profiler stopped after {sum(self.stacks.values())} thread samples, saved to {path}")
+        return path
+
+    def toggle(self):
+        if self.running(): self.stop()
+        else: self.start()
+
+    def install_signal_handler(self, signum=getattr(signal, "SIGUSR1", None)):
+        """
+        Toggles the profiler whenever the process receives signum, e.g. `kill -USR1 <pid>`.
+        Only possible from the main thread, on platforms with the signal.
+
+        Returns:
+            bool: whether the handler was installed
+        """
+        if signum is None or threading.current_thread() is not threading.main_thread(): return False
+        # The profile is written from a thread, since the handler interrupts the main thread mid-call
+        signal.signal(signum, lambda *args: threading.Thread(target=self.toggle, daemon=True).start())
+        return True
+
+
+class MetricsReporter():
+    def __init__(self, tracer, path=None, port=None, interval=10.0, profiler=None, host="127.0.0.1"):
+        """
+        Periodic snapshot of a run's span counters and of the counters of registered sources,
+        e.g. token usage and cost, queue depths and retries. Snapshots are written atomically to
+        a JSON file and served as JSON on GET /metrics. If a profiler is given, GET
+        /profile?seconds=N profiles the next N seconds.
+
+        Args:
+            tracer (Tracer): tracer whose span counters are reported
+            path (Optional[str]): JSON file rewritten with each snapshot
+            port (Optional[int]): local port serving the snapshots, None to not serve them
+            interval (float): seconds between snapshots
+            profiler (Optional[SamplingProfiler]): profiler the endpoint can switch on
+            host (str): interface to bind
+        """
+        self.tracer = tracer
+        self.path = path
+        self.interval = interval
+        self.profiler = profiler
+        self.lock = threading.Lock()
+        self.sources = {}
+        self.previous,self.last = None,None
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.server = None
+        if port is not None:
+            reporter = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def log_message(self, format, *args):
+                    pass
+
+                def send_json(self, status_code, body):
+                    data = json.dumps(body, default=str).encode("utf-8")
+                    self.send_response(status_code)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+
+                def do_GET(self):
+                    url = urlparse(self.path)
+                    if url.path == "/metrics":
+                        self.send_json(200, reporter.last or reporter.snapshot())
+                    elif url.path == "/profile" and reporter.profiler is not None:
+                        seconds = float(parse_qs(url.query).get("seconds", ["30"])[0])
+                        reporter.profiler.start()
+                        threading.Timer(seconds, reporter.profiler.stop).start()
+                        self.send_json(200, {"profiling_seconds": seconds, "output_dir": reporter.profiler.output_dir})
+                    else:
+                        self.send_json(404, {"error": f"{url.path} not found"})
+
+            self.server = ThreadingHTTPServer((host, port), Handler)
+            self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        if self.server is None: return None
+        host,port = self.server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def add_source(self, name, fn):
+        """
+        Adds, or replaces, a section of the snapshot.
+
+        Args:
+            name (str): key of the section
+            fn (Callable[[], dict]): returns the current counters of the section
+        """
+        with self.lock: self.sources[name] = fn
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: span counters, with their throughput since the previous snapshot, and the counters of every source
+        """
+        now = time.monotonic()
+        spans = self.tracer.stats()
+        if self.previous is not None:
+            previous_time,previous_spans = self.previous
+            for key,counters in spans.items():
+                counters["recent_per_second"] = (counters["count"] - previous_spans.get(key, {}).get("count", 0)) / max(now - previous_time, 1e-9)
+        snapshot = {"time": time.time(), "uptime": now - self.tracer.start_time, "pid": os.getpid(), "spans": spans}
+        with self.lock: sources = dict(self.sources)
+        for name,fn in sources.items():
+            try:
+                snapshot[name] = fn()
+            except Exception as e:
+                snapshot[name] = {"error": str(e)}
+        return snapshot
+
+    def report(self):
+        snapshot = self.snapshot()
+        self.previous,self.last = (time.monotonic(), snapshot["spans"]),snapshot
+        if self.path is not None:
+            with open(self.path + ".tmp", "w") as f: json.dump(snapshot, f, indent=2, default=str)
+            os.replace(self.path + ".tmp", self.path)
+
+    def report_until_stopped(self):
+        while not self.stopped.wait(self.interval): self.report()
+
+    def start(self):
+        self.report()
+        self.thread = threading.Thread(target=self.report_until_stopped, daemon=True)
+        self.thread.start()
+        if self.server is not None:
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            print(f"Serving metrics on {self.url}")
+        return self
+
+    def stop(self):
+        """
+        Writes a final snapshot and stops serving.
+        """
+        self.stopped.set()
+        if self.thread is not None: self.thread.join()
+        self.report()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
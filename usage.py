@@ -0,0 +1,198 @@
+import threading
+
+# Pipeline stages that send requests to the teacher model
+FEEDBACK = "feedback"
+INSTRUCTION_GENERATION = "instruction_generation"
+RESPONSE_GENERATION = "response_generation"
+IMPROVEMENT = "improvement"
+STAGES = [FEEDBACK, INSTRUCTION_GENERATION, RESPONSE_GENERATION, IMPROVEMENT]
+
+# (input, output) price in USD per million tokens
+PRICES_PER_MILLION_TOKENS = {
+    "gpt-4o-mini": (0.150, 0.600),
+    "gpt-4o": (2.50, 10.00),
+}
+
+# Input tokens served from the provider's prompt cache, in USD per million tokens
+CACHED_INPUT_PRICES_PER_MILLION_TOKENS = {
+    "gpt-4o-mini": 0.075,
+    "gpt-4o": 1.25,
+}
+
+# The Batch API is billed at half the list price
+BATCH_PRICE_MULTIPLIER = 0.5
+
+
+def get_usage(response):
+    """
+    Extracts token usage from a chat completion response.
+
+    Args:
+        response (ChatCompletion): response returned by the completions API
+
+    Returns:
+        Optional[dict]: prompt, completion and cached prompt token counts, or None if the API did not report usage
+    """
+    if getattr(response, "usage", None) is None: return None
+    cached_tokens = getattr(getattr(response.usage, "prompt_tokens_details", None), "cached_tokens", None) or 0
+    return {"prompt_tokens": response.usage.prompt_tokens, "completion_tokens": response.usage.completion_tokens, "cached_tokens": cached_tokens}
+
+
+def usage_from_json(usage):
+    """
+    Args:
+        usage (Optional[dict]): usage object of a chat completion in JSON, e.g. from a Batch API output file
+
+    Returns:
+        Optional[dict]: prompt, completion and cached prompt token counts
+    """
+    if usage is None: return None
+    return {"prompt_tokens": usage["prompt_tokens"], "completion_tokens": usage["completion_tokens"], "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0}
+
+
+def usage_to_json(usage):
+    """
+    Args:
+        usage (dict): prompt, completion and cached prompt token counts
+
+    Returns:
+        dict: usage object of a chat completion in JSON
+    """
+    return {
+        "prompt_tokens": usage["prompt_tokens"],
+        "completion_tokens": usage["completion_tokens"],
+        "total_tokens": usage["prompt_tokens"] + usage["completion_tokens"],
+        "prompt_tokens_details": {"cached_tokens": usage.get("cached_tokens", 0)},
+    }
+
+
+class UsageTracker():
+    def __init__(self, model_name, price_multiplier=1.0):
+        """
+        Thread-safe per-stage token and cost accounting. Token counts come from the usage
+        reported by the API; prompts are only tokenized locally when usage is missing.
+
+        Args:
+            model_name (str): name of the teacher model, used for pricing and fallback tokenization
+            price_multiplier (float): multiplier on the list price, e.g. BATCH_PRICE_MULTIPLIER for Batch API requests
+        """
+        self.model_name = model_name
+        self.price_multiplier = price_multiplier
+        self.lock = threading.Lock()
+        self.stages = {stage: {"calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0} for stage in STAGES}
+        self.latencies = {stage: [] for stage in STAGES}
+        self._encoder = None
+
+    @property
+    def encoder(self):
+        if self._encoder is None:
+            import tiktoken
+            try:
+                self._encoder = tiktoken.encoding_for_model(self.model_name)
+            except KeyError:
+                self._encoder = tiktoken.get_encoding("o200k_base")
+        return self._encoder
+
+    def record(self, stage, prompt, text, usage=None, latency=None):
+        """
+        Records a completed request.
+
+        Args:
+            stage (str): pipeline stage that sent the request
+            prompt (str): prompt sent to the model, only tokenized if usage is None
+            text (str): response received from the model, only tokenized if usage is None
+            usage (Optional[dict]): prompt, completion and cached prompt token counts reported by the API
+            latency (Optional[float]): seconds taken by the request, including retries
+
+        Returns:
+            dict: prompt and completion token counts recorded
+        """
+        if usage is None:
+            usage = {"prompt_tokens": len(self.encoder.encode(prompt)), "completion_tokens": len(self.encoder.encode(text))}
+
+        with self.lock:
+            counters = self.stages.setdefault(stage, {"calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0})
+            counters["calls"] += 1
+            counters["input_tokens"] += usage["prompt_tokens"]
+            counters["cached_tokens"] += usage.get("cached_tokens", 0)
+            counters["output_tokens"] += usage["completion_tokens"]
+            if latency is not None: self.latencies.setdefault(stage, []).append(latency)
+        return usage
+
+    def latency_percentile(self, stage, percentile):
+        """
+        Args:
+            stage (str): pipeline stage
+            percentile (float): percentile between 0 and 100
+
+        Returns:
+            Optional[float]: latency in seconds at the percentile, or None if the stage has no requests
+        """
+        with self.lock:
+            latencies = sorted(self.latencies.get(stage, []))
+        if not latencies: return None
+        return latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+
+    def totals(self):
+        """
+        Returns:
+            dict: calls, input, cached input and output tokens summed over all stages
+        """
+        with self.lock:
+            return {key: sum(counters[key] for counters in self.stages.values()) for key in ["calls", "input_tokens", "cached_tokens", "output_tokens"]}
+
+    def stats(self):
+        """
+        Returns:
+            dict: totals, cost and per-stage counters
+        """
+        totals = self.totals()
+        with self.lock: stages = {stage: dict(counters) for stage,counters in self.stages.items() if counters["calls"]}
+        return dict(totals, cost=self.cost(totals["input_tokens"], totals["output_tokens"], totals["cached_tokens"]), stages=stages)
+
+    def dollars_per_token(self):
+        """
+        Returns:
+            Optional[float]: average cost of the tokens used so far, or None if unknown
+        """
+        totals = self.totals()
+        cost = self.cost(totals["input_tokens"], totals["output_tokens"], totals["cached_tokens"])
+        if cost is None or not totals["input_tokens"] + totals["output_tokens"]: return None
+        return cost / (totals["input_tokens"] + totals["output_tokens"])
+
+    def cost(self, input_tokens, output_tokens, cached_tokens=0):
+        """
+        Args:
+            input_tokens (int): number of input tokens, including cached ones
+            output_tokens (int): number of output tokens
+            cached_tokens (int): number of input tokens served from the provider's prompt cache
+
+        Returns:
+            Optional[float]: cost in USD, or None if the model has no known price
+        """
+        if self.model_name not in PRICES_PER_MILLION_TOKENS: return None
+        input_price,output_price = PRICES_PER_MILLION_TOKENS[self.model_name]
+        cached_price = CACHED_INPUT_PRICES_PER_MILLION_TOKENS.get(self.model_name, input_price)
+        return ((input_tokens - cached_tokens)*input_price + cached_tokens*cached_price + output_tokens*output_price) * self.price_multiplier / 1000000
+
+    def summary(self, title="Total cost"):
+        """
+        Args:
+            title (str): heading for the summary
+
+        Returns:
+            str: human readable token usage and cost, overall and per stage
+        """
+        totals = self.totals()
+        lines = [
+            f"{title}:",
+            f"    Total input tokens: {totals['input_tokens']}",
+            f"    Cached input tokens: {totals['cached_tokens']} ({totals['cached_tokens'] / max(totals['input_tokens'], 1):.1%} of input tokens)",
+            f"    Total output tokens: {totals['output_tokens']}",
+            f"    Total cost: {self.cost(totals['input_tokens'], totals['output_tokens'], totals['cached_tokens'])}",
+        ]
+        with self.lock:
+            for stage,counters in self.stages.items():
+                if counters["calls"] == 0: continue
+                lines.append(f"    {stage}: {counters['calls']} calls, {counters['input_tokens']} input tokens ({counters['cached_tokens'] / counters['input_tokens'] if counters['input_tokens'] else 0:.1%} cached), {counters['output_tokens']} output tokens, cost {self.cost(counters['input_tokens'], counters['output_tokens'], counters['cached_tokens'])}")
+        return "\n".join(lines)